@@ -3,6 +3,26 @@ __ksql_server_version__ = "0.10.1"
 __ksql_api_version__ = "0.1.2"
 __version__ = __ksql_server_version__ + "." + __ksql_api_version__
 
-from ksql.client import KSQLAPI  # noqa
+import importlib
+
 from ksql.builder import SQLBuilder  # noqa
-from ksql.api import SimplifiedAPI  # noqa
+
+# The clients pull in the HTTP transports, they are only imported the first time they are used so that
+# ``import ksql`` stays cheap for programs that only build SQL. Module level ``__getattr__`` needs Python 3.7.
+_lazy_imports = {
+    "KSQLAPI": "ksql.client",
+    "SimplifiedAPI": "ksql.api",
+}
+
+
+def __getattr__(name):
+    module = _lazy_imports.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_imports))
@@ -2,18 +2,58 @@ import time
 
 import base64
 import functools
-import json
 import logging
-import requests
-import urllib
 from copy import deepcopy
-from requests import Timeout
 from urllib.parse import urlparse
-from hyper import HTTPConnection
 
 
 from ksql.builder import SQLBuilder
-from ksql.errors import CreateError, InvalidQueryError, KSQLError
+from ksql.codec import get_codec
+from ksql.compression import CompressionStats, Decompressor, accept_encoding, compress, iter_lines
+from ksql.errors import CommandTimeoutError, InvalidQueryError, KSQLError
+from ksql.queries import QueryRegistry, parse_query_id
+from ksql.utils import iter_json_array
+
+# Entity fields holding the items of a listing, yielded one by one by ksql_iter
+LISTING_FIELDS = ("queries", "queryDescriptions", "sourceDescriptions", "streams", "tables", "topics", "properties")
+# Command statuses after which a command won't change anymore, ERROR aside
+COMMAND_DONE = ("SUCCESS", "TERMINATED")
+
+
+def _normalize_statement(statement):
+    return " ".join(statement.split()).rstrip(";").strip().lower()
+
+
+def split_entities(statements, entities):
+    """
+    Assign the entities of a multi-statement ``/ksql`` response back to the statements that produced them.
+
+    Entities are matched on their ``statementText``, so statements producing no entity or several of them get theirs.
+    Identical statements are told apart by their order, and entities without a ``statementText``, e.g. warnings,
+    belong to the statement matched last. When some texts match none of the statements, e.g. rewritten by the server,
+    and there are as many entities as statements, entities are assigned by position instead.
+
+    """
+    keys = [_normalize_statement(statement) for statement in statements]
+    results = [[] for _ in statements]
+    matched = [False] * len(statements)
+    current = 0
+    unmatched = False
+    for entity in entities:
+        text = entity.get("statementText")
+        if text is not None:
+            key = _normalize_statement(text)
+            candidates = [index for index in range(current, len(keys)) if keys[index] == key]
+            if candidates:
+                # the first statement not matched yet, or the last matched one producing several entities
+                current = next((index for index in candidates if not matched[index]), candidates[0])
+                matched[current] = True
+            else:
+                unmatched = True
+        results[current].append(entity)
+    if unmatched and len(entities) == len(statements):
+        return [[entity] for entity in entities]
+    return results
 
 
 class BaseAPI(object):
@@ -28,10 +68,96 @@ class BaseAPI(object):
             'Content-Type': 'application/vnd.ksql.v1+json; charset=utf-8',
         }
         self.cert = kwargs.get("cert")
+        self.client_cert = kwargs.get("client_cert")
+        self.client_key = kwargs.get("client_key")
+        self.client_key_password = kwargs.get("client_key_password")
+        self._ssl_context = kwargs.get("ssl_context")
+        self._http2_ssl_context = None
+        self.tls_sessions = None
+        self.http2_tls_sessions = None
+        self._opener = None
+        self._session = None
+        self.codec = get_codec(kwargs.get("codec"))
+        self.compression = kwargs.get("compression", False)
+        self.request_compression = kwargs.get("request_compression")
+        self.compression_stats = CompressionStats()
+        self.command_sequence_number = None
+        self.queries = QueryRegistry(self)
+        if self.compression:
+            self.headers["Accept-Encoding"] = accept_encoding()
 
     def get_timout(self):
         return self.timeout
 
+    @property
+    def secure(self):
+        return urlparse(self.url).scheme == "https"
+
+    @property
+    def ssl_context(self):
+        """
+        SSL context shared by every HTTP/1.1 connection of this client, built on first use. Its TLS sessions are
+        resumed, ``tls_sessions`` counts the handshakes.
+
+        """
+        if self.tls_sessions is None:
+            from ksql.tls import create_ssl_context, resume_sessions
+
+            if self._ssl_context is None:
+                self._ssl_context = create_ssl_context(
+                    cafile=self.cert,
+                    certfile=self.client_cert,
+                    keyfile=self.client_key,
+                    password=self.client_key_password,
+                )
+            self.tls_sessions = resume_sessions(self._ssl_context)
+        return self._ssl_context
+
+    @property
+    def http2_ssl_context(self):
+        """ Same settings as ``ssl_context``, advertising h2 with ALPN so the HTTP/2 transport can negotiate it. """
+        if self._http2_ssl_context is None:
+            from ksql.tls import create_ssl_context, resume_sessions
+
+            self._http2_ssl_context = create_ssl_context(
+                cafile=self.cert,
+                certfile=self.client_cert,
+                keyfile=self.client_key,
+                password=self.client_key_password,
+                alpn_protocols=["h2", "http/1.1"],
+            )
+            self.http2_tls_sessions = resume_sessions(self._http2_ssl_context)
+        return self._http2_ssl_context
+
+    def _get_opener(self):
+        if self._opener is None:
+            from ksql.tls import build_opener
+
+            self._opener = build_opener(self.ssl_context if self.secure else None)
+        return self._opener
+
+    def _get_session(self):
+        if self._session is None:
+            import requests
+
+            self._session = requests.Session()
+            if self.secure:
+                from ksql.tls import mount_ssl_context
+
+                mount_ssl_context(self._session, self.ssl_context)
+        return self._session
+
+    def _http2_connection(self):
+        from hyper import HTTPConnection
+
+        parsed_uri = urlparse(self.url)
+        if self.secure:
+            return HTTPConnection(parsed_uri.netloc, secure=True, ssl_context=self.http2_ssl_context)
+        return HTTPConnection(parsed_uri.netloc)
+
+    def _decompressor(self, headers):
+        return Decompressor(headers.get("Content-Encoding"), self.compression_stats)
+
     @staticmethod
     def _validate_sql_string(sql_string):
         if len(sql_string) > 0:
@@ -42,8 +168,7 @@ class BaseAPI(object):
         return sql_string
 
     @staticmethod
-    def _raise_for_status(r, response):
-        r_json = json.loads(response)
+    def _raise_for_status(r, r_json):
         if r.getcode() != 200:
             # seems to be the new API behavior
             if r_json.get("@type") == "statement_error" or r_json.get("@type") == "generic_error":
@@ -52,7 +177,7 @@ class BaseAPI(object):
                 stackTrace = r_json["stack_trace"]
                 raise KSQLError(error_message, error_code, stackTrace)
             else:
-                raise KSQLError("Unknown Error: {}".format(r.content))
+                raise KSQLError("Unknown Error: {}".format(r_json))
         else:
             # seems to be the old API behavior, so some errors have status 200, bug??
             if r_json and r_json[0]["@type"] == "currentStatus" and r_json[0]["commandStatus"]["status"] == "ERROR":
@@ -62,20 +187,157 @@ class BaseAPI(object):
                 raise KSQLError(error_message, error_code, stackTrace)
             return True
 
-    def ksql(self, ksql_string, stream_properties=None):
-        r = self._request(endpoint="ksql", sql_string=ksql_string, stream_properties=stream_properties)
-        response = r.read().decode("utf-8")
-        self._raise_for_status(r, response)
-        res = json.loads(response)
+    def ksql(self, ksql_string, stream_properties=None, command_sequence_number=None):
+        r = self._request(
+            endpoint="ksql",
+            sql_string=ksql_string,
+            stream_properties=stream_properties,
+            command_sequence_number=command_sequence_number,
+        )
+        res = self.codec.loads(self._decompressor(r.headers).decompress(r.read()))
+        self._raise_for_status(r, res)
+        self._track_command_sequence_number(res)
         return res
 
-    def query2(self, query_string, encoding="utf-8", chunk_size=128, stream_properties=None, idle_timeout=None):
+    def _track_command_sequence_number(self, entities):
+        numbers = [e["commandSequenceNumber"] for e in entities if e.get("commandSequenceNumber", -1) >= 0]
+        if numbers:
+            self.command_sequence_number = max(numbers)
+
+    def ksql_many(self, statements, stream_properties=None, max_statements=50, max_bytes=1024 * 1024):
         """
-        Process streaming incoming data with HTTP/2.
+        Execute a list of statements with as few ``/ksql`` requests as possible.
+
+        Statements are packed into requests of at most ``max_statements`` statements and ``max_bytes`` bytes, encoded
+        in utf-8. The command sequence number of each request is passed to the next one, so the server waits for the
+        previous commands to be applied instead of the client polling for them.
+
+        Returns the list of entities produced by each statement, in the order of ``statements``. A statement failing
+        raises for its whole request: the requests before it have been executed, the following ones are not sent.
 
         """
-        parsed_uri = urlparse(self.url)
+        statements = [self._validate_sql_string(statement.strip()) for statement in statements]
+        results = []
+        batch = []
+        size = 0
+        for statement in statements:
+            length = len(statement.encode("utf-8"))
+            if batch and (len(batch) >= max_statements or size + length > max_bytes):
+                results.extend(self._ksql_batch(batch, stream_properties))
+                batch, size = [], 0
+            batch.append(statement)
+            size += length + 1
+        if batch:
+            results.extend(self._ksql_batch(batch, stream_properties))
+        return results
+
+    def _ksql_batch(self, statements, stream_properties):
+        entities = self.ksql(
+            "\n".join(statements),
+            stream_properties=stream_properties,
+            command_sequence_number=self.command_sequence_number,
+        )
+        return split_entities(statements, entities)
+
+    def command_status(self, command_id):
+        """ Current status of a command, e.g. ``{"status": "EXECUTING", "message": "..."}``. """
+        import urllib.parse
+        import urllib.request
+
+        url = "{}/status/{}".format(self.url, urllib.parse.quote(command_id, safe="/"))
+        headers = deepcopy(self.headers)
+        if self.api_key and self.secret:
+            base64string = base64.b64encode(bytes("{}:{}".format(self.api_key, self.secret), "utf-8")).decode("utf-8")
+            headers["Authorization"] = "Basic %s" % base64string
+        r = self._open(urllib.request.Request(url=url, headers=headers, method="GET"))
+        return self.codec.loads(self._decompressor(r.headers).decompress(r.read()))
+
+    def wait_for_command(self, command_id, timeout=60, poll_interval=0.01, max_poll_interval=1.0):
+        """
+        Poll the status of a command until it has been executed.
+
+        The delay between polls starts at ``poll_interval`` and doubles up to ``max_poll_interval``, so commands that
+        complete quickly are noticed quickly without hammering the server while slow ones run.
+
+        Parameter List
+        -------------
+        :param command_id: ``commandId`` returned by ``/ksql``.
+        :param timeout: Seconds to wait before raising CommandTimeoutError.
+        :param poll_interval: Delay before the second poll, in seconds.
+        :param max_poll_interval: Upper bound of the delay between polls, in seconds.
+
+        """
+        deadline = time.time() + timeout
+        delay = poll_interval
+        while True:
+            status = self.command_status(command_id)
+            if self._command_done(command_id, status):
+                return status
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise CommandTimeoutError(command_id, status, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_poll_interval)
+
+    def wait_for_commands(self, entities, timeout=60, poll_interval=0.01, max_poll_interval=1.0):
+        """
+        Wait for every command of a ``/ksql`` response to be executed, then return the entities.
+
+        Commands the server already reports as done are not polled, and ERROR statuses raise KSQLError. ``timeout``
+        applies to each command.
+
+        """
+        for entity in entities:
+            command_id = entity.get("commandId")
+            if command_id is None or self._command_done(command_id, entity.get("commandStatus")):
+                continue
+            entity["commandStatus"] = self.wait_for_command(
+                command_id, timeout=timeout, poll_interval=poll_interval, max_poll_interval=max_poll_interval
+            )
+        return entities
+
+    @staticmethod
+    def _command_done(command_id, status):
+        if not status:
+            return False
+        if status.get("status") == "ERROR":
+            raise KSQLError("Command {} failed: {}".format(command_id, status.get("message")))
+        return status.get("status") in COMMAND_DONE
 
+    def ksql_iter(self, ksql_string, stream_properties=None, chunk_size=65536, expand=LISTING_FIELDS):
+        """
+        Like ``ksql`` but parses the response incrementally and yields the entities one by one.
+
+        For listings (``SHOW QUERIES EXTENDED``, ``LIST STREAMS EXTENDED``, ...) the items of the listing are
+        yielded instead of the single entity wrapping them, so peak memory stays bounded by the largest item.
+
+        """
+        r = self._request(endpoint="ksql", sql_string=ksql_string, stream_properties=stream_properties)
+        chunks = iter(functools.partial(r.read, chunk_size), b"")
+        chunks = self._decompressor(r.headers).iter_decompress(chunks)
+        for entity in iter_json_array(chunks, loads=self.codec.loads, expand=expand):
+            if entity.get("@type") == "currentStatus" and entity["commandStatus"]["status"] == "ERROR":
+                raise KSQLError(entity["commandStatus"]["message"])
+            yield entity
+
+    def query2(
+        self,
+        query_string,
+        encoding="utf-8",
+        chunk_size=128,
+        stream_properties=None,
+        idle_timeout=None,
+        profiler=None,
+        budget=None,
+        on_start=None,
+    ):
+        """
+        Process streaming incoming data with HTTP/2.
+
+        A ``ksql.queries.QueryBudget`` given as ``budget`` stops the query when one of its limits is exceeded.
+        ``on_start`` is called with the ``ksql.queries.PushQuery`` once the query is running.
+
+        """
         logging.debug("KSQL generated: {}".format(query_string))
         sql_string = self._validate_sql_string(query_string)
         body = {"sql": sql_string}
@@ -84,33 +346,84 @@ class BaseAPI(object):
         else:
             body["properties"] = {}
 
-        with HTTPConnection(parsed_uri.netloc) as connection:
+        if budget is not None:
+            budget.start()
+        with self._http2_connection() as connection:
             streaming_response = self._request2(
                 endpoint="query-stream", body=body, connection=connection
             )
             start_idle = None
 
             if streaming_response.status == 200:
-                for chunk in streaming_response.read_chunked():
-                    if chunk != b"\n":
-                        start_idle = None
-                        yield chunk.decode(encoding)
-
-                    else:
-                        if not start_idle:
-                            start_idle = time.time()
-                        if idle_timeout and time.time() - start_idle > idle_timeout:
-                            print("Ending query because of time out! ({} seconds)".format(idle_timeout))
-                            return
+                chunks = streaming_response.read_chunked(decode_content=False)
+                if profiler is not None:
+                    chunks = profiler.wrap(chunks, "network")
+                content_encoding = streaming_response.headers.get(b"content-encoding", [b"identity"])[0]
+                if content_encoding != b"identity":
+                    decompressor = Decompressor(content_encoding.decode("ascii"), self.compression_stats)
+                    chunks = iter_lines(decompressor.iter_decompress(chunks))
+                push_query = self.queries.register("query-stream", sql_string)
+                push_query.response = streaming_response
+                if budget is not None:
+                    budget.query = push_query
+                if on_start is not None:
+                    on_start(push_query)
+                finished = False
+                header = True
+                try:
+                    for chunk in chunks:
+                        if chunk != b"\n":
+                            start_idle = None
+                            line = chunk.decode(encoding)
+                            if budget is not None:
+                                # rows are arrays, the header and final or error messages objects
+                                budget.add(len(chunk), not header and chunk.startswith(b"["))
+                            if header:
+                                push_query.query_id = parse_query_id(line)
+                                header = False
+                            yield line
+
+                        else:
+                            if budget is not None:
+                                budget.check_time()
+                            if not start_idle:
+                                start_idle = time.time()
+                            if idle_timeout and time.time() - start_idle > idle_timeout:
+                                print("Ending query because of time out! ({} seconds)".format(idle_timeout))
+                                return
+                    finished = True
+                except Exception:
+                    if push_query.closed:
+                        return
+                    raise
+                finally:
+                    self._end_push_query(push_query, finished)
             else:
                 raise ValueError("Return code is {}.".format(streaming_response.status))
 
-    def query(self, query_string, encoding="utf-8", chunk_size=128, stream_properties=None, idle_timeout=None):
+    def query(
+        self,
+        query_string,
+        encoding="utf-8",
+        chunk_size=128,
+        stream_properties=None,
+        idle_timeout=None,
+        profiler=None,
+        budget=None,
+        on_start=None,
+    ):
         """
         Process streaming incoming data.
 
+        A ``ksql.queries.QueryBudget`` given as ``budget`` stops the query when one of its limits is exceeded.
+        ``on_start`` is called with the ``ksql.queries.PushQuery`` once the query is running.
+
         """
 
+        import http.client
+
+        if budget is not None:
+            budget.start()
         streaming_response = self._request(
             endpoint="query", sql_string=query_string, stream_properties=stream_properties
         )
@@ -118,26 +431,68 @@ class BaseAPI(object):
         start_idle = None
 
         if streaming_response.code == 200:
-            for chunk in streaming_response:
-                if chunk != b"\n":
-                    start_idle = None
-                    yield chunk.decode(encoding)
-                else:
-                    if not start_idle:
-                        start_idle = time.time()
-                    if idle_timeout and time.time() - start_idle > idle_timeout:
-                        print("Ending query because of time out! ({} seconds)".format(idle_timeout))
-                        return
+            chunks = streaming_response
+            if streaming_response.headers.get("Content-Encoding"):
+                chunks = iter(functools.partial(streaming_response.read1, 65536), b"")
+            if profiler is not None:
+                chunks = profiler.wrap(chunks, "network")
+            if streaming_response.headers.get("Content-Encoding"):
+                chunks = iter_lines(self._decompressor(streaming_response.headers).iter_decompress(chunks))
+            push_query = self.queries.register("query", query_string)
+            push_query.response = streaming_response
+            if budget is not None:
+                budget.query = push_query
+            if on_start is not None:
+                on_start(push_query)
+            finished = False
+            header = True
+            try:
+                for chunk in chunks:
+                    if chunk != b"\n":
+                        start_idle = None
+                        line = chunk.decode(encoding)
+                        if budget is not None:
+                            budget.add(len(chunk), not header and chunk.startswith(b'{"row"'))
+                        if header:
+                            push_query.query_id = parse_query_id(line)
+                            header = False
+                        yield line
+                    else:
+                        if budget is not None:
+                            budget.check_time()
+                        if not start_idle:
+                            start_idle = time.time()
+                        if idle_timeout and time.time() - start_idle > idle_timeout:
+                            print("Ending query because of time out! ({} seconds)".format(idle_timeout))
+                            return
+                # iterating over the response swallows a connection dropped in the middle of a chunk
+                if getattr(streaming_response, "chunked", False) and streaming_response.chunk_left is not None:
+                    raise http.client.IncompleteRead(b"")
+                finished = True
+            except Exception:
+                if push_query.closed:
+                    # closed from another thread while reading
+                    return
+                raise
+            finally:
+                self._end_push_query(push_query, finished)
         else:
             raise ValueError("Return code is {}.".format(streaming_response.status_code))
 
+    def _end_push_query(self, push_query, finished):
+        # runs when the generator is exhausted, closed or garbage collected: only abandoned queries need closing
+        if finished:
+            self.queries.discard(push_query)
+        else:
+            self.queries.close(push_query)
+
     def get_request(self, endpoint):
         auth = (self.api_key, self.secret) if self.api_key or self.secret else None
-        return requests.get(endpoint, headers=self.headers, auth=auth, verify=self.cert)
+        return self._get_session().get(endpoint, headers=self.headers, auth=auth)
 
     def _request2(self, endpoint, connection, body, method="POST", encoding="utf-8"):
         url = "{}/{}".format(self.url, endpoint)
-        data = json.dumps(body).encode(encoding)
+        data = self.codec.dumps(body)
 
         headers = deepcopy(self.headers)
         if self.api_key and self.secret:
@@ -149,7 +504,17 @@ class BaseAPI(object):
 
         return resp
 
-    def _request(self, endpoint, method="POST", sql_string="", stream_properties=None, encoding="utf-8"):
+    def _request(
+        self,
+        endpoint,
+        method="POST",
+        sql_string="",
+        stream_properties=None,
+        encoding="utf-8",
+        command_sequence_number=None,
+    ):
+        import urllib.request
+
         url = "{}/{}".format(self.url, endpoint)
 
         logging.debug("KSQL generated: {}".format(sql_string))
@@ -160,7 +525,9 @@ class BaseAPI(object):
             body["streamsProperties"] = stream_properties
         else:
             body["streamsProperties"] = {}
-        data = json.dumps(body).encode(encoding)
+        if command_sequence_number is not None:
+            body["commandSequenceNumber"] = command_sequence_number
+        data = self.codec.dumps(body)
 
         headers = deepcopy(self.headers)
         if self.api_key and self.secret:
@@ -168,12 +535,16 @@ class BaseAPI(object):
             headers["Authorization"] = "Basic %s" % base64string
 
         req = urllib.request.Request(url=url, data=data, headers=headers, method=method.upper())
+        return self._open(req)
+
+    def _open(self, req):
+        import urllib.error
 
         try:
-            r = urllib.request.urlopen(req, timeout=self.timeout, cafile=self.cert)
+            r = self._get_opener().open(req, timeout=self.timeout)
         except urllib.error.HTTPError as http_error:
             try:
-                content = json.loads(http_error.read().decode(encoding))
+                content = self.codec.loads(self._decompressor(http_error.headers).decompress(http_error.read()))
             except Exception as e:
                 raise http_error
             else:
@@ -184,41 +555,44 @@ class BaseAPI(object):
 
     def close_query(self, query_id):
         body = {"queryId": query_id}
-        data = json.dumps(body).encode("utf-8")
+        data = self.codec.dumps(body)
         url = "{}/{}".format(self.url, "close-query")
 
-        response = requests.post(url=url, data=data, verify=self.cert)
+        response = self._get_session().post(url=url, data=data)
 
         if response.status_code == 200:
             logging.debug("Successfully canceled Query ID: {}".format(query_id))
             return True
         elif response.status_code == 400:
-            message = json.loads(response.content)["message"]
+            message = self.codec.loads(response.content)["message"]
             logging.debug("Failed canceling Query ID: {}: {}".format(query_id, message))
             return False
         else:
             raise ValueError("Return code is {}.".format(response.status_code))
 
     def inserts_stream(self, stream_name, rows):
-        body = '{{"target":"{}"}}'.format(stream_name)
-        for row in rows:
-            body += '\n{}'.format(json.dumps(row))
+        dumps = self.codec.dumps
+        body = b"\n".join([dumps({"target": stream_name})] + [dumps(row) for row in rows])
+        headers = deepcopy(self.headers)
+        if self.request_compression:
+            body = compress(body, self.request_compression, self.compression_stats)
+            headers["Content-Encoding"] = self.request_compression
 
-        parsed_uri = urlparse(self.url)
         url = "{}/{}".format(self.url, "inserts-stream")
-        headers = deepcopy(self.headers)
-        with HTTPConnection(parsed_uri.netloc) as connection:
-            connection.request("POST", url, bytes(body, "utf-8"), headers)
+        with self._http2_connection() as connection:
+            connection.request("POST", url, body, headers)
             response = connection.get_response()
-            result = response.read()
+            result = response.read(decode_content=False)
+            content_encoding = response.headers.get(b"content-encoding", [b"identity"])[0].decode("ascii")
+        result = Decompressor(content_encoding, self.compression_stats).decompress(result)
 
-        result_str = result.decode("utf-8")
-        result_chunks = result_str.split("\n")
         return_arr = []
-        for chunk in result_chunks:
+        for chunk in result.split(b"\n"):
+            if not chunk.strip():
+                continue
             try:
-                return_arr.append(json.loads(chunk))
-            except:
+                return_arr.append(self.codec.loads(chunk))
+            except ValueError:
                 pass
 
         return return_arr
@@ -318,10 +692,9 @@ class SimplifiedAPI(BaseAPI):
             value_format=value_format,
             key=key,
         )
-        self.ksql(ksql_string)
+        self.wait_for_commands(self.ksql(ksql_string))
         return True
 
-    @BaseAPI.retry(exceptions=(Timeout, CreateError))
     def _create_as(
         self,
         table_type,
@@ -346,5 +719,5 @@ class SimplifiedAPI(BaseAPI):
             partition_by=partition_by,
             **kwargs,
         )
-        self.ksql(ksql_string)
+        self.wait_for_commands(self.ksql(ksql_string))
         return True
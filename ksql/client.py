@@ -1,25 +1,61 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import threading
+import time
+
 from ksql.api import SimplifiedAPI
+from ksql.queries import QueryBudget, QueryResults
 from ksql.utils import process_query_result
 
+# Server versions are shared by every client of the process, keyed by url: {url: (version, expires_at)}
+_version_cache = {}  # type: dict
+_version_cache_lock = threading.Lock()
+VERSION_CACHE_TTL = 300
+
+# First server versions serving the /query-stream endpoint: standalone ksqlDB releases are numbered 0.x, the
+# Confluent Platform ones (5.x for KSQL, ...) ship ksqlDB 0.10 from 6.0
+QUERY_STREAM_MIN_VERSION = (0, 10, 0)
+CONFLUENT_QUERY_STREAM_MIN_VERSION = (6, 0, 0)
+
+
+def parse_version(version):
+    """ Turn a version string like ``0.10.1`` or ``7.3.0-ccs`` into a tuple of ints, None if it can't be parsed. """
+    parts = []
+    for part in str(version).split("-")[0].split("."):
+        if not part.isdigit():
+            break
+        parts.append(int(part))
+    return tuple(parts) or None
+
 
 class KSQLAPI(object):
     """ API Class """
 
-    def __init__(self, url, max_retries=3, check_version=True, ** kwargs):
+    def __init__(self, url, max_retries=3, check_version=True, version_cache_ttl=VERSION_CACHE_TTL, ** kwargs):
         """
         You can use a Basic Authentication with this API, for now we accept the api_key/secret based on the Confluent
         Cloud implementation. So you just need to put on the kwargs the api_key and secret.
+
+        The server version is checked on the first request rather than here, and cached for ``version_cache_ttl``
+        seconds for every client of the same url.
         """
         self.url = url
 
         self.sa = SimplifiedAPI(url, max_retries=max_retries, **kwargs)
+        # to build equivalent clients, e.g. in worker processes
+        self._options = dict(
+            kwargs, max_retries=max_retries, check_version=check_version, version_cache_ttl=version_cache_ttl
+        )
 
         self.check_version = check_version
-        if check_version is True:
+        self.version_cache_ttl = version_cache_ttl
+        self._version_checked = check_version is not True
+
+    def _ensure_version(self):
+        if not self._version_checked:
             self.get_ksql_version()
+            self._version_checked = True
 
     def get_url(self):
         return self.url
@@ -28,31 +64,161 @@ class KSQLAPI(object):
     def timeout(self):
         return self.sa.get_timout()
 
-    def get_ksql_version(self):
+    @property
+    def compression_stats(self):
+        return self.sa.compression_stats
+
+    def get_ksql_version(self, use_cache=True):
+        if use_cache:
+            with _version_cache_lock:
+                cached = _version_cache.get(self.url)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+
         r = self.sa.get_request(self.url + "/info")
         if r.status_code == 200:
             info = r.json().get("KsqlServerInfo")
             version = info.get("version")
+            with _version_cache_lock:
+                _version_cache[self.url] = (version, time.monotonic() + self.version_cache_ttl)
             return version
 
         else:
             raise ValueError("Status Code: {}.\nMessage: {}".format(r.status_code, r.content))
 
+    def supports_query_stream(self):
+        """ Whether the server is recent enough to serve push and pull queries on ``/query-stream``. """
+        version = parse_version(self.get_ksql_version())
+        if version is None:
+            return False
+        if version[0] == 0:
+            return version >= QUERY_STREAM_MIN_VERSION
+        return version >= CONFLUENT_QUERY_STREAM_MIN_VERSION
+
     def get_properties(self):
+        self._ensure_version()
         properties = self.sa.ksql("show properties;")
         return properties[0]["properties"]
 
-    def ksql(self, ksql_string, stream_properties=None):
-        return self.sa.ksql(ksql_string, stream_properties=stream_properties)
+    def ksql(self, ksql_string, stream_properties=None, command_sequence_number=None):
+        self._ensure_version()
+        return self.sa.ksql(
+            ksql_string, stream_properties=stream_properties, command_sequence_number=command_sequence_number
+        )
+
+    def ksql_many(self, statements, stream_properties=None, max_statements=50, max_bytes=1024 * 1024):
+        self._ensure_version()
+        return self.sa.ksql_many(
+            statements, stream_properties=stream_properties, max_statements=max_statements, max_bytes=max_bytes
+        )
+
+    def ksql_iter(self, ksql_string, stream_properties=None, chunk_size=65536):
+        self._ensure_version()
+        return self.sa.ksql_iter(ksql_string, stream_properties=stream_properties, chunk_size=chunk_size)
+
+    def query(
+        self,
+        query_string,
+        encoding="utf-8",
+        chunk_size=128,
+        stream_properties=None,
+        idle_timeout=None,
+        use_http2=None,
+        return_objects=None,
+        profiler=None,
+        buffer_size=None,
+        overflow="block",
+        max_rows=None,
+        max_bytes=None,
+        max_seconds=None,
+        max_buffered_bytes=None,
+    ):
+        """
+        Execute a query and yield the streamed results.
+
+        Pass a ``ksql.profiling.QueryProfiler`` as ``profiler`` to get a breakdown of where the time went. The
+        summary report is returned by the generator when it is exhausted and stored on ``profiler.report`` once the
+        generator is closed.
+
+        With ``use_http2="auto"`` the ``/query-stream`` endpoint is used when the server version supports it.
+
+        ``return_objects=True`` yields the rows as dicts. ``return_objects="typed"`` yields compact tuples readable by
+        column name, and ``"lazy"`` rows decoded when first read, see ``ksql.rows``.
+
+        With ``buffer_size`` the results are read and decoded on a background thread, see
+        ``ksql.streaming.BackgroundReader`` for the ``overflow`` policies. It can't be combined with a ``profiler``,
+        which times a single thread.
+
+        ``max_rows``, ``max_bytes``, ``max_seconds`` and, with a ``buffer_size``, ``max_buffered_bytes`` bound the
+        query: when one is exceeded it is stopped and ``QueryBudgetExceededError`` is raised, see
+        ``ksql.queries.QueryBudget``.
+
+        Returns a ``ksql.queries.QueryResults``, which can be closed from another thread. With a ``buffer_size``, its
+        ``stats()`` reports the queue depth and dropped rows of the background reader.
+
+        """
+        results = QueryResults()
+        results.results = self._query(
+            results,
+            query_string,
+            encoding=encoding,
+            chunk_size=chunk_size,
+            stream_properties=stream_properties,
+            idle_timeout=idle_timeout,
+            use_http2=use_http2,
+            return_objects=return_objects,
+            profiler=profiler,
+            buffer_size=buffer_size,
+            overflow=overflow,
+            max_rows=max_rows,
+            max_bytes=max_bytes,
+            max_seconds=max_seconds,
+            max_buffered_bytes=max_buffered_bytes,
+        )
+        return results
+
+    def _query(
+        self,
+        query_results,
+        query_string,
+        encoding,
+        chunk_size,
+        stream_properties,
+        idle_timeout,
+        use_http2,
+        return_objects,
+        profiler,
+        buffer_size,
+        overflow,
+        max_rows,
+        max_bytes,
+        max_seconds,
+        max_buffered_bytes,
+    ):
+        self._ensure_version()
+        if use_http2 == "auto":
+            use_http2 = self.supports_query_stream()
+
+        budget = None
+        if max_buffered_bytes is not None and not buffer_size:
+            raise ValueError("max_buffered_bytes requires a buffer_size")
+        if buffer_size and profiler is not None:
+            raise ValueError("A profiler can't time a query read on a background thread, drop buffer_size or profiler")
+        if any(limit is not None for limit in (max_rows, max_bytes, max_seconds, max_buffered_bytes)):
+            budget = QueryBudget(
+                max_rows=max_rows, max_bytes=max_bytes, max_seconds=max_seconds, max_buffered_bytes=max_buffered_bytes
+            )
 
-    def query(self, query_string, encoding="utf-8", chunk_size=128, stream_properties=None, idle_timeout=None, use_http2=None, return_objects=None):
         if use_http2:
-            yield from self.sa.query2(
+            results = self.sa.query2(
                 query_string=query_string,
                 encoding=encoding,
                 chunk_size=chunk_size,
                 stream_properties=stream_properties,
                 idle_timeout=idle_timeout,
+                profiler=profiler,
+                budget=budget,
+                on_start=query_results.started,
             )
         else:
             results = self.sa.query(
@@ -60,23 +226,230 @@ class KSQLAPI(object):
                 encoding=encoding,
                 chunk_size=chunk_size,
                 stream_properties=stream_properties,
-                idle_timeout=idle_timeout
+                idle_timeout=idle_timeout,
+                profiler=profiler,
+                budget=budget,
+                on_start=query_results.started,
+            )
+        results = process_query_result(results, return_objects, loads=self.sa.codec.loads)
+
+        if buffer_size:
+            from ksql.streaming import BackgroundReader
+
+            results = BackgroundReader(
+                results, buffer_size=buffer_size, overflow=overflow, budget=budget, interrupt=query_results.stop
+            )
+            query_results.reader = results
+
+        if profiler is None:
+            yield from results
+            return
+
+        try:
+            yield from profiler.wrap(results, "decode", outer=True)
+        finally:
+            report = profiler.finish()
+        return report
+
+    def resilient_query(self, query_string, use_http2=None, return_objects=None, **options):
+        """
+        Like ``query`` but reconnects when the connection fails, resuming where the stream stopped and dropping the
+        rows replayed. See ``ksql.resilient.ResilientQuery`` for the ``options``.
+
+        """
+        from ksql.resilient import ResilientQuery
+
+        self._ensure_version()
+        if use_http2 == "auto":
+            use_http2 = self.supports_query_stream()
+        results = iter(ResilientQuery(self.sa, query_string, use_http2=bool(use_http2), **options))
+        return process_query_result(results, return_objects, loads=self.sa.codec.loads)
+
+    def query_parallel(
+        self,
+        query_string,
+        processes=None,
+        batch_size=1000,
+        max_delay=0.05,
+        transform=None,
+        stream_properties=None,
+        idle_timeout=None,
+        executor=None,
+    ):
+        """
+        Execute a query and decode its rows on a process pool, see ``ksql.parallel.ParallelDecoder``.
+
+        Yields the row dicts, or what ``transform`` returns for them, in the order of the stream. Needs Python 3.8.
+
+        """
+        from ksql.parallel import ParallelDecoder
+
+        self._ensure_version()
+        lines = self.sa.query(query_string, stream_properties=stream_properties, idle_timeout=idle_timeout)
+        return iter(
+            ParallelDecoder(
+                lines,
+                processes=processes,
+                batch_size=batch_size,
+                max_delay=max_delay,
+                transform=transform,
+                codec=self.sa.codec.name,
+                executor=executor,
             )
+        )
+
+    def sharded_query(self, query_string, shards=2, partition_expression="ROWPARTITION", transform=None, **kwargs):
+        """
+        Consume a push query with ``shards`` worker processes, each reading a disjoint set of partitions, see
+        ``ksql.parallel.ShardedQuery``. The workers create their clients with the options of this one.
+
+        """
+        from ksql.parallel import ShardedQuery
+
+        self._ensure_version()
+        return ShardedQuery(
+            self.url,
+            query_string,
+            shards=shards,
+            partition_expression=partition_expression,
+            options=self._options,
+            transform=transform,
+            **kwargs,
+        )
+
+    def parallel_pull(self, table, start, end, shards=4, columns="*", where=None, max_workers=None):
+        """
+        Pull the windows of ``table`` starting in ``[start, end)`` with ``shards`` concurrent queries, yielding the
+        rows in window order, see ``ksql.pull.parallel_pull``.
 
-            yield from process_query_result(results, return_objects)
+        """
+        from ksql.pull import parallel_pull
+
+        self._ensure_version()
+        return parallel_pull(
+            self, table, start, end, shards=shards, columns=columns, where=where, max_workers=max_workers
+        )
+
+    def get_many(self, table, keys, key_column="ID", columns="*", batch_size=100, max_bytes=16384, max_workers=4):
+        """
+        Look up many keys of ``table`` with concurrent ``IN (...)`` pull queries and return a dict of the rows found
+        by key, see ``ksql.pull.get_many``.
+
+        """
+        from ksql.pull import get_many
+
+        self._ensure_version()
+        return get_many(
+            self,
+            table,
+            keys,
+            key_column=key_column,
+            columns=columns,
+            batch_size=batch_size,
+            max_bytes=max_bytes,
+            max_workers=max_workers,
+        )
+
+    def merge_queries(self, queries, buffer_size=1000, **query_kwargs):
+        """
+        Run several push queries concurrently and iterate over their rows as ``(tag, row)`` pairs.
+
+        Parameter List
+        -------------
+        :param queries: A dict mapping tags to query strings, or a list of query strings used as their own tags.
+        :param buffer_size: Maximum number of rows buffered per query.
+        :param query_kwargs: Passed to ``query`` for every query, e.g. ``return_objects=True``.
+
+        """
+        from ksql.streaming import MergedQueries
+
+        if not isinstance(queries, dict):
+            queries = {query_string: query_string for query_string in queries}
+        generators = {tag: self.query(query_string, **query_kwargs) for tag, query_string in queries.items()}
+        return MergedQueries(generators, buffer_size=buffer_size)
+
+    def aggregate_windows(
+        self,
+        query_string,
+        window,
+        key=None,
+        value=None,
+        aggregations=("count",),
+        time_column="ROWTIME",
+        grace=0,
+        batch_size=1000,
+        max_delay=0.05,
+        **query_kwargs
+    ):
+        """
+        Run a push query and aggregate its rows over event time windows on the client, yielding one result per
+        window as it closes, see ``ksql.windows.WindowedAggregator``. The query must select ``time_column``.
+
+        """
+        from ksql.windows import WindowedAggregator
+
+        aggregator = WindowedAggregator(
+            window, key=key, value=value, aggregations=aggregations, time_column=time_column, grace=grace
+        )
+        rows = self.query(query_string, return_objects=True, **query_kwargs)
+        return aggregator.aggregate(rows, batch_size=batch_size, max_delay=max_delay)
+
+    def query_to_file(self, query_string, path, format=None, use_http2=None, stream_properties=None, **sink_options):
+        """
+        Run a query and write its rows to files until it ends, e.g. with a ``LIMIT``, and return the write statistics.
+        The format is guessed from the extension of ``path`` unless given, see ``ksql.sinks`` for the ``sink_options``.
+
+        """
+        from ksql.sinks import open_sink
+
+        sink = open_sink(path, format=format, loads=self.sa.codec.loads, **sink_options)
+        lines = self.query(query_string, stream_properties=stream_properties, use_http2=use_http2)
+        return sink.consume(lines)
+
+    def export_snapshot(self, table, path, key_column=None, batch_size=10000, stream_properties=None, where=None):
+        """
+        Scan ``table`` into a columnar snapshot file that ``ksql.snapshot.Snapshot`` maps back into memory, and return
+        the number of rows, see ``ksql.snapshot.export_snapshot``.
+
+        """
+        from ksql.snapshot import export_snapshot
+
+        self._ensure_version()
+        return export_snapshot(
+            self,
+            table,
+            path,
+            key_column=key_column,
+            batch_size=batch_size,
+            stream_properties=stream_properties,
+            where=where,
+        )
 
     def close_query(self, query_id):
+        self._ensure_version()
         return self.sa.close_query(query_id)
 
+    @property
+    def active_queries(self):
+        """ Push queries started by this client that are still running. """
+        return self.sa.queries.active()
+
+    def close_all(self, max_workers=8):
+        """ Close every active push query, concurrently. """
+        return self.sa.queries.close_all(max_workers=max_workers)
+
     def inserts_stream(self, stream_name, rows):
+        self._ensure_version()
         return self.sa.inserts_stream(stream_name, rows)
 
     def create_stream(self, table_name, columns_type, topic, value_format="JSON"):
+        self._ensure_version()
         return self.sa.create_stream(
             table_name=table_name, columns_type=columns_type, topic=topic, value_format=value_format
         )
 
     def create_table(self, table_name, columns_type, topic, value_format, key, **kwargs):
+        self._ensure_version()
         return self.sa.create_table(
             table_name=table_name, columns_type=columns_type, topic=topic, value_format=value_format, key=key, **kwargs
         )
@@ -92,7 +465,7 @@ class KSQLAPI(object):
         partition_by=None,
         **kwargs
     ):
-
+        self._ensure_version()
         return self.sa.create_stream_as(
             table_name=table_name,
             select_columns=select_columns,
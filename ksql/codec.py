@@ -0,0 +1,89 @@
+"""
+JSON codecs used to encode requests and decode responses and rows.
+
+The standard library ``json`` module is the default. Faster backends are used when they are installed and asked for,
+either by name (``codec="orjson"``) or with ``codec="auto"``, which picks the fastest one available.
+
+"""
+import json
+
+
+class JSONCodec(object):
+    """ Standard library codec, ``loads`` accepts str or bytes and ``dumps`` returns utf-8 encoded bytes. """
+
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self.loads = orjson.loads
+        self.dumps = orjson.dumps
+
+
+class UjsonCodec(JSONCodec):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson  # type: ignore
+
+        self.loads = ujson.loads
+        self._dumps = ujson.dumps
+
+    def dumps(self, obj):
+        return self._dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+class SimdjsonCodec(JSONCodec):
+    """ simdjson only parses, encoding falls back to the standard library. """
+
+    name = "simdjson"
+
+    def __init__(self):
+        import simdjson  # type: ignore
+
+        self.loads = simdjson.loads
+
+
+CODECS = {codec.name: codec for codec in (OrjsonCodec, UjsonCodec, SimdjsonCodec, JSONCodec)}
+# Preference order for codec="auto"
+AUTO_ORDER = ("orjson", "simdjson", "ujson", "json")
+
+
+def available_codecs():
+    """ Names of the codecs whose backend is installed. """
+    names = []
+    for name in AUTO_ORDER:
+        try:
+            CODECS[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get_codec(codec=None):
+    """
+    Resolve a codec from a name, ``"auto"``, an instance or None (standard library).
+
+    Asking for a backend by name raises ImportError when it is not installed.
+
+    """
+    if codec is None:
+        return JSONCodec()
+    if not isinstance(codec, str):
+        return codec
+    if codec == "auto":
+        return CODECS[available_codecs()[0]]()
+    if codec not in CODECS:
+        raise ValueError("Unknown codec {}, expected one of: {}".format(codec, ", ".join(AUTO_ORDER)))
+    return CODECS[codec]()
@@ -0,0 +1,147 @@
+"""
+HTTP content-encoding support: gzip and deflate with zlib, zstd when the ``zstandard`` package is installed.
+
+"""
+import threading
+import time
+import zlib
+
+
+def _zstandard():
+    try:
+        import zstandard  # type: ignore
+    except ImportError:
+        return None
+    return zstandard
+
+
+def supported_encodings():
+    encodings = ["gzip", "deflate"]
+    if _zstandard() is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def accept_encoding():
+    """ Value of the Accept-Encoding header advertising every supported encoding. """
+    return ", ".join(supported_encodings())
+
+
+class CompressionStats(object):
+    """
+    Bytes saved by compression and the CPU time spent on it, accumulated over the life of a client. Thread-safe, the
+    streams of a client are read from background and merge threads too.
+
+    """
+
+    def __init__(self):
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_saved(self):
+        return self.decoded_bytes - self.wire_bytes
+
+    @property
+    def ratio(self):
+        return self.wire_bytes / self.decoded_bytes if self.decoded_bytes else 1.0
+
+    def record(self, wire_bytes, decoded_bytes, cpu_seconds):
+        with self._lock:
+            self.wire_bytes += wire_bytes
+            self.decoded_bytes += decoded_bytes
+            self.cpu_seconds += cpu_seconds
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "wire_bytes": self.wire_bytes,
+                "decoded_bytes": self.decoded_bytes,
+                "bytes_saved": self.bytes_saved,
+                "ratio": self.ratio,
+                "cpu_seconds": self.cpu_seconds,
+            }
+
+
+class Decompressor(object):
+    """ Streaming decoder for a response body sent with the given Content-Encoding. """
+
+    def __init__(self, encoding, stats=None):
+        self.encoding = (encoding or "identity").lower()
+        self.stats = stats
+        if self.encoding == "gzip":
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self._decoder = zlib.decompressobj()
+            self._raw_deflate = None
+        elif self.encoding == "zstd":
+            zstandard = _zstandard()
+            if zstandard is None:
+                raise ValueError("Server sent a zstd encoded response but zstandard is not installed")
+            self._decoder = zstandard.ZstdDecompressor().decompressobj()
+        elif self.encoding == "identity":
+            self._decoder = None
+        else:
+            raise ValueError("Unsupported Content-Encoding: {}".format(encoding))
+
+    def decompress(self, data):
+        if self._decoder is None or not data:
+            return data
+        started = time.process_time()
+        if self.encoding == "deflate" and self._raw_deflate is None:
+            # some servers send raw deflate streams without the zlib header
+            try:
+                decoded = self._decoder.decompress(data)
+                self._raw_deflate = False
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                self._raw_deflate = True
+                decoded = self._decoder.decompress(data)
+        else:
+            decoded = self._decoder.decompress(data)
+        if self.stats is not None:
+            self.stats.record(len(data), len(decoded), time.process_time() - started)
+        return decoded
+
+    def iter_decompress(self, chunks):
+        for chunk in chunks:
+            decoded = self.decompress(chunk)
+            if decoded:
+                yield decoded
+        if self._decoder is not None and hasattr(self._decoder, "flush"):
+            tail = self._decoder.flush()
+            if tail:
+                yield tail
+
+
+def compress(data, encoding, stats=None):
+    """ Compress a whole request body. """
+    started = time.process_time()
+    if encoding in ("gzip", "deflate"):
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+    elif encoding == "zstd":
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise ValueError("zstd request compression requires the zstandard package")
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        raise ValueError("Unsupported request compression: {}".format(encoding))
+    if stats is not None:
+        stats.record(len(compressed), len(data), time.process_time() - started)
+    return compressed
+
+
+def iter_lines(chunks):
+    """ Re-split a stream of byte chunks into lines, each keeping its trailing newline. """
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending
@@ -41,3 +41,22 @@ class KSQLError(Exception):
         self.msg = "{}".format(e)
         self.error_code = error_code
         self.stackTrace = stackTrace
+
+
+class CommandTimeoutError(Exception):
+    def __init__(self, command_id, status, timeout):
+        self.msg = "Command {} is still {} after {} seconds".format(command_id, (status or {}).get("status"), timeout)
+        self.command_id = command_id
+        self.status = status
+
+
+class QueryBudgetExceededError(Exception):
+    def __init__(self, limit, value, maximum, query_id=None):
+        self.msg = "Query {} exceeded its budget: {} reached {}, the maximum is {}".format(
+            query_id, limit, value, maximum
+        )
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+        self.query_id = query_id
+        super(QueryBudgetExceededError, self).__init__(self.msg)
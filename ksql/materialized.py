@@ -0,0 +1,241 @@
+"""
+Tables materialized in memory from their changelog.
+
+A ``MaterializedView`` runs ``SELECT * FROM <table> EMIT CHANGES`` and applies every change to a local keyed store,
+so reads are dictionary lookups instead of pull queries.
+
+"""
+import json
+import os
+import pickle
+import threading
+
+from ksql.resilient import normalize_line
+from ksql.utils import parse_columns
+
+
+class MaterializedView(object):
+    """
+    Keep a local copy of a table up to date from a push query on it.
+
+    Rows are stored as tuples keyed by their key. A change whose row is a tombstone deletes the key. Secondary
+    indexes map the values of other columns to the keys having them. Lookups don't take a lock, updates are applied
+    by a single thread and hold a lock that ``save`` takes to copy the rows.
+
+    A snapshot saved with ``save`` can be given as ``snapshot`` to serve reads right away when the process restarts,
+    while the changelog is replayed from the beginning of the topic and brings the view up to date.
+
+    Parameter List
+    -------------
+    :param client: The ``KSQLAPI`` running the push query.
+    :param table: Name of the table.
+    :param key_columns: Names of the key columns, a composite key is looked up as a tuple.
+    :param indexes: Names of columns to index.
+    :param use_http2: Run the push query on ``/query-stream``, see ``KSQLAPI.query``.
+    :param stream_properties: Properties of the push query, ``auto.offset.reset`` is ``earliest`` unless set.
+    :param snapshot: Path of a snapshot to load when it exists.
+    :param is_tombstone: Function telling whether a row dict deletes its key, when the server doesn't flag tombstones.
+
+    """
+
+    def __init__(
+        self,
+        client,
+        table,
+        key_columns=("ID",),
+        indexes=(),
+        use_http2=False,
+        stream_properties=None,
+        snapshot=None,
+        is_tombstone=None,
+    ):
+        if isinstance(key_columns, str):
+            key_columns = (key_columns,)
+        self.client = client
+        self.table = table
+        self.key_columns = tuple(key_columns)
+        self.use_http2 = use_http2
+        self.stream_properties = dict({"auto.offset.reset": "earliest"}, **(stream_properties or {}))
+        self.is_tombstone = is_tombstone
+        self.columns = None
+        self.updates = 0
+        self.deletes = 0
+        self._rows = {}
+        self._indexes = {column: {} for column in indexes}
+        self._positions = None
+        self._key_positions = None
+        self._stopped = False
+        self._thread = None
+        self._results = None
+        self._lock = threading.Lock()
+        self._loads = client.sa.codec.loads if client is not None else json.loads
+        if snapshot is not None and os.path.exists(snapshot):
+            self.load(snapshot)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def get(self, key, default=None):
+        """ The row of ``key`` as a dict. """
+        row = self._rows.get(key)
+        if row is None:
+            return default
+        return dict(zip(self.columns, row))
+
+    def get_tuple(self, key):
+        """ The row of ``key`` as stored, a tuple in the order of ``columns``, for the fastest lookups. """
+        return self._rows.get(key)
+
+    def lookup(self, column, value):
+        """ The rows whose indexed ``column`` equals ``value``. """
+        keys = self._indexes[column].get(value, ())
+        return [self.get(key) for key in list(keys)]
+
+    def keys(self):
+        return list(self._rows)
+
+    def start(self):
+        """ Apply the changelog on a background thread. """
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """ Stop applying the changelog and close the push query, wait at most ``timeout`` seconds for its thread. """
+        self._stopped = True
+        results = self._results
+        if results is not None:
+            results.close()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """ Apply the changelog on the calling thread, until the query ends or ``stop`` is called. """
+        query_string = "SELECT * FROM {} EMIT CHANGES;".format(self.table)
+        lines = self.client.query(query_string, stream_properties=self.stream_properties, use_http2=self.use_http2)
+        self._results = lines
+        self._positions = None
+        try:
+            if self._stopped:
+                return
+            for line in lines:
+                if self._stopped:
+                    break
+                self.apply(line)
+        finally:
+            lines.close()
+
+    def apply(self, line):
+        """ Apply one line of the push query response: the header, a row or a tombstone. """
+        line = normalize_line(line)
+        if not line or line == "]":
+            return
+        if self._positions is None:
+            with self._lock:
+                self._read_header(line)
+            return
+        message = self._loads(line)
+        tombstone = False
+        if isinstance(message, dict):
+            if "row" not in message:
+                # finalMessage, errorMessage
+                return
+            tombstone = bool(message.get("tombstone") or message["row"].get("tombstone"))
+            values = message["row"]["columns"]
+        else:
+            values = message
+        row = tuple(values)
+        key = self._key(row)
+        if not tombstone and self.is_tombstone is not None:
+            tombstone = self.is_tombstone(dict(zip(self.columns, row)))
+        with self._lock:
+            if tombstone:
+                self._delete(key)
+            else:
+                self._upsert(key, row)
+
+    def _read_header(self, line):
+        header = self._loads(line[1:] if line.startswith("[") else line)
+        if "header" in header:
+            columns = [column["name"] for column in parse_columns(line)]
+        else:
+            columns = list(header["columnNames"])
+        if self.columns is not None and columns != self.columns:
+            # the table changed since the snapshot
+            self._rows.clear()
+            for index in self._indexes.values():
+                index.clear()
+        self.columns = columns
+        self._positions = {name: position for position, name in enumerate(columns)}
+        self._key_positions = [self._positions[name] for name in self.key_columns]
+
+    def _key(self, row):
+        if len(self._key_positions) == 1:
+            return row[self._key_positions[0]]
+        return tuple(row[position] for position in self._key_positions)
+
+    def _upsert(self, key, row):
+        previous = self._rows.get(key)
+        self._rows[key] = row
+        self.updates += 1
+        for column, index in self._indexes.items():
+            position = self._positions[column]
+            if previous is not None:
+                if previous[position] == row[position]:
+                    continue
+                self._unindex(index, previous[position], key)
+            index.setdefault(row[position], set()).add(key)
+
+    def _delete(self, key):
+        previous = self._rows.pop(key, None)
+        self.deletes += 1
+        if previous is None:
+            return
+        for column, index in self._indexes.items():
+            self._unindex(index, previous[self._positions[column]], key)
+
+    @staticmethod
+    def _unindex(index, value, key):
+        keys = index.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    def save(self, path):
+        """ Write a snapshot of the view atomically, while the changelog is applied if need be. """
+        with self._lock:
+            state = {
+                "table": self.table,
+                "columns": self.columns,
+                "key_columns": self.key_columns,
+                "rows": dict(self._rows),
+            }
+        tmp = "{}.tmp".format(path)
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """ Replace the content of the view with a snapshot written by ``save``. Only load trusted files. """
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state["table"] != self.table or tuple(state["key_columns"]) != self.key_columns:
+            raise ValueError(
+                "Snapshot {} is not a snapshot of {} keyed by {}".format(path, self.table, self.key_columns)
+            )
+        self.columns = state["columns"]
+        self._rows = state["rows"]
+        self._positions = None
+        positions = {name: position for position, name in enumerate(self.columns)}
+        for column, index in self._indexes.items():
+            index.clear()
+            position = positions[column]
+            for key, row in self._rows.items():
+                index.setdefault(row[position], set()).add(key)
@@ -0,0 +1,367 @@
+"""
+Consuming push queries on several cores.
+
+``ParallelDecoder`` decodes the rows of one query on a process pool. The raw lines of the response are grouped in
+batches, each batch is written to a shared memory block and a worker process decodes it, and applies an optional
+transformation, without the lines being pickled. Results are yielded in the order of the stream. They still travel
+back to the parent pickled, so the speed-up is largest for wide rows and for transformations that reduce them, e.g.
+to a few fields or an aggregate.
+
+``ShardedQuery`` splits one query into several queries reading disjoint partitions, each run by a worker process.
+
+"""
+import os
+import re
+import sys
+import time
+from collections import deque
+
+from ksql.errors import KSQLError
+from ksql.utils import parse_columns, process_row
+
+
+def _decode_batch(name, size, columns, codec, transform):
+    """ Runs in a worker: decode the lines stored in the shared memory block ``name``. """
+    from multiprocessing import shared_memory
+
+    from ksql.codec import get_codec
+
+    loads = get_codec(codec).loads
+    block = shared_memory.SharedMemory(name=name)
+    if sys.version_info < (3, 13):
+        # attaching registers the block with the resource tracker as if this process owned it, the parent unlinks it
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(block._name, "shared_memory")
+    try:
+        data = bytes(block.buf[:size]).decode("utf-8")
+    finally:
+        block.close()
+    results = []
+    for line in data.split("\n")[:-1]:
+        row = process_row(line + "\n", columns, loads)
+        if row is None:
+            # finalMessage, the query is over
+            results.append(None)
+            break
+        results.append(transform(row) if transform is not None else row)
+    return results
+
+
+class ParallelDecoder(object):
+    """
+    Decode the lines of a ``/query`` response on a process pool and yield the rows in order.
+
+    Parameter List
+    -------------
+    :param lines: Raw lines as yielded by ``BaseAPI.query``, starting with the header.
+    :param processes: Number of worker processes, the number of CPUs by default.
+    :param batch_size: Number of rows decoded per task.
+    :param max_delay: Submit a partial batch once its first row has waited this long, in seconds. It is checked when
+                      rows arrive, so rows of a stream that goes quiet wait for the next one.
+    :param transform: Function applied to every row dict in the workers. It must be picklable, e.g. defined at the
+                      top level of a module.
+    :param codec: Name of the codec decoding the rows in the workers.
+    :param executor: A ``concurrent.futures.ProcessPoolExecutor`` to use instead of starting one.
+
+    The batches are passed in ``multiprocessing.shared_memory`` blocks, which need Python 3.8.
+
+    """
+
+    def __init__(
+        self,
+        lines,
+        processes=None,
+        batch_size=1000,
+        max_delay=0.05,
+        transform=None,
+        codec="json",
+        executor=None,
+    ):
+        if sys.version_info < (3, 8):
+            raise ImportError("ParallelDecoder needs multiprocessing.shared_memory, available from Python 3.8")
+        self.lines = lines
+        self.processes = processes or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.transform = transform
+        self.codec = codec
+        self.executor = executor
+        self.batches = 0
+
+    def __iter__(self):
+        return self._run()
+
+    def _run(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        lines = iter(self.lines)
+        try:
+            header = next(lines)
+        except StopIteration:
+            return
+        columns = parse_columns(header)
+        executor = self.executor or ProcessPoolExecutor(max_workers=self.processes)
+        # enough batches in flight to keep every worker busy while the parent reads the next ones
+        max_pending = self.processes * 2
+        pending = deque()
+        try:
+            batch = []
+            started = None
+            for line in lines:
+                if started is None:
+                    started = time.time()
+                batch.append(line)
+                if len(batch) < self.batch_size and time.time() - started < self.max_delay:
+                    continue
+                pending.append(self._submit(executor, batch, columns))
+                batch, started = [], None
+                while len(pending) >= max_pending or (pending and pending[0][0].done()):
+                    if not (yield from self._collect(pending.popleft())):
+                        return
+            if batch:
+                pending.append(self._submit(executor, batch, columns))
+            while pending:
+                if not (yield from self._collect(pending.popleft())):
+                    return
+        finally:
+            # shutdown(cancel_futures=True) needs Python 3.9, the batches not collected are cancelled here. A batch
+            # already being decoded can't be cancelled, its block is released once the worker is done with it.
+            for future, block in pending:
+                future.cancel()
+                future.add_done_callback(lambda future, block=block: self._release(block))
+            if self.executor is None:
+                executor.shutdown(wait=False)
+            if hasattr(lines, "close"):
+                lines.close()
+
+    def _submit(self, executor, batch, columns):
+        from multiprocessing import shared_memory
+
+        data = "".join(line if line.endswith("\n") else line + "\n" for line in batch).encode("utf-8")
+        block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        block.buf[: len(data)] = data
+        self.batches += 1
+        future = executor.submit(_decode_batch, block.name, len(data), columns, self.codec, self.transform)
+        return future, block
+
+    def _collect(self, entry):
+        """ Yield the rows of a finished batch, returns False when the query is over. """
+        future, block = entry
+        try:
+            rows = future.result()
+        finally:
+            self._release(block)
+        for row in rows:
+            if row is None:
+                return False
+            yield row
+        return True
+
+    @staticmethod
+    def _release(block):
+        block.close()
+        block.unlink()
+
+
+# Clauses that may follow WHERE in a push query
+_TRAILING_CLAUSES = re.compile(r"\b(GROUP\s+BY|HAVING|PARTITION\s+BY|EMIT|LIMIT)\b", re.IGNORECASE)
+_WHERE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+
+
+def shard_query(query_string, shards, shard, partition_expression="ROWPARTITION"):
+    """
+    Restrict a push query to the rows of one shard: those whose ``partition_expression % shards`` is ``shard``.
+
+    The filter is added to the WHERE clause, or a WHERE clause is added before GROUP BY, HAVING, PARTITION BY, EMIT
+    and LIMIT. Keywords are located without parsing the query, so they must not appear in string literals.
+
+    """
+    query_string = query_string.strip().rstrip(";")
+    if not re.match(r"^\w+$", partition_expression):
+        partition_expression = "({})".format(partition_expression)
+    condition = "{} % {} = {}".format(partition_expression, shards, shard)
+    where = _WHERE.search(query_string)
+    start = where.end() if where else 0
+    trailing = _TRAILING_CLAUSES.search(query_string, start)
+    end = trailing.start() if trailing else len(query_string)
+    if where:
+        existing = query_string[where.end() : end].strip()
+        filtered = "WHERE ({}) AND {} ".format(existing, condition)
+        return query_string[: where.start()] + filtered + query_string[end:] + ";"
+    return "{} WHERE {} {};".format(query_string[:end].rstrip(), condition, query_string[end:]).replace(" ;", ";")
+
+
+def _read_shard(url, options, query_string, shard, queue, stop, transform, batch_size, max_delay):
+    """ Runs in a worker process: stream one shard and send its rows to the parent in batches. """
+    from ksql.client import KSQLAPI
+
+    try:
+        client = KSQLAPI(url, **options)
+        batch = []
+        flushed = time.time()
+        for row in client.query(query_string, return_objects=True):
+            batch.append(transform(row) if transform is not None else row)
+            if len(batch) >= batch_size or time.time() - flushed >= max_delay:
+                queue.put(("rows", shard, batch, time.time()))
+                batch, flushed = [], time.time()
+                if stop.is_set():
+                    return
+        if batch:
+            queue.put(("rows", shard, batch, time.time()))
+        queue.put(("done", shard, None, time.time()))
+    except Exception as e:
+        queue.put(("error", shard, "{}: {}".format(type(e).__name__, e), time.time()))
+
+
+class ShardStats(object):
+    """ Progress of one shard of a ``ShardedQuery``. """
+
+    def __init__(self, shard, query_string):
+        self.shard = shard
+        self.query_string = query_string
+        self.state = "running"
+        self.rows = 0
+        self.started = time.time()
+        self.last_row_at = None
+        self.queue_delay = 0.0
+        self.lag = None
+
+    def record(self, rows, sent_at):
+        now = time.time()
+        self.rows += len(rows)
+        self.last_row_at = now
+        self.queue_delay = now - sent_at
+        rowtime = rows[-1].get("ROWTIME") if isinstance(rows[-1], dict) else None
+        if rowtime is not None:
+            self.lag = now - rowtime / 1000.0
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        return {
+            "state": self.state,
+            "rows": self.rows,
+            "rows_per_second": self.rows / elapsed if elapsed > 0 else 0.0,
+            "seconds_since_last_row": time.time() - self.last_row_at if self.last_row_at else None,
+            "queue_delay_seconds": self.queue_delay,
+            "lag_seconds": self.lag,
+        }
+
+
+class ShardedQuery(object):
+    """
+    Consume one push query with several worker processes, like the members of a consumer group.
+
+    The query is split into ``shards`` queries filtered on ``partition_expression % shards``, ``ROWPARTITION`` by
+    default so each shard reads a disjoint set of partitions. Each shard runs in its own process with its own client,
+    and the rows of every shard are yielded by a single iterator, in the order they reach the parent.
+
+    ``stats()`` reports the rows, throughput and delays of each shard. ``lag_seconds`` is the age of the last row
+    received, computed from its ``ROWTIME`` when the query selects it.
+
+    Parameter List
+    -------------
+    :param url: Url of the ksqlDB server.
+    :param query_string: The push query to split.
+    :param shards: Number of shards and worker processes.
+    :param partition_expression: Expression distributing the rows, e.g. a numeric key column.
+    :param options: Options of the clients created in the workers, as passed to ``KSQLAPI``. They must be picklable.
+    :param transform: Function applied to every row dict in the workers, it must be picklable.
+    :param batch_size: Maximum number of rows sent at once by a worker.
+    :param max_delay: Maximum time a worker holds rows before sending them, in seconds. It is checked when rows
+                      arrive.
+    :param queue_size: Maximum number of batches waiting for the consumer, workers wait when it is reached.
+
+    """
+
+    def __init__(
+        self,
+        url,
+        query_string,
+        shards=2,
+        partition_expression="ROWPARTITION",
+        options=None,
+        transform=None,
+        batch_size=100,
+        max_delay=0.05,
+        queue_size=100,
+    ):
+        self.url = url
+        self.queries = [shard_query(query_string, shards, shard, partition_expression) for shard in range(shards)]
+        self.options = dict(options or {})
+        self.transform = transform
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self._stats = [ShardStats(shard, query) for shard, query in enumerate(self.queries)]
+        self._processes = []
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = self._run()
+        return next(self._iterator)
+
+    def close(self):
+        if self._iterator is not None:
+            self._iterator.close()
+
+    def stats(self):
+        return {stats.shard: stats.as_dict() for stats in self._stats}
+
+    def _run(self):
+        import multiprocessing
+        import queue as queues
+
+        queue = multiprocessing.Queue(self.queue_size)
+        stop = multiprocessing.Event()
+        for shard, query_string in enumerate(self.queries):
+            process = multiprocessing.Process(
+                target=_read_shard,
+                args=(
+                    self.url,
+                    self.options,
+                    query_string,
+                    shard,
+                    queue,
+                    stop,
+                    self.transform,
+                    self.batch_size,
+                    self.max_delay,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+        running = len(self._processes)
+        try:
+            while running:
+                try:
+                    kind, shard, payload, sent_at = queue.get(timeout=0.5)
+                except queues.Empty:
+                    dead = [shard for shard, process in enumerate(self._processes) if not process.is_alive()]
+                    for shard in dead:
+                        if self._stats[shard].state == "running":
+                            raise KSQLError("Shard {} exited unexpectedly".format(shard))
+                    continue
+                stats = self._stats[shard]
+                if kind == "rows":
+                    stats.record(payload, sent_at)
+                    yield from payload
+                elif kind == "done":
+                    stats.state = "done"
+                    running -= 1
+                else:
+                    stats.state = "error"
+                    raise KSQLError("Shard {} failed: {}".format(shard, payload))
+        finally:
+            stop.set()
+            for process in self._processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            queue.close()
+            queue.cancel_join_thread()
@@ -0,0 +1,110 @@
+import logging
+import time
+import tracemalloc
+
+
+class QueryProfiler(object):
+    """
+    Collects a timing breakdown for a single streaming query.
+
+    Time is split between the phases of the pipeline: waiting on the socket ("network"), framing and decoding rows
+    ("decode") and the time the consumer holds on to each yielded row ("consumer"). Every phase is measured
+    exclusively, so nested stages never count the same interval twice.
+
+    Parameter List
+    -------------
+    :param trace_malloc: Also count memory allocations with tracemalloc while the query runs.
+    :param clock: Function returning the current time in seconds, ``time.perf_counter`` by default.
+
+    """
+
+    PHASES = ("network", "decode", "consumer")
+
+    def __init__(self, trace_malloc=False, clock=time.perf_counter):
+        self.trace_malloc = trace_malloc
+        self.clock = clock
+        self.timings = dict.fromkeys(self.PHASES, 0.0)
+        self.rows = 0
+        self.bytes = 0
+        self.report = None
+        self._stack = []
+        self._started = None
+        self._consumer_start = None
+        self._owns_tracemalloc = False
+        self._malloc_start = None
+
+    def start(self):
+        if self._started is not None:
+            return
+        self._started = self.clock()
+        if self.trace_malloc:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._owns_tracemalloc = True
+            self._malloc_start = tracemalloc.take_snapshot()
+
+    def _enter(self, phase):
+        now = self.clock()
+        if self._stack:
+            parent, since = self._stack[-1]
+            self.timings[parent] += now - since
+        self._stack.append([phase, now])
+
+    def _exit(self):
+        now = self.clock()
+        phase, since = self._stack.pop()
+        self.timings[phase] += now - since
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def wrap(self, iterator, phase, outer=False):
+        """
+        Time every ``next()`` call of ``iterator`` as ``phase``.
+
+        The outer wrapper also attributes the time between two ``next()`` calls to the consumer.
+
+        """
+        self.start()
+        iterator = iter(iterator)
+        while True:
+            if outer and self._consumer_start is not None:
+                self.timings["consumer"] += self.clock() - self._consumer_start
+                self._consumer_start = None
+            self._enter(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            if phase == "network":
+                self.bytes += len(item)
+            if outer:
+                self.rows += 1
+                self._consumer_start = self.clock()
+            yield item
+
+    def finish(self):
+        """ Stop profiling and build the summary report. """
+        if self.report is not None:
+            return self.report
+        if self._consumer_start is not None:
+            self.timings["consumer"] += self.clock() - self._consumer_start
+            self._consumer_start = None
+        wall = self.clock() - self._started if self._started is not None else 0.0
+
+        report = {"rows": self.rows, "bytes": self.bytes, "wall_seconds": wall}
+        for phase in self.PHASES:
+            report["{}_seconds".format(phase)] = self.timings[phase]
+
+        if self._malloc_start is not None:
+            stats = tracemalloc.take_snapshot().compare_to(self._malloc_start, "filename")
+            report["allocated_blocks"] = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+            report["allocated_bytes"] = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+            report["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+            if self._owns_tracemalloc:
+                tracemalloc.stop()
+
+        self.report = report
+        logging.debug("Query profile: {}".format(report))
+        return report
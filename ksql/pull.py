@@ -0,0 +1,156 @@
+"""
+Pull queries split into concurrent requests.
+
+"""
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def to_millis(value):
+    """ Epoch milliseconds from an int, or from a datetime (naive datetimes are taken as UTC). """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp() * 1000)
+    return int(value)
+
+
+def split_range(start, end, shards):
+    """ Split ``[start, end)`` into at most ``shards`` contiguous, non empty ranges. """
+    shards = max(1, min(shards, end - start))
+    step, extra = divmod(end - start, shards)
+    ranges = []
+    lower = start
+    for shard in range(shards):
+        upper = lower + step + (1 if shard < extra else 0)
+        ranges.append((lower, upper))
+        lower = upper
+    return ranges
+
+
+def window_query(table, start, end, columns="*", where=None):
+    """ Pull query selecting the windows of ``table`` starting in ``[start, end)``. """
+    if not isinstance(columns, str):
+        columns = ", ".join(columns)
+    conditions = "WINDOWSTART >= {} AND WINDOWSTART < {}".format(start, end)
+    if where:
+        conditions = "({}) AND {}".format(where, conditions)
+    return "SELECT {} FROM {} WHERE {};".format(columns, table, conditions)
+
+
+def parallel_pull(client, table, start, end, shards=4, columns="*", where=None, max_workers=None):
+    """
+    Run a pull query over a windowed table as ``shards`` concurrent queries, each covering a slice of the
+    ``WINDOWSTART`` range, and yield the rows as objects in window order.
+
+    Each slice is sorted when it completes, and slices are yielded in order as soon as the ones before them are done, so
+    the first rows arrive before the whole range has been read.
+
+    Parameter List
+    -------------
+    :param client: A ``KSQLAPI``.
+    :param table: Name of the windowed table.
+    :param start: Beginning of the range, inclusive, in epoch milliseconds or as a datetime.
+    :param end: End of the range, exclusive, in epoch milliseconds or as a datetime.
+    :param shards: Number of queries the range is split into.
+    :param columns: Columns to select, ``WINDOWSTART`` must be among them for the rows to be ordered.
+    :param where: Extra condition, e.g. on the key, and-ed with the range of every query.
+    :param max_workers: Number of queries run at once, ``shards`` by default.
+
+    """
+    start, end = to_millis(start), to_millis(end)
+    if end <= start:
+        return
+    queries = [window_query(table, lower, upper, columns, where) for lower, upper in split_range(start, end, shards)]
+
+    def fetch(query_string):
+        rows = list(client.query(query_string, return_objects=True))
+        rows.sort(key=lambda row: row.get("WINDOWSTART") or 0)
+        return rows
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(queries))
+    futures = []
+    try:
+        futures.extend(executor.submit(fetch, query_string) for query_string in queries)
+        for future in futures:
+            yield from future.result()
+    finally:
+        # slices not started yet are abandoned when the consumer stops early, shutdown(cancel_futures=True) needs 3.9
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def format_literal(value):
+    """ SQL literal of a key: strings are quoted, numbers and booleans are written as they are. """
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def batch_keys(keys, batch_size=100, max_bytes=16384):
+    """ Group keys in batches of at most ``batch_size`` keys and ``max_bytes`` of SQL literals. """
+    batch, size = [], 0
+    for key in keys:
+        literal = format_literal(key)
+        if batch and (len(batch) >= batch_size or size + len(literal) + 2 > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append((key, literal))
+        size += len(literal) + 2
+    if batch:
+        yield batch
+
+
+class LookupResult(dict):
+    """ Rows found by ``get_many`` keyed by their key, ``batches`` has the size and timing of every query. """
+
+    def __init__(self):
+        super(LookupResult, self).__init__()
+        self.batches = []
+
+
+def get_many(client, table, keys, key_column="ID", columns="*", batch_size=100, max_bytes=16384, max_workers=4):
+    """
+    Look up many keys of a table with a few concurrent ``IN (...)`` pull queries.
+
+    Returns a ``LookupResult``, a dict mapping the keys found to their row. Its ``batches`` attribute lists, for every
+    query, the number of keys and rows and the time it took, to tune ``batch_size``.
+
+    Parameter List
+    -------------
+    :param client: A ``KSQLAPI``.
+    :param table: Name of the table.
+    :param keys: Keys to look up, duplicates are queried once.
+    :param key_column: Name of the key column, it must be among the selected ``columns``.
+    :param columns: Columns to select.
+    :param batch_size: Maximum number of keys per query.
+    :param max_bytes: Maximum size of the ``IN`` list of a query, in bytes.
+    :param max_workers: Number of queries run at once.
+
+    """
+    if not isinstance(columns, str):
+        columns = ", ".join(columns)
+    keys = list(dict.fromkeys(keys))
+    result = LookupResult()
+    if not keys:
+        return result
+
+    def fetch(batch):
+        started = time.time()
+        query_string = "SELECT {} FROM {} WHERE {} IN ({});".format(
+            columns, table, key_column, ", ".join(literal for key, literal in batch)
+        )
+        rows = list(client.query(query_string, return_objects=True))
+        return batch, rows, time.time() - started
+
+    name = key_column.strip("`")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch, rows, seconds in executor.map(fetch, batch_keys(keys, batch_size, max_bytes)):
+            for row in rows:
+                result[row[name] if name in row else row.get(name.upper())] = row
+            result.batches.append({"keys": len(batch), "rows": len(rows), "seconds": seconds})
+    return result
@@ -0,0 +1,293 @@
+"""
+Lifecycle of push queries.
+
+Every push query started by a client is tracked by its ``QueryRegistry`` until it ends. A query abandoned by its
+consumer, whether the generator is closed explicitly, garbage collected or still open when the process exits, is
+stopped on the server instead of running until the connection times out.
+
+"""
+import atexit
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+import weakref
+
+from ksql.errors import QueryBudgetExceededError
+
+# Endpoints whose queries are stopped with /close-query, the others end when their connection is closed
+CLOSE_QUERY_ENDPOINTS = ("query-stream",)
+
+_registries = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+def _response_socket(response):
+    """ The socket under a ``http.client`` or ``requests`` streaming response, None when it cannot be reached. """
+    raw = getattr(response, "raw", None)
+    if raw is not None:
+        # requests wraps the http.client response in a urllib3 one
+        response = getattr(raw, "_fp", None)
+    fp = getattr(response, "fp", None)
+    return getattr(getattr(fp, "raw", None), "_sock", None)
+
+
+def close_response(response):
+    """
+    Close a streaming response, waking up a reader blocked on it.
+
+    Closing the response alone does not interrupt a read in progress in another thread, which would only return once
+    the server sends something. Shutting the socket down makes it return right away.
+
+    """
+    sock = _response_socket(response)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def parse_query_id(line):
+    """
+    Read the query id from the first line of a ``/query`` or ``/query-stream`` response, None when it has none.
+
+    ``/query`` starts with ``[{"header":{"queryId":...}},`` and ``/query-stream`` with ``{"queryId":...}``.
+
+    """
+    line = line.strip()
+    if line.startswith("["):
+        line = line[1:]
+    if line.endswith(","):
+        line = line[:-1]
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(header, dict):
+        return None
+    return header.get("header", header).get("queryId")
+
+
+class PushQuery(object):
+    """ A running push query. ``query_id`` is set once the response header has been read. """
+
+    def __init__(self, registry, endpoint, query_string):
+        self.registry = registry
+        self.endpoint = endpoint
+        self.query_string = query_string
+        self.query_id = None
+        self.response = None
+        self.closed = False
+
+    def close(self):
+        return self.registry.close(self)
+
+
+class QueryResults(object):
+    """
+    Results of a push query, as returned by ``KSQLAPI.query``.
+
+    Iterates like the generator it wraps, but ``close`` can also be called from another thread than the one consuming
+    the results, even while it is blocked waiting for the next row: the query is stopped and its connection closed
+    right away.
+
+    """
+
+    def __init__(self, results=None):
+        self.results = results
+        self.push_query = None
+        self.reader = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.results)
+
+    def started(self, push_query):
+        """ Called by the query generator once the query is running. """
+        with self._lock:
+            self.push_query = push_query
+            closed = self._closed
+        if closed:
+            push_query.close()
+
+    def stats(self):
+        """ Stats of the ``ksql.streaming.BackgroundReader`` of a query with a ``buffer_size``, once started. """
+        return self.reader.stats() if self.reader is not None else None
+
+    def stop(self):
+        """ Stop the query and close its connection, waking up a thread blocked reading it. """
+        with self._lock:
+            self._closed = True
+            push_query = self.push_query
+        if push_query is not None:
+            push_query.close()
+
+    def close(self):
+        self.stop()
+        try:
+            self.results.close()
+        except ValueError:
+            # the generator is running in another thread, it ends now that its connection is closed
+            pass
+
+
+class QueryRegistry(object):
+    """
+    Active push queries of a client.
+
+    Parameter List
+    -------------
+    :param api: The ``BaseAPI`` used to send ``close_query`` requests.
+
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self._queries = set()
+        self._lock = threading.Lock()
+        _registries.add(self)
+
+    def register(self, endpoint, query_string):
+        query = PushQuery(self, endpoint, query_string)
+        with self._lock:
+            self._queries.add(query)
+        return query
+
+    def discard(self, query):
+        """ Forget a query that ended on its own. """
+        query.closed = True
+        with self._lock:
+            self._queries.discard(query)
+
+    def active(self):
+        with self._lock:
+            return list(self._queries)
+
+    def close(self, query):
+        """
+        Stop a query on the server and release its connection. A generator blocked reading the query ends right away.
+
+        Returns the result of ``close_query`` for queries closed through ``/close-query``, True otherwise. Errors are
+        logged rather than raised, since this runs while generators are finalized and at exit.
+
+        """
+        with self._lock:
+            if query.closed:
+                return True
+            query.closed = True
+            self._queries.discard(query)
+        closed = True
+        if query.endpoint in CLOSE_QUERY_ENDPOINTS and query.query_id is not None:
+            try:
+                closed = self.api.close_query(query.query_id)
+            except Exception as e:
+                logging.debug("Failed closing Query ID: {}: {}".format(query.query_id, e))
+                closed = False
+        if query.response is not None:
+            try:
+                close_response(query.response)
+            except Exception as e:
+                logging.debug("Failed closing the connection of Query ID: {}: {}".format(query.query_id, e))
+        return closed
+
+    def close_all(self, max_workers=8):
+        """
+        Close every active query, concurrently.
+
+        Returns a dict mapping each closed query to the result of ``close``.
+
+        """
+        queries = self.active()
+        if len(queries) <= 1:
+            return {query: self.close(query) for query in queries}
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+            return dict(zip(queries, executor.map(self.close, queries)))
+
+
+def approximate_size(item):
+    """ Rough size of a row in bytes: the length of a raw line, or the shallow sizes of a row object and its values. """
+    if isinstance(item, (str, bytes)):
+        return len(item)
+    raw = getattr(item, "_raw", None)
+    if raw is not None:
+        # a lazy row not decoded yet
+        return len(raw)
+    values = item.values() if isinstance(item, dict) else item
+    return sys.getsizeof(item) + sum(sys.getsizeof(value) for value in values)
+
+
+class QueryBudget(object):
+    """
+    Limits of one push query. Exceeding one raises ``QueryBudgetExceededError`` from the query generator, which stops
+    the query like closing it would: its connection is closed and it is closed on the server.
+
+    Limits are checked as lines arrive, heartbeats included, so ``max_seconds`` is enforced late on a stream that
+    goes completely silent, see ``idle_timeout`` for that.
+
+    Parameter List
+    -------------
+    :param max_rows: Maximum number of rows.
+    :param max_bytes: Maximum size of the response, after decompression.
+    :param max_seconds: Maximum time since the query was sent.
+    :param max_buffered_bytes: Maximum size of the rows read ahead and waiting for the consumer, see the
+                               ``buffer_size`` of ``KSQLAPI.query``. Sizes are estimated with ``approximate_size``.
+
+    """
+
+    def __init__(self, max_rows=None, max_bytes=None, max_seconds=None, max_buffered_bytes=None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_buffered_bytes = max_buffered_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.buffered_bytes = 0
+        self.started = None
+        self.query = None
+
+    def start(self, query=None):
+        self.started = time.monotonic()
+        self.query = query
+
+    def add(self, size, row):
+        """ Account for a line of the response, ``row`` telling whether it is a row or another message. """
+        self.bytes += size
+        self.rows += row
+        if self.max_rows is not None and self.rows > self.max_rows:
+            self._exceeded("rows", self.rows, self.max_rows)
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            self._exceeded("bytes", self.bytes, self.max_bytes)
+        self.check_time()
+
+    def check_time(self):
+        if self.max_seconds is not None and self.started is not None:
+            elapsed = time.monotonic() - self.started
+            if elapsed > self.max_seconds:
+                self._exceeded("seconds", round(elapsed, 3), self.max_seconds)
+
+    def buffer(self, size):
+        self.buffered_bytes += size
+        if self.max_buffered_bytes is not None and self.buffered_bytes > self.max_buffered_bytes:
+            self._exceeded("buffered bytes", self.buffered_bytes, self.max_buffered_bytes)
+
+    def release(self, size):
+        self.buffered_bytes -= size
+
+    def _exceeded(self, limit, value, maximum):
+        query_id = self.query.query_id if self.query is not None else None
+        raise QueryBudgetExceededError(limit, value, maximum, query_id)
+
+
+@atexit.register
+def _close_all_registries():
+    for registry in list(_registries):
+        registry.close_all()
@@ -0,0 +1,229 @@
+"""
+Push queries that survive connection failures.
+
+``ResilientQuery`` reconnects with exponential backoff when the stream breaks and resumes where it stopped. Servers
+with push query continuation tokens enabled resume exactly from the last token received. Otherwise the query is
+restarted with the configured ``auto.offset.reset`` and, until the first row not delivered yet arrives, the rows
+replayed are dropped by comparing them with the most recent rows already delivered. The position can be checkpointed
+to a file, so a restarted process resumes too.
+
+"""
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import time
+from collections import Counter, deque
+
+from ksql.errors import KSQLError
+from ksql.queries import parse_query_id
+
+# Streaming property carrying the continuation token to resume a push query from
+CONTINUATION_TOKEN_PROPERTY = "request.ksql.query.push.continuation.token"
+# Failures of the connection, as opposed to errors in the query itself
+RETRYABLE_ERRORS = (http.client.HTTPException, OSError)
+
+
+def normalize_line(line):
+    """ A streamed row without the separator or the closing bracket of ``/query`` responses. """
+    line = line.strip().rstrip(",")
+    if line.startswith("{") and line.endswith("}]"):
+        line = line[:-1]
+    return line
+
+
+def _digest(key):
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class ResilientQuery(object):
+    """
+    Iterate over the lines of a push query, reconnecting when the connection fails.
+
+    Lines are yielded like ``BaseAPI.query``/``query2`` do, the response header only once.
+
+    Parameter List
+    -------------
+    :param api: The ``BaseAPI`` running the query.
+    :param query_string: The push query.
+    :param stream_properties: Streaming properties sent with every attempt.
+    :param use_http2: Use ``query2`` (``/query-stream``) rather than ``query``.
+    :param offset_reset: ``auto.offset.reset`` used when reconnecting without a continuation token: ``earliest``
+                         replays the topic and relies on deduplication, ``latest`` skips the rows produced while
+                         disconnected. None keeps ``stream_properties`` as they are.
+    :param dedup_window: Number of recent rows remembered to drop the ones replayed after a reconnect. Rows are only
+                         compared while the stream replays them, identical rows are otherwise all delivered.
+    :param key: Function computing the identity of a row from its line, the whole line by default.
+    :param max_retries: Consecutive failed attempts before giving up, None to retry forever.
+    :param initial_delay: Delay before the first reconnect, in seconds. It doubles on each consecutive failure.
+    :param max_delay: Upper bound of the delay between reconnects, in seconds.
+    :param checkpoint: Path of a file to save the position to, and to resume from when it exists.
+    :param checkpoint_every: Save the checkpoint every this many rows, and when the iteration ends.
+
+    """
+
+    def __init__(
+        self,
+        api,
+        query_string,
+        stream_properties=None,
+        use_http2=False,
+        offset_reset=None,
+        dedup_window=10000,
+        key=None,
+        max_retries=None,
+        initial_delay=0.1,
+        max_delay=30.0,
+        checkpoint=None,
+        checkpoint_every=1000,
+        **query_kwargs
+    ):
+        self.api = api
+        self.query_string = query_string
+        self.stream_properties = dict(stream_properties or {})
+        self.use_http2 = use_http2
+        self.offset_reset = offset_reset
+        self.key = key
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.query_kwargs = query_kwargs
+        self.continuation_token = None
+        self.rows = 0
+        self.duplicates = 0
+        self.reconnects = 0
+        self._recent = deque(maxlen=dedup_window)
+        # identical rows can be in the window more than once
+        self._seen = Counter()
+        self._replaying = False
+        if checkpoint is not None:
+            self._load_checkpoint()
+
+    def __iter__(self):
+        return self._run()
+
+    def _run(self):
+        attempt = 0
+        header_sent = False
+        try:
+            while True:
+                lines = self._connect(resuming=attempt > 0 or len(self._recent) > 0)
+                try:
+                    first = True
+                    for line in lines:
+                        if first:
+                            first = False
+                            if parse_query_id(line) is not None:
+                                if not header_sent:
+                                    header_sent = True
+                                    yield line
+                                continue
+                        if "continuationToken" in line and self._read_token(line):
+                            continue
+                        if self._is_duplicate(line):
+                            self.duplicates += 1
+                            continue
+                        attempt = 0
+                        self.rows += 1
+                        yield line
+                        if self.checkpoint is not None and self.rows % self.checkpoint_every == 0:
+                            self.save_checkpoint()
+                    return
+                except RETRYABLE_ERRORS + (KSQLError,) as e:
+                    if not self._retryable(e):
+                        raise
+                    attempt += 1
+                    if self.max_retries is not None and attempt > self.max_retries:
+                        raise
+                    self.reconnects += 1
+                    delay = self._backoff(attempt)
+                    logging.debug("Push query failed ({}), reconnecting in {:.2f}s".format(e, delay))
+                    time.sleep(delay)
+                finally:
+                    lines.close()
+        finally:
+            if self.checkpoint is not None:
+                self.save_checkpoint()
+
+    def _connect(self, resuming):
+        properties = dict(self.stream_properties)
+        # a continuation token resumes exactly, without replaying rows
+        self._replaying = resuming and self.continuation_token is None and self.offset_reset != "latest"
+        if self.continuation_token is not None:
+            properties[CONTINUATION_TOKEN_PROPERTY] = self.continuation_token
+        elif resuming and self.offset_reset is not None:
+            properties["auto.offset.reset"] = self.offset_reset
+        query = self.api.query2 if self.use_http2 else self.api.query
+        return query(self.query_string, stream_properties=properties, **self.query_kwargs)
+
+    @staticmethod
+    def _retryable(error):
+        if isinstance(error, KSQLError):
+            # server side failures, a rejected query would fail again
+            return bool(error.error_code) and error.error_code >= 50000
+        return True
+
+    def _backoff(self, attempt):
+        delay = min(self.max_delay, self.initial_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _read_token(self, line):
+        try:
+            message = json.loads(normalize_line(line))
+        except ValueError:
+            return False
+        if not isinstance(message, dict) or "continuationToken" not in message:
+            return False
+        token = message["continuationToken"]
+        if isinstance(token, dict):
+            token = token.get("continuationToken")
+        self.continuation_token = token
+        return True
+
+    def _is_duplicate(self, line):
+        line = normalize_line(line)
+        digest = _digest(str(self.key(line)) if self.key is not None else line)
+        if self._replaying:
+            if digest in self._seen:
+                return True
+            # the first row not delivered yet ends the replay
+            self._replaying = False
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            self._seen[oldest] -= 1
+            if not self._seen[oldest]:
+                del self._seen[oldest]
+        self._recent.append(digest)
+        self._seen[digest] += 1
+        return False
+
+    def save_checkpoint(self):
+        """ Write the position atomically to the checkpoint file. """
+        state = {
+            "query": self.query_string,
+            "continuation_token": self.continuation_token,
+            "recent": list(self._recent),
+        }
+        tmp = "{}.tmp".format(self.checkpoint)
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint)
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if state.get("query") != self.query_string:
+            raise ValueError("Checkpoint {} belongs to another query: {}".format(self.checkpoint, state.get("query")))
+        self.continuation_token = state.get("continuation_token")
+        for digest in state.get("recent", [])[-self._recent.maxlen :]:
+            self._recent.append(digest)
+        self._seen = Counter(self._recent)
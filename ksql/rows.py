@@ -0,0 +1,215 @@
+"""
+Compact row objects generated from the schema of a query.
+
+``process_row`` builds a dict per row, repeating the column names in every one of them. The classes built here hold
+the column names, types and positions once, on the class, and the rows only hold their values:
+
+- ``Row`` subclasses are tuples, with the columns readable by name, ``row["ID"]``, or as attributes, ``row.ID``.
+- ``LazyRow`` subclasses keep the raw JSON line and decode it the first time a column is read, so rows that are
+  buffered, counted or filtered out before being read are never decoded.
+
+Use them with ``query(..., return_objects="typed")`` or ``return_objects="lazy"``.
+
+"""
+import json
+import operator
+import threading
+from collections import OrderedDict
+
+# Most recently used row classes. Bounded, since a process may see any number of schemas over time
+_classes = OrderedDict()  # type: OrderedDict
+_classes_lock = threading.Lock()
+MAX_CLASSES = 1024
+
+
+def _normalize(line):
+    return line.replace(",\n", "").replace("]\n", "").rstrip("]")
+
+
+def _rebuild(fields, types, values):
+    return row_class(list(zip(fields, types)))._make(values)
+
+
+class Row(tuple):
+    """ A row as a tuple of its values, in the order of ``_fields``. Columns can be read by name. """
+
+    __slots__ = ()
+    _fields = ()
+    _types = ()
+    _index = {}  # type: dict
+
+    @classmethod
+    def _make(cls, values):
+        return tuple.__new__(cls, values)
+
+    def __getitem__(self, item):
+        if item.__class__ is str:
+            item = self._index[item]
+        return tuple.__getitem__(self, item)
+
+    def get(self, name, default=None):
+        index = self._index.get(name)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def as_dict(self):
+        return dict(zip(self._fields, self))
+
+    def __repr__(self):
+        return "Row({})".format(", ".join("{}={!r}".format(name, value) for name, value in self.items()))
+
+    def __reduce__(self):
+        return _rebuild, (self._fields, self._types, tuple(self))
+
+
+class LazyRow(object):
+    """ A row keeping its raw ``/query`` or ``/query-stream`` line until one of its columns is read. """
+
+    __slots__ = ("_raw", "_values")
+    _fields = ()
+    _types = ()
+    _index = {}  # type: dict
+    _loads = staticmethod(json.loads)
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._values = None
+
+    @classmethod
+    def _make(cls, values):
+        row = cls(None)
+        row._values = tuple(values)
+        return row
+
+    @property
+    def decoded(self):
+        return self._values is not None
+
+    def _decode(self):
+        values = self._values
+        if values is None:
+            if self._raw.startswith("["):
+                values = self._values = tuple(self._loads(self._raw))
+            else:
+                values = self._values = tuple(self._loads(_normalize(self._raw))["row"]["columns"])
+            self._raw = None
+        return values
+
+    def __getitem__(self, item):
+        if item.__class__ is str:
+            item = self._index[item]
+        return self._decode()[item]
+
+    def get(self, name, default=None):
+        index = self._index.get(name)
+        return default if index is None else self._decode()[index]
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self._decode())
+
+    def as_dict(self):
+        return dict(zip(self._fields, self._decode()))
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if isinstance(other, (LazyRow, tuple)):
+            return self._decode() == tuple(other)
+        return NotImplemented
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return "LazyRow({})".format(", ".join("{}={!r}".format(name, value) for name, value in self.items()))
+
+    def __reduce__(self):
+        return _rebuild, (self._fields, self._types, self._decode())
+
+
+def row_class(columns, lazy=False, loads=json.loads):
+    """
+    The row class of a schema, built once per schema and reused by every query returning it.
+
+    Parameter List
+    -------------
+    :param columns: The columns as returned by ``parse_columns``, dicts with a ``name`` and a ``type``, or names.
+    :param lazy: Build a ``LazyRow`` class, decoding the rows with ``loads`` when they are first read.
+    :param loads: Function decoding the raw lines of lazy rows.
+
+    """
+    columns = [column if isinstance(column, (dict, tuple)) else (column, None) for column in columns]
+    columns = [(column["name"], column["type"]) if isinstance(column, dict) else tuple(column) for column in columns]
+    fields = tuple(name for name, type_ in columns)
+    types = tuple(type_ for name, type_ in columns)
+    cache_key = (fields, types, lazy, _loads_key(loads) if lazy else None)
+    base = LazyRow if lazy else Row
+    with _classes_lock:
+        cls = _classes.get(cache_key)
+        if cls is not None:
+            _classes.move_to_end(cache_key)
+            return cls
+        namespace = {
+            "__slots__": (),
+            "_fields": fields,
+            "_types": types,
+            "_index": {name: index for index, name in enumerate(fields)},
+        }
+        for index, name in enumerate(fields):
+            if name.startswith("_") or hasattr(base, name):
+                # read it by name instead, row["KEYS"]
+                continue
+            if lazy:
+                namespace[name] = property(lambda self, index=index: self._decode()[index])
+            else:
+                namespace[name] = property(operator.itemgetter(index))
+        if lazy:
+            namespace["_loads"] = staticmethod(loads)
+        cls = _classes[cache_key] = type(base.__name__, (base,), namespace)
+        if len(_classes) > MAX_CLASSES:
+            _classes.popitem(last=False)
+        return cls
+
+
+def _loads_key(loads):
+    """
+    Identify a ``loads`` function in the cache. The bound ``loads`` of a codec is a new object for every codec
+    instance, e.g. every client, the classes are shared by the instances of a codec class instead.
+
+    """
+    function = getattr(loads, "__func__", None)
+    if function is None:
+        return loads
+    return type(loads.__self__), function
+
+
+def typed_rows(lines, columns, lazy=False, loads=json.loads):
+    """
+    Turn the row lines of a ``/query`` or ``/query-stream`` response, after its header, into instances of the
+    schema's row class.
+
+    """
+    cls = row_class(columns, lazy=lazy, loads=loads)
+    for line in lines:
+        if lazy and line.startswith(('{"row"', "[")):
+            yield cls(line)
+            continue
+        if line.startswith("["):
+            yield cls._make(loads(line))
+            continue
+        message = loads(_normalize(line))
+        if "finalMessage" in message:
+            return
+        values = message["row"]["columns"]
+        yield cls._make(values)
@@ -0,0 +1,390 @@
+"""
+Writing push query output to files.
+
+The sinks take what ``KSQLAPI.query`` yields: the raw lines of ``/query`` or ``/query-stream`` responses, header
+included, or row objects (``return_objects=True``, ``"typed"`` or ``"lazy"``). Rows are buffered and written in
+batches, each file is written under a ``.part`` name and renamed when it is complete.
+
+- ``JsonLinesSink`` writes one JSON document per line. Raw lines are written as the server sent them, without being
+  decoded and encoded again, and every file starts with the header of the query.
+- ``CsvSink`` writes the column names then one record per row.
+- ``ParquetSink`` writes a row group per batch, it requires ``pyarrow``.
+
+Files are rotated once they reach ``max_bytes`` or are older than ``max_seconds``, which requires a ``path`` with an
+``{index}`` or ``{time}`` field, e.g. ``clicks-{index:05d}.jsonl``. ``fsync`` decides when written data is forced to
+disk: ``"never"``, when a file is complete (``"rotate"``) or after every batch (``"batch"``).
+
+"""
+import csv
+import io
+import json
+import os
+import time
+
+from ksql.resilient import normalize_line
+from ksql.utils import parse_columns
+
+FSYNC_POLICIES = ("never", "rotate", "batch")
+
+
+def _split_header(line):
+    """ The columns of a header line as ``(name, type)`` pairs, None if the line is not a header. """
+    if line.startswith("["):
+        line = line[1:]
+    if line.startswith('{"header"'):
+        return [(column["name"], column["type"]) for column in parse_columns(line)]
+    if line.startswith('{"queryId"') or line.startswith('{"columnNames"'):
+        header = json.loads(line)
+        return list(zip(header["columnNames"], header.get("columnTypes") or [None] * len(header["columnNames"])))
+    return None
+
+
+def _row_values(line, loads):
+    """ The values of a row line of either endpoint, None for other messages, e.g. finalMessage. """
+    message = loads(line)
+    if isinstance(message, list):
+        return message
+    row = message.get("row")
+    if row is None:
+        return None
+    return row["columns"]
+
+
+def _object_columns(row):
+    fields = getattr(row, "_fields", None)
+    if fields is None:
+        fields = list(row)
+    types = getattr(row, "_types", None) or [None] * len(fields)
+    return list(zip(fields, types))
+
+
+def _object_values(row, names):
+    if isinstance(row, dict):
+        return [row.get(name) for name in names]
+    return list(row)
+
+
+class FileSink(object):
+    """
+    Base class of the sinks: batching, rotation, fsync and throughput statistics.
+
+    Parameter List
+    -------------
+    :param path: Path of the files, formatted with ``index``, the number of the file, and ``time``, when it was opened.
+    :param max_bytes: Start a new file once this many bytes were written to the current one.
+    :param max_seconds: Start a new file once the current one is this old, checked when rows are written.
+    :param batch_size: Number of rows written at once.
+    :param max_delay: Write a partial batch once its first row has waited this long, in seconds, checked when rows
+                      arrive.
+    :param fsync: One of ``FSYNC_POLICIES``.
+    :param loads: Function decoding the raw lines, when the format requires it.
+
+    """
+
+    def __init__(
+        self,
+        path,
+        max_bytes=None,
+        max_seconds=None,
+        batch_size=1000,
+        max_delay=1.0,
+        fsync="rotate",
+        loads=json.loads,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy {}, expected one of: {}".format(fsync, ", ".join(FSYNC_POLICIES)))
+        if (max_bytes or max_seconds) and "{" not in path:
+            raise ValueError("A rotated path needs an {index} or {time} field, got: " + path)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.loads = loads
+        self.columns = None
+        self.header = None
+        self.files = []
+        self.rows = 0
+        self.bytes = 0
+        self.write_seconds = 0.0
+        self.started = None
+        self._batch = []
+        self._batch_started = None
+        self._file = None
+        self._file_path = None
+        self._file_bytes = 0
+        self._opened_at = None
+        self._index = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, item):
+        """ Add a raw line or a row object. """
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        if isinstance(item, bytes):
+            item = item.decode("utf-8")
+        if isinstance(item, str):
+            line = normalize_line(item)
+            if not line or line == "]":
+                return
+            if self.columns is None:
+                columns = _split_header(line)
+                if columns is not None:
+                    self.columns = columns
+                    self.header = line[1:] if line.startswith("[") else line
+                    return
+            row = self._from_line(line)
+        else:
+            if self.columns is None:
+                self.columns = _object_columns(item)
+            row = self._from_object(item)
+        if row is None:
+            return
+        if self._batch_started is None:
+            self._batch_started = now
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size or now - self._batch_started >= self.max_delay:
+            self.flush()
+
+    def consume(self, iterable):
+        """ Write everything ``iterable`` yields, close the sink and return its ``stats``. """
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                self.write(item)
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+            self.close()
+        return self.stats()
+
+    def flush(self):
+        """ Write the buffered rows, and rotate the file when it is due. """
+        if not self._batch:
+            return
+        started = time.time()
+        if self._file is None:
+            self._open_next()
+        written = self._write_batch(self._batch)
+        if self.fsync == "batch":
+            self._sync()
+        self.write_seconds += time.time() - started
+        self.rows += len(self._batch)
+        self.bytes += written
+        self._file_bytes += written
+        self._batch = []
+        self._batch_started = None
+        if (self.max_bytes and self._file_bytes >= self.max_bytes) or (
+            self.max_seconds and time.time() - self._opened_at >= self.max_seconds
+        ):
+            self._finish_file()
+
+    def close(self):
+        """ Write the buffered rows and complete the current file. """
+        self.flush()
+        if self._file is not None:
+            self._finish_file()
+
+    def stats(self):
+        """ Rows and bytes written, and the throughput overall and of the writes alone. """
+        elapsed = time.time() - self.started if self.started is not None else 0.0
+        return {
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "files": len(self.files) + (1 if self._file is not None else 0),
+            "seconds": elapsed,
+            "write_seconds": self.write_seconds,
+            "rows_per_second": self.rows / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_second": self.bytes / elapsed if elapsed > 0 else 0.0,
+            "write_bytes_per_second": self.bytes / self.write_seconds if self.write_seconds > 0 else 0.0,
+        }
+
+    def _open_next(self):
+        self._file_path = self.path.format(index=self._index, time=time.strftime("%Y%m%dT%H%M%S"))
+        self._index += 1
+        directory = os.path.dirname(self._file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self._file_path + ".part", "wb")
+        self._file_bytes = 0
+        self._opened_at = time.time()
+        written = self._start_file()
+        self._file_bytes += written
+        self.bytes += written
+
+    def _sync(self):
+        if self._file.closed:
+            # closed by the format's writer
+            fd = os.open(self._file_path + ".part", os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _finish_file(self):
+        started = time.time()
+        written = self._end_file()
+        self._file_bytes += written
+        self.bytes += written
+        if self.fsync != "never":
+            self._sync()
+        self._file.close()
+        os.replace(self._file_path + ".part", self._file_path)
+        self.write_seconds += time.time() - started
+        self.files.append(self._file_path)
+        self._file = None
+
+    def _names(self):
+        return [name for name, type_ in self.columns]
+
+    # Implemented by the formats
+
+    def _from_line(self, line):
+        """ What to buffer for a raw row line, None to skip it. """
+        return _row_values(line, self.loads)
+
+    def _from_object(self, row):
+        return _object_values(row, self._names())
+
+    def _start_file(self):
+        """ Write what comes before the rows in a new file, returns the number of bytes written. """
+        return 0
+
+    def _write_batch(self, batch):
+        raise NotImplementedError
+
+    def _end_file(self):
+        return 0
+
+
+class JsonLinesSink(FileSink):
+    """ Write rows as JSON lines, raw lines being written as they are. """
+
+    def _from_line(self, line):
+        if line.startswith('{"finalMessage"') or line.startswith('{"errorMessage"'):
+            return None
+        return line
+
+    def _from_object(self, row):
+        if not isinstance(row, dict):
+            row = dict(zip(self._names(), row))
+        return json.dumps(row)
+
+    def _start_file(self):
+        if self.header is None:
+            return 0
+        data = (self.header + "\n").encode("utf-8")
+        self._file.write(data)
+        return len(data)
+
+    def _write_batch(self, batch):
+        data = ("\n".join(batch) + "\n").encode("utf-8")
+        self._file.write(data)
+        return len(data)
+
+
+class CsvSink(FileSink):
+    """ Write rows as CSV records, nested values are written as JSON. """
+
+    def _start_file(self):
+        return self._write_records([self._names()])
+
+    def _write_batch(self, batch):
+        return self._write_records(
+            [[json.dumps(value) if isinstance(value, (dict, list)) else value for value in row] for row in batch]
+        )
+
+    def _write_records(self, records):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(records)
+        data = buffer.getvalue().encode("utf-8")
+        self._file.write(data)
+        return len(data)
+
+
+# Arrow types of the ksqlDB scalar types, other types are written as JSON strings
+_ARROW_TYPES = {
+    "BOOLEAN": "bool_",
+    "INT": "int32",
+    "INTEGER": "int32",
+    "BIGINT": "int64",
+    "DOUBLE": "float64",
+    "STRING": "string",
+    "VARCHAR": "string",
+}
+
+
+class ParquetSink(FileSink):
+    """ Write rows to Parquet files, one row group per batch. Requires ``pyarrow``. """
+
+    def __init__(self, path, **options):
+        try:
+            import pyarrow  # type: ignore
+            import pyarrow.parquet  # type: ignore
+        except ImportError:
+            raise ImportError("ParquetSink requires pyarrow, install it with: pip install pyarrow")
+        super(ParquetSink, self).__init__(path, **options)
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._schema = None
+        self._writer = None
+
+    def _arrow_schema(self):
+        if self._schema is None:
+            fields = []
+            for name, type_ in self.columns:
+                arrow_type = _ARROW_TYPES.get((type_ or "").upper())
+                fields.append((name, getattr(self._pa, arrow_type)() if arrow_type else self._pa.string()))
+            self._schema = self._pa.schema(fields)
+        return self._schema
+
+    def _start_file(self):
+        before = self._file.tell()
+        # the writer starts the file with the magic number right away
+        self._writer = self._pq.ParquetWriter(self._file, self._arrow_schema())
+        return self._file.tell() - before
+
+    def _write_batch(self, batch):
+        schema = self._arrow_schema()
+        arrays = []
+        for position, field in enumerate(schema):
+            values = [row[position] for row in batch]
+            if field.type == self._pa.string():
+                values = [value if value is None or isinstance(value, str) else json.dumps(value) for value in values]
+            arrays.append(self._pa.array(values, type=field.type))
+        before = self._file.tell()
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=schema))
+        return self._file.tell() - before
+
+    def _end_file(self):
+        before = self._file.tell()
+        self._writer.close()
+        self._writer = None
+        return self._file.tell() - before
+
+
+SINKS = {"jsonl": JsonLinesSink, "csv": CsvSink, "parquet": ParquetSink}
+
+
+def open_sink(path, format=None, **options):
+    """
+    Create the sink of a format, ``jsonl``, ``csv`` or ``parquet``, guessed from the extension of ``path`` when not
+    given. See ``FileSink`` for the ``options``.
+
+    """
+    if format is None:
+        extension = os.path.splitext(path)[1].lstrip(".").lower()
+        format = {"json": "jsonl", "ndjson": "jsonl", "parq": "parquet"}.get(extension, extension)
+    if format not in SINKS:
+        raise ValueError("Unknown sink format {}, expected one of: {}".format(format, ", ".join(SINKS)))
+    return SINKS[format](path, **options)
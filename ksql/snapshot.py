@@ -0,0 +1,448 @@
+"""
+Table snapshots in a memory-mapped columnar file.
+
+``export_snapshot`` scans a table with a pull query and writes its rows to a single file, column by column, without
+holding them in memory: numeric and boolean columns are fixed-width arrays, other columns are an array of offsets into
+a heap of utf-8 strings, nested values being written as JSON. A permutation of the rows sorted by key is stored with
+them.
+
+``Snapshot`` maps the file back into memory. Columns are read in place, as memoryviews that ``numpy.asarray`` turns
+into arrays without copying, and keys are looked up by binary search over the sorted index.
+
+The layout is the sections, each aligned on 8 bytes, followed by a JSON footer describing them, the footer length as
+an unsigned 64 bits integer and ``MAGIC``.
+
+"""
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+from array import array
+
+from ksql.resilient import normalize_line
+from ksql.sinks import _row_values, _split_header
+
+MAGIC = b"KSQLSNP1"
+_TRAILER = struct.Struct("<Q8s")
+
+# array typecodes of the fixed-width ksqlDB types, other types are stored as strings
+_FIXED_TYPES = {
+    "BOOLEAN": "b",
+    "INT": "i",
+    "INTEGER": "i",
+    "BIGINT": "q",
+    "DOUBLE": "d",
+}
+_KEY_COLUMNS = re.compile(r"`(\w+)` [^,`]*? KEY\b")
+
+
+def _typecode(type_):
+    return _FIXED_TYPES.get(re.split(r"\W", type_ or "", maxsplit=1)[0].upper())
+
+
+def _read_positions(f, count=8192):
+    """ Iterate over the row positions of a sorted run, reading ``count`` at a time. """
+    while True:
+        positions = array("q")
+        try:
+            positions.fromfile(f, count)
+        except EOFError:
+            # the positions left are read nonetheless
+            yield from positions
+            return
+        yield from positions
+
+
+class _ColumnWriter(object):
+    """ Spill the values of one column to temporary files as they are appended. """
+
+    def __init__(self, path, name, type_):
+        self.name = name
+        self.type = type_
+        self.typecode = _typecode(type_)
+        self.values_path = "{}.{}.values".format(path, name)
+        self.heap_path = "{}.{}.heap".format(path, name)
+        self.nulls_path = "{}.{}.nulls".format(path, name)
+        self._values = open(self.values_path, "wb")
+        self._nulls = open(self.nulls_path, "wb")
+        self._heap = open(self.heap_path, "wb") if self.typecode is None else None
+        self.has_nulls = False
+        self._heap_size = 0
+        self._buffer = array(self.typecode or "q")
+        self._null_buffer = bytearray()
+        self._heap_buffer = []
+        if self.typecode is None:
+            self._buffer.append(0)
+
+    def append(self, value):
+        null = value is None
+        self.has_nulls = self.has_nulls or null
+        self._null_buffer.append(null)
+        if self.typecode is not None:
+            self._buffer.append(0 if null else value)
+            return
+        if not null:
+            data = (value if isinstance(value, str) else json.dumps(value)).encode("utf-8")
+            self._heap_buffer.append(data)
+            self._heap_size += len(data)
+        self._buffer.append(self._heap_size)
+
+    def flush(self):
+        self._buffer.tofile(self._values)
+        del self._buffer[:]
+        self._nulls.write(self._null_buffer)
+        del self._null_buffer[:]
+        if self._heap is not None:
+            self._heap.write(b"".join(self._heap_buffer))
+            self._heap_buffer = []
+
+    def close(self):
+        self.flush()
+        for f in (self._values, self._nulls, self._heap):
+            if f is not None:
+                f.close()
+
+    def remove(self):
+        for path in (self.values_path, self.nulls_path, self.heap_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class SnapshotWriter(object):
+    """
+    Write rows to a snapshot file, a batch at a time.
+
+    Parameter List
+    -------------
+    :param path: Path of the snapshot, it is written under a ``.part`` name and renamed when complete.
+    :param columns: The columns as ``(name, type)`` pairs, ksqlDB type names.
+    :param key_column: Column to index, or None.
+    :param batch_size: Number of rows buffered per column before being written.
+    :param metadata: Extra JSON serializable information stored in the footer.
+
+    The key index is sorted with ``numpy.argsort`` for fixed-width keys when numpy is installed, and otherwise by
+    merging sorted runs of ``sort_run_rows`` rows spilled to temporary files, so memory stays bounded.
+
+    """
+
+    sort_run_rows = 1 << 18
+
+    def __init__(self, path, columns, key_column=None, batch_size=10000, metadata=None):
+        names = [name for name, type_ in columns]
+        if key_column is not None and key_column not in names:
+            raise ValueError("Key column {} is not one of: {}".format(key_column, ", ".join(names)))
+        self.path = path
+        self.key_column = key_column
+        self.batch_size = batch_size
+        self.metadata = metadata or {}
+        self.rows = 0
+        self._columns = [_ColumnWriter(path, name, type_) for name, type_ in columns]
+
+    def append(self, values):
+        """ Add a row as the list of its values, in the order of the columns. """
+        for column, value in zip(self._columns, values):
+            column.append(value)
+        self.rows += 1
+        if self.rows % self.batch_size == 0:
+            for column in self._columns:
+                column.flush()
+
+    def close(self):
+        """ Assemble the snapshot file from the columns written so far. """
+        for column in self._columns:
+            column.close()
+        try:
+            self._assemble()
+        finally:
+            for column in self._columns:
+                column.remove()
+
+    def abort(self):
+        for column in self._columns:
+            column.close()
+            column.remove()
+
+    def _assemble(self):
+        sections = []
+        part = self.path + ".part"
+        with open(part, "wb") as f:
+
+            def copy(source):
+                padding = -f.tell() % 8
+                f.write(b"\0" * padding)
+                offset = f.tell()
+                with open(source, "rb") as data:
+                    shutil.copyfileobj(data, f, 1024 * 1024)
+                return [offset, f.tell() - offset]
+
+            for column in self._columns:
+                section = {"name": column.name, "type": column.type, "typecode": column.typecode}
+                section["values"] = copy(column.values_path)
+                section["nulls"] = copy(column.nulls_path) if column.has_nulls else None
+                section["heap"] = copy(column.heap_path) if column.typecode is None else None
+                sections.append(section)
+            f.flush()
+            index = None
+            if self.key_column is not None and self.rows:
+                f.write(b"\0" * (-f.tell() % 8))
+                offset = f.tell()
+                with Snapshot(part, sections=sections, rows=self.rows) as partial:
+                    keys = partial.column(self.key_column)
+                    self._write_index(keys, f)
+                    del keys
+                index = [offset, f.tell() - offset]
+            footer = json.dumps(
+                {
+                    "rows": self.rows,
+                    "columns": sections,
+                    "key_column": self.key_column,
+                    "index": index,
+                    "metadata": self.metadata,
+                }
+            ).encode("utf-8")
+            f.write(footer)
+            f.write(_TRAILER.pack(len(footer), MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part, self.path)
+
+    def _write_index(self, keys, f):
+        """ Write the positions of the rows in the order of their keys, ties in the order of the rows. """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None and isinstance(keys, memoryview):
+            numpy.argsort(numpy.asarray(keys), kind="stable").astype(numpy.int64, copy=False).tofile(f)
+            return
+        if self.rows <= self.sort_run_rows:
+            array("q", sorted(range(self.rows), key=keys.__getitem__)).tofile(f)
+            return
+        runs = []
+        try:
+            for start in range(0, self.rows, self.sort_run_rows):
+                positions = range(start, min(start + self.sort_run_rows, self.rows))
+                runs.append(tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path))))
+                array("q", sorted(positions, key=keys.__getitem__)).tofile(runs[-1])
+                runs[-1].seek(0)
+            # heapq.merge keeps ties in the order of the runs, which are in the order of the rows
+            order = array("q")
+            for position in heapq.merge(*[_read_positions(run) for run in runs], key=keys.__getitem__):
+                order.append(position)
+                if len(order) == 8192:
+                    order.tofile(f)
+                    del order[:]
+            order.tofile(f)
+        finally:
+            for run in runs:
+                run.close()
+
+
+class _StringColumn(object):
+    """ A string column read in place, values are decoded when accessed. """
+
+    def __init__(self, offsets, heap):
+        self._offsets = offsets
+        self._heap = heap
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return str(self._heap[self._offsets[index] : self._offsets[index + 1]], "utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class Snapshot(object):
+    """
+    A snapshot file mapped in memory.
+
+    ``column(name)`` returns the values of a column without copying them: a memoryview of numbers for fixed-width
+    columns, which ``numpy.asarray`` accepts, and a sequence decoding the strings when they are read otherwise. Nulls
+    are stored as zeros or empty strings there, ``row`` and ``get`` return them as None.
+
+    """
+
+    def __init__(self, path, sections=None, rows=None):
+        self.path = path
+        self._cache = {}
+        self._index = None
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        if sections is None:
+            footer_size, magic = _TRAILER.unpack(self._map[-_TRAILER.size :])
+            if magic != MAGIC:
+                self.close()
+                raise ValueError("{} is not a snapshot file".format(path))
+            end = size - _TRAILER.size
+            footer = json.loads(self._map[end - footer_size : end].decode("utf-8"))
+            sections, rows = footer["columns"], footer["rows"]
+            self.key_column = footer["key_column"]
+            self.metadata = footer["metadata"]
+            self._index = self._view(footer["index"], "q")
+        else:
+            self.key_column = None
+            self.metadata = {}
+        self.rows = rows
+        self.columns = [(section["name"], section["type"]) for section in sections]
+        self._sections = {section["name"]: section for section in sections}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        self._cache.clear()
+        self._index = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # views of the columns are still in use, the mapping is released with them
+                pass
+        self._file.close()
+
+    def _view(self, section, typecode):
+        if section is None:
+            return None
+        offset, length = section
+        view = memoryview(self._map)[offset : offset + length]
+        return view.cast(typecode) if typecode else view
+
+    def column(self, name):
+        """ The values of a column, read in place. """
+        values = self._cache.get(name)
+        if values is None:
+            section = self._sections[name]
+            if section["typecode"] is not None:
+                values = self._view(section["values"], section["typecode"])
+            else:
+                values = _StringColumn(self._view(section["values"], "q"), self._view(section["heap"], None))
+            self._cache[name] = values
+        return values
+
+    def nulls(self, name):
+        """ One byte per row, 1 where the column is null, None when it has no nulls. """
+        return self._view(self._sections[name]["nulls"], None)
+
+    def column_values(self, name):
+        """ The values of a column as a list, with None for nulls. """
+        values = list(self.column(name))
+        nulls = self.nulls(name)
+        if nulls is not None:
+            values = [None if null else value for value, null in zip(values, nulls)]
+        if self._sections[name]["typecode"] == "b":
+            values = [None if value is None else bool(value) for value in values]
+        return values
+
+    def row(self, index):
+        """ The row at ``index`` as a dict. """
+        row = {}
+        for name, type_ in self.columns:
+            nulls = self.nulls(name)
+            if nulls is not None and nulls[index]:
+                row[name] = None
+                continue
+            value = self.column(name)[index]
+            row[name] = bool(value) if self._sections[name]["typecode"] == "b" else value
+        return row
+
+    def __iter__(self):
+        for index in range(self.rows):
+            yield self.row(index)
+
+    def _bounds(self, key):
+        if self._index is None:
+            raise ValueError("{} has no key index".format(self.path))
+        keys = self.column(self.key_column)
+        index = self._index
+        low, high = 0, self.rows
+        while low < high:
+            middle = (low + high) // 2
+            if keys[index[middle]] < key:
+                low = middle + 1
+            else:
+                high = middle
+        start, high = low, self.rows
+        while low < high:
+            middle = (low + high) // 2
+            if keys[index[middle]] <= key:
+                low = middle + 1
+            else:
+                high = middle
+        return start, low
+
+    def lookup(self, key):
+        """ The rows whose key is ``key``, by binary search over the sorted index. """
+        start, end = self._bounds(key)
+        return [self.row(self._index[position]) for position in range(start, end)]
+
+    def get(self, key, default=None):
+        """ The first row whose key is ``key``. """
+        start, end = self._bounds(key)
+        return self.row(self._index[start]) if start < end else default
+
+
+def export_snapshot(client, table, path, key_column=None, batch_size=10000, stream_properties=None, where=None):
+    """
+    Scan ``table`` with a pull query and write its rows to a snapshot file, returning the number of rows.
+
+    Parameter List
+    -------------
+    :param client: A ``KSQLAPI``.
+    :param table: Name of the table.
+    :param path: Path of the snapshot file.
+    :param key_column: Column indexed for lookups, the key of the table by default when it has a single key column.
+    :param batch_size: Number of rows buffered per column before being written.
+    :param stream_properties: Properties of the pull query.
+    :param where: Condition restricting the rows exported.
+
+    """
+    query_string = "SELECT * FROM {}{};".format(table, " WHERE {}".format(where) if where else "")
+    lines = client.query(query_string, stream_properties=stream_properties)
+    loads = client.sa.codec.loads
+    writer = None
+    try:
+        for line in lines:
+            line = normalize_line(line)
+            if not line or line == "]":
+                continue
+            if writer is None:
+                columns = _split_header(line)
+                if columns is None:
+                    continue
+                if key_column is None:
+                    keys = _KEY_COLUMNS.findall(line)
+                    key_column = keys[0] if len(keys) == 1 else None
+                writer = SnapshotWriter(
+                    path, columns, key_column=key_column, batch_size=batch_size, metadata={"table": table}
+                )
+                continue
+            values = _row_values(line, loads)
+            if values is not None:
+                writer.append(values)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        lines.close()
+    if writer is None:
+        raise ValueError("The scan of {} returned no header".format(table))
+    writer.close()
+    return writer.rows
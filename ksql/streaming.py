@@ -0,0 +1,356 @@
+"""
+Consuming many push queries from a single loop.
+
+"""
+import threading
+from collections import deque
+
+from ksql.errors import QueryBudgetExceededError
+from ksql.queries import approximate_size
+
+_DONE = object()
+
+
+def _close_iterable(iterable):
+    """ Close an iterable from any thread, returns False when it can only be stopped by the thread reading it. """
+    close = getattr(iterable, "close", None)
+    if close is None:
+        return False
+    try:
+        close()
+    except ValueError:
+        # a generator running in its reader thread
+        return False
+    return True
+
+
+class _Source(object):
+    def __init__(self, tag, iterable, buffer_size, lock):
+        self.tag = tag
+        self.iterable = iterable
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.not_full = threading.Condition(lock)
+        self.error = None
+        self.rows = 0
+
+
+class MergedQueries(object):
+    """
+    Iterate over several push queries at once, yielding ``(tag, row)`` pairs.
+
+    Each query is read by its own daemon thread into a buffer of at most ``buffer_size`` rows, a query whose buffer is
+    full waits for the consumer without holding the others back. The consumer takes one row from each query in turn,
+    so a busy query can't starve a quiet one.
+
+    A query failing stops the iteration: its buffered rows are yielded first, then its exception is raised. Closing
+    the iterator closes the queries and waits for their readers. Queries that can't be closed from another thread,
+    like generators, are only stopped after the row their reader is waiting for and are not waited for, the results
+    of ``KSQLAPI.query`` are closed right away.
+
+    Parameter List
+    -------------
+    :param queries: A dict mapping tags to iterables, or a list of iterables tagged by their index.
+    :param buffer_size: Maximum number of rows buffered per query.
+
+    """
+
+    def __init__(self, queries, buffer_size=1000):
+        if not isinstance(queries, dict):
+            queries = dict(enumerate(queries))
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._sources = [_Source(tag, iterable, buffer_size, self._lock) for tag, iterable in queries.items()]
+        self._closed = False
+        self._iterator = None
+        self._threads = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = self._run()
+        return next(self._iterator)
+
+    def close(self, timeout=None):
+        """ Close the queries and wait at most ``timeout`` seconds for each of the readers that could be stopped. """
+        if self._iterator is not None:
+            self._iterator.close()
+        for source, thread in zip(self._sources, self._threads):
+            if _close_iterable(source.iterable):
+                thread.join(timeout)
+
+    def depths(self):
+        """ Number of rows waiting in the buffer of each query. """
+        with self._lock:
+            return {source.tag: len(source.buffer) for source in self._sources}
+
+    def rows(self):
+        """ Number of rows read so far from each query. """
+        with self._lock:
+            return {source.tag: source.rows for source in self._sources}
+
+    def _run(self):
+        for source in self._sources:
+            thread = threading.Thread(target=self._read, args=(source,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        active = list(self._sources)
+        position = 0
+        try:
+            while active:
+                with self._lock:
+                    while True:
+                        source = self._next_ready(active, position)
+                        if source is not None:
+                            break
+                        self._not_empty.wait()
+                    index = active.index(source)
+                    position = (index + 1) % len(active)
+                    item = source.buffer.popleft()
+                    source.not_full.notify()
+                if item is _DONE:
+                    active.remove(source)
+                    if source.error is not None:
+                        raise source.error
+                    position = index % len(active) if active else 0
+                    continue
+                yield source.tag, item
+        finally:
+            self._stop()
+
+    @staticmethod
+    def _next_ready(active, position):
+        count = len(active)
+        for offset in range(count):
+            source = active[(position + offset) % count]
+            if source.buffer:
+                return source
+        return None
+
+    def _read(self, source):
+        iterator = iter(source.iterable)
+        try:
+            for item in iterator:
+                with self._lock:
+                    while len(source.buffer) >= source.buffer_size and not self._closed:
+                        source.not_full.wait()
+                    if self._closed:
+                        break
+                    source.buffer.append(item)
+                    source.rows += 1
+                    self._not_empty.notify()
+        except Exception as e:
+            source.error = e
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+            with self._lock:
+                source.buffer.append(_DONE)
+                self._not_empty.notify()
+
+    def _stop(self):
+        with self._lock:
+            self._closed = True
+            for source in self._sources:
+                source.not_full.notify_all()
+        for source in self._sources:
+            _close_iterable(source.iterable)
+
+
+class BackgroundReader(object):
+    """
+    Read an iterable on a background thread into a bounded buffer, decoupling network reads from processing.
+
+    ``overflow`` decides what happens when the consumer falls behind and the buffer is full:
+
+    - ``block``: the reader waits for the consumer, pushing back on the server through TCP
+    - ``drop-oldest``: the oldest buffered row is discarded to make room
+    - ``drop-newest``: the incoming row is discarded
+    - ``sample``: only one incoming row out of ``sample_every`` is kept, replacing the oldest one
+
+    The first row, the header of raw streams, is never dropped.
+
+    When the ``max_buffered_bytes`` of the ``budget`` is exceeded, the buffered rows are dropped and the consumer gets
+    the ``QueryBudgetExceededError`` right away.
+
+    Parameter List
+    -------------
+    :param iterable: Rows to read, e.g. the generator returned by ``query``.
+    :param buffer_size: Maximum number of rows buffered.
+    :param overflow: One of ``OVERFLOW_POLICIES``.
+    :param sample_every: Keep one row out of this many when sampling.
+    :param budget: A ``ksql.queries.QueryBudget`` accounting for the size of the buffered rows.
+    :param interrupt: Called on close to stop the iterable from another thread, e.g. ``ksql.queries.QueryResults.stop``.
+                      Closing the reader waits for its thread only when the iterable could be stopped.
+
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest", "sample")
+
+    def __init__(self, iterable, buffer_size=1000, overflow="block", sample_every=10, budget=None, interrupt=None):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unknown overflow policy {}, expected one of: {}".format(overflow, ", ".join(self.OVERFLOW_POLICIES))
+            )
+        self.iterable = iterable
+        self.buffer_size = buffer_size
+        self.overflow = overflow
+        self.sample_every = sample_every
+        self.budget = budget
+        self.interrupt = interrupt
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+        self._finished = False
+        self._error = None
+        self._overflowed = 0
+        self._first_pending = True
+        self._iterator = None
+        self._thread = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = self._run()
+        return next(self._iterator)
+
+    def close(self, timeout=None):
+        """ Stop reading and wait at most ``timeout`` seconds for the reader thread if the iterable can be stopped. """
+        if self._iterator is not None:
+            self._iterator.close()
+        self._stop()
+        if self.interrupt is not None:
+            self.interrupt()
+        elif not _close_iterable(self.iterable):
+            return
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def start(self):
+        """ Start reading ahead before the first row is consumed, iterating starts the reader otherwise. """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._read, daemon=True)
+            self._thread.start()
+        return self
+
+    @property
+    def depth(self):
+        """ Number of rows waiting for the consumer. """
+        return len(self._buffer)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth": len(self._buffer),
+                "max_depth": self.max_depth,
+                "received": self.received,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+            }
+
+    def _run(self):
+        self.start()
+        try:
+            while True:
+                with self._lock:
+                    while not self._buffer and not self._finished:
+                        self._not_empty.wait()
+                    if not self._buffer:
+                        break
+                    item = self._buffer.popleft()
+                    self._removed(item)
+                    self._first_pending = False
+                    self.delivered += 1
+                    self._not_full.notify()
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._stop()
+
+    def _read(self):
+        iterator = iter(self.iterable)
+        try:
+            for item in iterator:
+                with self._lock:
+                    if self._closed:
+                        break
+                    self.received += 1
+                    if len(self._buffer) >= self.buffer_size and not self._make_room():
+                        self.dropped += 1
+                        continue
+                    if self._closed:
+                        break
+                    self._buffer.append(item)
+                    if self.budget is not None:
+                        self.budget.buffer(approximate_size(item))
+                    self.max_depth = max(self.max_depth, len(self._buffer))
+                    self._not_empty.notify()
+        except QueryBudgetExceededError as e:
+            if e.limit == "buffered bytes":
+                with self._lock:
+                    self._buffer.clear()
+            self._error = e
+        except Exception as e:
+            self._error = e
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+            with self._lock:
+                self._finished = True
+                self._not_empty.notify()
+
+    def _make_room(self):
+        """ Called with the buffer full, returns whether the incoming row should be buffered. """
+        if self.overflow == "block":
+            while len(self._buffer) >= self.buffer_size and not self._closed:
+                self._not_full.wait()
+            return True
+        if self.overflow == "drop-newest":
+            return False
+        if self.overflow == "sample":
+            self._overflowed += 1
+            if self._overflowed % self.sample_every:
+                return False
+        # drop-oldest, or a sampled row, but keep the first row
+        if not self._first_pending:
+            self._removed(self._buffer.popleft())
+        elif len(self._buffer) > 1:
+            self._removed(self._buffer[1])
+            del self._buffer[1]
+        else:
+            return False
+        self.dropped += 1
+        return True
+
+    def _removed(self, item):
+        if self.budget is not None:
+            self.budget.release(approximate_size(item))
+
+    def _stop(self):
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+
+
+def merge_queries(queries, buffer_size=1000):
+    """
+    Merge several push queries into a single iterator of ``(tag, row)`` pairs, see ``MergedQueries``.
+
+    .. code:: python
+
+        for tag, row in merge_queries({"orders": client.query(q1), "payments": client.query(q2)}):
+            ...
+
+    """
+    return MergedQueries(queries, buffer_size=buffer_size)
@@ -0,0 +1,145 @@
+"""
+TLS configuration shared by every transport of a client.
+
+One SSL context is built per client and reused by the urllib, requests and HTTP/2 code paths. The sockets the context
+wraps cache the TLS session of their server, so that new connections of any of them resume it instead of performing a
+full handshake.
+
+"""
+
+import ssl
+import threading
+import urllib.request
+
+
+def create_ssl_context(cafile=None, certfile=None, keyfile=None, password=None, alpn_protocols=None):
+    """
+    Build a client side SSL context.
+
+    Parameter List
+    -------------
+    :param cafile: CA bundle used to verify the server, the system defaults when None.
+    :param certfile: Client certificate for mutual TLS.
+    :param keyfile: Private key of the client certificate, when it isn't bundled in ``certfile``.
+    :param password: Password of the private key.
+    :param alpn_protocols: Protocols to advertise with ALPN, e.g. ``["h2", "http/1.1"]``.
+
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    if certfile:
+        context.load_cert_chain(certfile, keyfile=keyfile, password=password)
+    if alpn_protocols:
+        context.set_alpn_protocols(alpn_protocols)
+    return context
+
+
+class TLSSessionCache(object):
+    """Thread-safe cache of the last TLS session per (host, port), with counters for monitoring."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+    def get(self, key):
+        with self._lock:
+            return self._sessions.get(key)
+
+    def put(self, key, session):
+        if session is None:
+            return
+        with self._lock:
+            self._sessions[key] = session
+
+    def record(self, resumed):
+        with self._lock:
+            self.handshakes += 1
+            self.resumed += bool(resumed)
+
+
+class SessionResumingSocket(ssl.SSLSocket):
+    """
+    Offers the cached TLS session of the server before the handshake, and caches the session it ends up with.
+
+    TLS 1.3 session tickets arrive after the handshake, the session is cached again once the first bytes are read.
+
+    """
+
+    session_cache = None
+    _ticket_pending = False
+
+    def _session_key(self):
+        try:
+            address = self.getpeername()[:2]
+        except OSError:
+            address = ()
+        return (self.server_hostname,) + tuple(address)
+
+    def do_handshake(self, block=False):
+        key = self._session_key()
+        if self.session is None:
+            session = self.session_cache.get(key)
+            if session is not None:
+                self.session = session
+        super(SessionResumingSocket, self).do_handshake(block)
+        self.session_cache.record(self.session_reused)
+        self.session_cache.put(key, self.session)
+        self._ticket_pending = True
+
+    def read(self, len=1024, buffer=None):
+        # recv and recv_into read through here
+        received = super(SessionResumingSocket, self).read(len, buffer)
+        if self._ticket_pending:
+            self._ticket_pending = False
+            self.session_cache.put(self._session_key(), self.session)
+        return received
+
+
+def resume_sessions(context):
+    """
+    Make the sockets wrapped by ``context`` resume the last TLS session of their server, whichever transport opens
+    them. Returns the session cache of the context, the one already installed when the context is shared.
+
+    """
+    socket_class = context.sslsocket_class
+    if issubclass(socket_class, SessionResumingSocket):
+        return socket_class.session_cache
+    session_cache = TLSSessionCache()
+    context.sslsocket_class = type("SessionResumingSocket", (SessionResumingSocket,), {"session_cache": session_cache})
+    return session_cache
+
+
+def build_opener(context):
+    """urllib opener making its https connections with ``context``."""
+    return urllib.request.build_opener(urllib.request.HTTPSHandler(context=context))
+
+
+def mount_ssl_context(session, context):
+    """Make a requests session use ``context`` for its https connections."""
+    from requests.adapters import HTTPAdapter
+
+    class SSLContextAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs["ssl_context"] = context
+            return super(SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
+
+        def proxy_manager_for(self, *args, **kwargs):
+            kwargs["ssl_context"] = context
+            return super(SSLContextAdapter, self).proxy_manager_for(*args, **kwargs)
+
+        # requests passes its CA bundle along with the context, and urllib3 would load it into the shared context:
+        # verification is configured by the context alone
+        def cert_verify(self, conn, url, verify, cert):
+            pass
+
+        def build_connection_pool_key_attributes(self, request, verify, cert=None):
+            host_params, pool_kwargs = super(SSLContextAdapter, self).build_connection_pool_key_attributes(
+                request, verify, cert
+            )
+            pool_kwargs.pop("ca_certs", None)
+            pool_kwargs.pop("ca_cert_dir", None)
+            return host_params, pool_kwargs
+
+    session.mount("https://", SSLContextAdapter())
+    return session
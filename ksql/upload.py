@@ -21,19 +21,17 @@ class FileUpload(object):
         :param ksqlfile: File containing the ksql rules to be uploaded.
                           Only supports ksql queries and not streaming queries
 
+        The rules are sent in batches with ``KSQLAPI.ksql_many``: a failing rule raises for its whole batch, the
+        batches before it have been executed and the following ones are not sent.
+
         """
 
         # check if the file is .ksql
         self.checkExtension(ksqlfile)
 
-        # parse the file and get back the rules
-        rules = self.get_rules_list(ksqlfile)
-        log_return = []
-        for each_rule in rules:
-            resp = self.client.ksql(each_rule)
-            log_return.append(resp)
-
-        return log_return
+        # parse the file and get back the rules, sent in as few requests as possible
+        rules = list(self.get_rules_list(ksqlfile))
+        return self.client.ksql_many(rules)
 
     def get_rules_list(self, ksqlfile):
         with open(ksqlfile) as rf:
@@ -1,10 +1,12 @@
 import ksql
-import telnetlib
+import codecs
 import json
 import re
 
 
 def check_kafka_available(bootstrap_servers):
+    import telnetlib
+
     host, port = bootstrap_servers.split(":")
     try:
         telnetlib.Telnet(host, port)
@@ -80,9 +82,17 @@ def parse_columns(columns_str):
     return result
 
 
-def process_row(row, column_names):
+def parse_header(header, loads=json.loads):
+    """ The columns of the header of a ``/query`` or a ``/query-stream`` response, like ``parse_columns``. """
+    if header.startswith("{"):
+        message = loads(header)
+        return [{"name": name, "type": type_} for name, type_ in zip(message["columnNames"], message["columnTypes"])]
+    return parse_columns(header)
+
+
+def process_row(row, column_names, loads=json.loads):
     row = row.replace(",\n", "").replace("]\n", "").rstrip("]")
-    row_obj = json.loads(row)
+    row_obj = loads(row)
     if "finalMessage" in row_obj:
         return None
     column_values = row_obj["row"]["columns"]
@@ -95,7 +105,7 @@ def process_row(row, column_names):
     return result
 
 
-def process_query_result(results, return_objects=None):
+def process_query_result(results, return_objects=None, loads=json.loads):
     if return_objects is None:
         yield from results
 
@@ -104,10 +114,177 @@ def process_query_result(results, return_objects=None):
         header = next(results)
     except StopIteration:
         return
-    columns = parse_columns(header)
+    columns = parse_header(header, loads)
+
+    if return_objects in ("typed", "lazy"):
+        from ksql.rows import typed_rows
 
+        yield from typed_rows(results, columns, lazy=return_objects == "lazy", loads=loads)
+        return
+
+    names = [column["name"] for column in columns]
     for result in results:
-        row_obj = process_row(result, columns)
+        if result.startswith("["):
+            # /query-stream rows are arrays of the values
+            yield dict(zip(names, loads(result)))
+            continue
+        row_obj = process_row(result, columns, loads)
         if row_obj is None:
             return
         yield row_obj
+
+
+_CONTAINER_TOKEN = re.compile(r'["\[\]{}]')
+_STRING_TOKEN = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r"[\s,\]}]")
+
+
+class _JSONStream(object):
+    """ A text buffer over a sequence of byte chunks, consumed one JSON value at a time. """
+
+    def __init__(self, chunks, encoding, loads):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.loads = loads
+        self.buf = ""
+        self.pos = 0
+        self.exhausted = False
+
+    def more(self):
+        if self.exhausted:
+            raise ValueError("Unexpected end of JSON input")
+        if self.pos > 0:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.buf += self.decoder.decode(b"", final=True)
+            self.exhausted = True
+        else:
+            self.buf += self.decoder.decode(chunk)
+
+    def peek(self):
+        """ Next non-whitespace character, None at the end of the input. """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.exhausted:
+                return None
+            self.more()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected {!r} at {!r}".format(char, self.buf[self.pos:self.pos + 50]))
+        self.pos += 1
+
+    def _string_end(self, start):
+        """ Index after the closing quote of the string opening at ``start``, None if it isn't complete yet. """
+        index = start + 1
+        while True:
+            match = _STRING_TOKEN.search(self.buf, index)
+            if match is None:
+                return None
+            if match.group() == '"':
+                return match.end()
+            if match.end() >= len(self.buf):
+                return None
+            index = match.end() + 1
+
+    def read_value(self):
+        """ Parse the value starting at the current position. Scanning resumes where it stopped as data arrives. """
+        first = self.peek()
+        if first is None:
+            raise ValueError("Unexpected end of JSON input")
+        start = self.pos
+        index = start
+        depth = 0
+        while True:
+            if first in "[{":
+                end = None
+                while True:
+                    match = _CONTAINER_TOKEN.search(self.buf, index)
+                    if match is None:
+                        index = len(self.buf)
+                        break
+                    token = match.group()
+                    if token == '"':
+                        string_end = self._string_end(match.start())
+                        if string_end is None:
+                            index = match.start()
+                            break
+                        index = string_end
+                        continue
+                    index = match.end()
+                    depth += 1 if token in "[{" else -1
+                    if depth == 0:
+                        end = index
+                        break
+            elif first == '"':
+                end = self._string_end(start)
+            else:
+                match = _SCALAR_END.search(self.buf, start)
+                end = match.start() if match else (len(self.buf) if self.exhausted else None)
+
+            if end is not None:
+                self.pos = end
+                return self.loads(self.buf[start:end])
+            # keep the partial value, the buffer is only compacted up to its start
+            self.pos = start
+            self.more()
+            index -= start
+            start = 0
+
+    def iter_array(self, expand=()):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            if expand and self.peek() == "{":
+                yield from self.iter_object(expand)
+            else:
+                yield self.read_value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError("Expected ',' or ']' in JSON array, got {!r}".format(separator))
+
+    def iter_object(self, expand):
+        """
+        Yield the items of the array fields named in ``expand`` one by one, or the whole object if it has none.
+        """
+        self.expect("{")
+        envelope = {}
+        expanded = False
+        while self.peek() != "}":
+            key = self.read_value()
+            self.expect(":")
+            if key in expand and self.peek() == "[":
+                expanded = True
+                yield from self.iter_array()
+            else:
+                envelope[key] = self.read_value()
+            if self.peek() == ",":
+                self.pos += 1
+        self.pos += 1
+        if not expanded:
+            yield envelope
+
+
+def iter_json_array(chunks, encoding="utf-8", loads=json.loads, expand=()):
+    """
+    Incrementally parse a JSON array arriving as a sequence of byte chunks, yielding its elements one by one.
+
+    Only the element being parsed is buffered, so peak memory depends on the largest element rather than on the
+    size of the whole array. Elements that are objects holding an array under one of the ``expand`` keys yield
+    the items of that array instead, so that a single entity wrapping a big listing doesn't have to be buffered.
+
+    """
+    stream = _JSONStream(chunks, encoding, loads)
+    if stream.peek() is None:
+        return
+    yield from stream.iter_array(expand)
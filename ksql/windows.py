@@ -0,0 +1,365 @@
+"""
+Windowed aggregation of push query rows on the client.
+
+Rows are grouped by key and assigned to tumbling, hopping or session windows by their event time, ``ROWTIME`` by
+default. They are added in batches: the window assignment, the grouping and the count, sum, min and max of every
+window touched by a batch are computed with NumPy, so Python only loops over the windows, not over the rows.
+
+The watermark is the largest event time seen minus ``grace``. A window is closed and its result emitted once the
+watermark reaches its end. Lateness is judged against the watermark at the start of each batch: a row whose windows
+are all closed is dropped and counted in ``late``.
+
+NumPy is an optional dependency, it is imported when an aggregator is created.
+
+"""
+import datetime
+import heapq
+import itertools
+import re
+import time
+
+_PERCENTILE = re.compile(r"^p(\d+(?:\.\d+)?)$")
+AGGREGATIONS = ("count", "sum", "mean", "min", "max")
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Windowed aggregation requires numpy, install it with: pip install numpy")
+    return numpy
+
+
+def to_duration(value):
+    """ Milliseconds from an int or a timedelta. """
+    if isinstance(value, datetime.timedelta):
+        return int(value.total_seconds() * 1000)
+    return int(value)
+
+
+class HoppingWindow(object):
+    """ Windows of ``size`` milliseconds starting every ``advance`` milliseconds, a row belongs to several of them. """
+
+    def __init__(self, size, advance):
+        self.size = to_duration(size)
+        self.advance = to_duration(advance)
+        if self.size <= 0 or self.advance <= 0 or self.advance > self.size:
+            raise ValueError("Window size and advance must be positive, and advance at most size")
+        # number of windows a row may belong to
+        self.count = -(-self.size // self.advance)
+
+    def assign(self, np, times):
+        """ Start of every window containing each time, flattened, with the index of its row. """
+        latest = times - times % self.advance
+        starts = latest[:, None] - np.arange(self.count, dtype=np.int64)[None, :] * self.advance
+        rows = np.broadcast_to(np.arange(len(times))[:, None], starts.shape)
+        contains = starts + self.size > times[:, None]
+        return starts[contains], rows[contains]
+
+
+class TumblingWindow(HoppingWindow):
+    """ Consecutive, non overlapping windows of ``size`` milliseconds. """
+
+    def __init__(self, size):
+        super(TumblingWindow, self).__init__(size, size)
+
+    def assign(self, np, times):
+        return times - times % self.size, np.arange(len(times))
+
+
+class SessionWindow(object):
+    """ Rows of a key less than ``gap`` milliseconds apart belong to the same session. """
+
+    def __init__(self, gap):
+        self.gap = to_duration(gap)
+        if self.gap <= 0:
+            raise ValueError("Session gap must be positive")
+
+
+class _Window(object):
+    __slots__ = ("key", "start", "end", "close_at", "closed", "count", "sum", "min", "max", "chunks")
+
+    def __init__(self, key, start, end, close_at):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.close_at = close_at
+        self.closed = False
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.chunks = []
+
+    def add(self, count, total, minimum, maximum, chunk):
+        self.count += count
+        self.sum += total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+        if chunk is not None:
+            self.chunks.append(chunk)
+
+    def merge(self, other):
+        self.add(other.count, other.sum, other.min, other.max, None)
+        self.chunks.extend(other.chunks)
+
+
+class WindowedAggregator(object):
+    """
+    Aggregate rows over event time windows, per key, and emit one result per window when it closes.
+
+    Results are dicts shaped like the rows of a windowed table: the key column, ``WINDOWSTART``, ``WINDOWEND`` and
+    one column per aggregation, e.g. ``COUNT`` or ``P99``. Session windows start and end at their first and last row.
+
+    Aggregations are ``count``, ``sum``, ``mean``, ``min``, ``max`` and percentiles written ``p50``, ``p99.9``...
+    Percentiles keep the values of the open windows in memory, the others only keep running totals.
+
+    .. code:: python
+
+        aggregator = WindowedAggregator(TumblingWindow(60000), key="ID", value="AMOUNT",
+                                        aggregations=("count", "sum", "p99"), grace=5000)
+        for result in aggregator.aggregate(client.query(query_string, return_objects=True)):
+            ...
+
+    Parameter List
+    -------------
+    :param window: A ``TumblingWindow``, ``HoppingWindow`` or ``SessionWindow``.
+    :param key: Column grouping the rows, a tuple of columns, a function of the row dict, or None for one group.
+    :param value: Column aggregated, only ``count`` may be computed without one. Rows where it is null are skipped.
+    :param aggregations: Names of the aggregations to compute.
+    :param time_column: Column holding the event time of the rows, in epoch milliseconds.
+    :param grace: How long to wait for out of order rows before closing a window, in milliseconds or as a timedelta.
+
+    """
+
+    def __init__(self, window, key=None, value=None, aggregations=("count",), time_column="ROWTIME", grace=0):
+        self._np = _numpy()
+        if isinstance(aggregations, str):
+            aggregations = (aggregations,)
+        self.aggregations = tuple(name.lower() for name in aggregations)
+        self._percentiles = []
+        for name in self.aggregations:
+            match = _PERCENTILE.match(name)
+            if match is not None and float(match.group(1)) <= 100:
+                self._percentiles.append(float(match.group(1)))
+            elif name not in AGGREGATIONS:
+                raise ValueError(
+                    "Unknown aggregation {}, expected pNN or one of: {}".format(name, ", ".join(AGGREGATIONS))
+                )
+        if value is None and self.aggregations != ("count",):
+            raise ValueError("A value column is required for aggregations other than count")
+        self.window = window
+        self.key = key
+        self.value = value
+        self.time_column = time_column
+        self.grace = to_duration(grace)
+        self.watermark = None
+        self.rows = 0
+        self.late = 0
+        self.skipped = 0
+        self.emitted = 0
+        self._windows = {}
+        self._sessions = {}
+        self._closing = []
+        self._sequence = itertools.count()
+
+    @property
+    def open_windows(self):
+        return len(self._windows) + sum(len(sessions) for sessions in self._sessions.values())
+
+    def process(self, rows):
+        """ Add a batch of row dicts and return the results of the windows closed by it, in the order they closed. """
+        rows = rows if isinstance(rows, list) else list(rows)
+        if not rows:
+            return []
+        times, key_ids, keys, values = self._columns(rows)
+        if len(times):
+            self.rows += len(times)
+            if isinstance(self.window, SessionWindow):
+                self._add_sessions(times, key_ids, keys, values)
+            else:
+                self._add_windows(times, key_ids, keys, values)
+            watermark = int(times.max()) - self.grace
+            if self.watermark is None or watermark > self.watermark:
+                self.watermark = watermark
+        return self._close()
+
+    def flush(self):
+        """ Close every open window, e.g. when the stream is over, and return their results. """
+        return self._close(force=True)
+
+    def aggregate(self, rows, batch_size=1000, max_delay=0.05):
+        """
+        Aggregate an iterable of row dicts, e.g. ``query(..., return_objects=True)``, and yield the results as the
+        windows close. The remaining windows are flushed when the iterable is exhausted.
+
+        Rows are added in batches of ``batch_size``, or once the first row of a batch has waited ``max_delay``
+        seconds, which is checked when rows arrive.
+
+        """
+        iterator = iter(rows)
+        batch, started = [], None
+        try:
+            for row in iterator:
+                if started is None:
+                    started = time.time()
+                batch.append(row)
+                if len(batch) >= batch_size or time.time() - started >= max_delay:
+                    yield from self.process(batch)
+                    batch, started = [], None
+            if batch:
+                yield from self.process(batch)
+            yield from self.flush()
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    def _columns(self, rows):
+        np = self._np
+        count = len(rows)
+        times = np.fromiter((row[self.time_column] for row in rows), dtype=np.int64, count=count)
+        ids = {}
+        if self.key is None:
+            key_ids = np.zeros(count, dtype=np.int64)
+            ids[None] = 0
+        else:
+            key_ids = np.fromiter(
+                (ids.setdefault(self._key_of(row), len(ids)) for row in rows), dtype=np.int64, count=count
+            )
+        if self.value is None:
+            values = np.zeros(count)
+        else:
+            values = np.fromiter(
+                (np.nan if row.get(self.value) is None else row[self.value] for row in rows),
+                dtype=np.float64,
+                count=count,
+            )
+            valid = ~np.isnan(values)
+            if not valid.all():
+                self.skipped += int(count - valid.sum())
+                times, key_ids, values = times[valid], key_ids[valid], values[valid]
+        return times, key_ids, list(ids), values
+
+    def _key_of(self, row):
+        if isinstance(self.key, str):
+            return row[self.key]
+        if isinstance(self.key, tuple):
+            return tuple(row[column] for column in self.key)
+        return self.key(row)
+
+    def _reduce(self, order, boundaries, values):
+        """ Count, sum, min, max and the values of each group of the sorted rows. """
+        np = self._np
+        values = values[order]
+        counts = np.diff(np.append(boundaries, len(values)))
+        sums = np.add.reduceat(values, boundaries)
+        minimums = np.minimum.reduceat(values, boundaries)
+        maximums = np.maximum.reduceat(values, boundaries)
+        chunks = np.split(values, boundaries[1:]) if self._percentiles else itertools.repeat(None)
+        return zip(counts.tolist(), sums.tolist(), minimums.tolist(), maximums.tolist(), chunks)
+
+    def _add_windows(self, times, key_ids, keys, values):
+        np = self._np
+        size = self.window.size
+        starts, rows = self.window.assign(np, times)
+        if self.watermark is not None:
+            open_ = starts + size > self.watermark
+            self.late += int((np.bincount(rows[open_], minlength=len(times)) == 0).sum())
+            starts, rows = starts[open_], rows[open_]
+            if not len(starts):
+                return
+        row_keys = key_ids[rows]
+        order = np.lexsort((starts, row_keys))
+        row_keys, starts = row_keys[order], starts[order]
+        boundaries = np.flatnonzero(
+            np.concatenate(([True], (row_keys[1:] != row_keys[:-1]) | (starts[1:] != starts[:-1])))
+        )
+        groups = self._reduce(order, boundaries, values[rows])
+        for key_id, start, aggregates in zip(row_keys[boundaries].tolist(), starts[boundaries].tolist(), groups):
+            key = keys[key_id]
+            window = self._windows.get((key, start))
+            if window is None:
+                window = self._windows[(key, start)] = _Window(key, start, start + size, start + size)
+                self._schedule(window)
+            window.add(*aggregates)
+
+    def _add_sessions(self, times, key_ids, keys, values):
+        np = self._np
+        gap = self.window.gap
+        order = np.lexsort((times, key_ids))
+        sorted_times, sorted_keys = times[order], key_ids[order]
+        breaks = (sorted_keys[1:] != sorted_keys[:-1]) | (np.diff(sorted_times) >= gap)
+        boundaries = np.flatnonzero(np.concatenate(([True], breaks)))
+        ends = np.append(boundaries[1:], len(order)) - 1
+        groups = self._reduce(order, boundaries, values)
+        segments = zip(
+            sorted_keys[boundaries].tolist(), sorted_times[boundaries].tolist(), sorted_times[ends].tolist(), groups
+        )
+        for key_id, start, end, aggregates in segments:
+            key = keys[key_id]
+            sessions = self._sessions.get(key, [])
+            merged = [session for session in sessions if start - session.end < gap and session.start - end < gap]
+            if not merged and self.watermark is not None and end + gap <= self.watermark:
+                self.late += aggregates[0]
+                continue
+            start = min([start] + [session.start for session in merged])
+            end = max([end] + [session.end for session in merged])
+            window = _Window(key, start, end, end + gap)
+            window.add(*aggregates)
+            for session in merged:
+                window.merge(session)
+                session.closed = True
+                sessions.remove(session)
+            sessions.append(window)
+            self._sessions[key] = sessions
+            self._schedule(window)
+
+    def _schedule(self, window):
+        heapq.heappush(self._closing, (window.close_at, next(self._sequence), window))
+
+    def _close(self, force=False):
+        results = []
+        while self._closing and (force or self._closing[0][0] <= self.watermark):
+            close_at, sequence, window = heapq.heappop(self._closing)
+            if window.closed or window.close_at != close_at:
+                continue
+            window.closed = True
+            if isinstance(self.window, SessionWindow):
+                sessions = self._sessions[window.key]
+                sessions.remove(window)
+                if not sessions:
+                    del self._sessions[window.key]
+            else:
+                del self._windows[(window.key, window.start)]
+            results.append(self._result(window))
+        self.emitted += len(results)
+        return results
+
+    def _result(self, window):
+        result = {}
+        if isinstance(self.key, str):
+            result[self.key] = window.key
+        elif isinstance(self.key, tuple):
+            result.update(zip(self.key, window.key))
+        elif self.key is not None:
+            result["KEY"] = window.key
+        result["WINDOWSTART"] = window.start
+        result["WINDOWEND"] = window.end
+        if self._percentiles:
+            percentiles = self._np.percentile(self._np.concatenate(window.chunks), self._percentiles).tolist()
+            percentiles = dict(zip(self._percentiles, percentiles))
+        for name in self.aggregations:
+            if name == "count":
+                value = window.count
+            elif name == "sum":
+                value = window.sum
+            elif name == "mean":
+                value = window.sum / window.count
+            elif name == "min":
+                value = window.min
+            elif name == "max":
+                value = window.max
+            else:
+                value = percentiles[float(name[1:])]
+            result[name.upper()] = value
+        return result
@@ -55,6 +55,7 @@ setup(
     ],
     include_package_data=True,
     platforms=['any'],
+    python_requires=">=3.7",
     extras_require={
         "dev": get_install_requirements("test-requirements.txt")
     },
@@ -64,7 +65,6 @@ setup(
         "Natural Language :: English",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
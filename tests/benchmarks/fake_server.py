@@ -0,0 +1,515 @@
+"""
+An in-process stand-in for a ksqlDB server.
+
+It speaks just enough of the REST API for the client to run against it: ``/info``, ``/ksql``, ``/close-query``, the
+chunked HTTP/1.1 ``/query`` endpoint and the ``/query-stream`` and ``/inserts-stream`` endpoints. HTTP/2 upgrade
+requests are declined, so HTTP/2 clients fall back to HTTP/1.1 chunked responses with the same framing.
+Responses are gzip or deflate encoded when the client asks for it, and gzip request bodies are accepted.
+
+Faults can be injected to test the client under bad network and server conditions, see ``Faults``.
+
+"""
+import json
+import re
+import socket
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StreamConfig(object):
+    """
+    Shape of the rows streamed by the push query endpoints.
+
+    Parameter List
+    -------------
+    :param rows: Number of rows to send before ending the query. None streams until the client disconnects.
+    :param row_size: Approximate size in bytes of the payload column of each row.
+    :param rate: Rows per second, None to send as fast as possible.
+    :param heartbeat_every: Send an empty line after every ``heartbeat_every`` rows, None to disable heartbeats.
+    :param trailing_heartbeats: Heartbeats sent after the last row instead of closing the response right away.
+    :param heartbeat_interval: Seconds between trailing heartbeats.
+    :param partitions: Number of partitions of the source topic, row ``i`` is in partition ``i % partitions``. Queries
+                       filtering on ``ROWPARTITION % n = k`` only get the rows of the matching partitions.
+    :param window_size: Serve ``/query`` as pull queries on a windowed table instead: ``rows`` windows of
+                        ``window_size`` ms starting at 0. Queries filtering on ``WINDOWSTART >= a AND WINDOWSTART < b``
+                        get the windows in that range, newest first.
+
+    """
+
+    def __init__(
+        self,
+        rows=1000,
+        row_size=64,
+        rate=None,
+        heartbeat_every=None,
+        trailing_heartbeats=0,
+        heartbeat_interval=0.0,
+        partitions=1,
+        window_size=None,
+    ):
+        self.rows = rows
+        self.row_size = row_size
+        self.rate = rate
+        self.heartbeat_every = heartbeat_every
+        self.trailing_heartbeats = trailing_heartbeats
+        self.heartbeat_interval = heartbeat_interval
+        self.partitions = partitions
+        self.window_size = window_size
+
+
+class Faults(object):
+    """
+    Misbehaviour injected by the fake server. Everything is deterministic so tests and benchmarks are repeatable.
+
+    Parameter List
+    -------------
+    :param latency: Seconds to wait before answering each request.
+    :param bandwidth: Throttle response bodies to this many bytes per second.
+    :param chunk_size: Split every frame into HTTP chunks of at most this many bytes.
+    :param disconnect_after: Drop the connection after this many rows of a push query, without ending the response.
+    :param status: Answer requests with this HTTP status (e.g. 503) and a ``generic_error`` body.
+    :param statement_error: Answer ``/ksql`` requests with a 400 ``statement_error`` carrying this message.
+    :param command_error: Answer ``/ksql`` statements with a 200 ``currentStatus`` in the ERROR state carrying this
+                          message, like older servers do.
+    :param fail_requests: Only the first ``fail_requests`` requests get ``status``/``statement_error`` or are
+                          disconnected, None fails all of them.
+
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        bandwidth=None,
+        chunk_size=None,
+        disconnect_after=None,
+        status=None,
+        statement_error=None,
+        command_error=None,
+        fail_requests=None,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.disconnect_after = disconnect_after
+        self.status = status
+        self.statement_error = statement_error
+        self.command_error = command_error
+        self.fail_requests = fail_requests
+
+
+class Disconnect(Exception):
+    pass
+
+
+COLUMNS = [("ID", "BIGINT"), ("SENT_AT", "DOUBLE"), ("PAYLOAD", "STRING")]
+WINDOWED_COLUMNS = [("ID", "BIGINT"), ("WINDOWSTART", "BIGINT"), ("WINDOWEND", "BIGINT"), ("TOTAL", "BIGINT")]
+
+
+def parse_shard(sql):
+    """ ``(n, k)`` when the query filters on ``ROWPARTITION % n = k``. """
+    match = re.search(r"ROWPARTITION\s*%\s*(\d+)\s*=\s*(\d+)", sql, re.IGNORECASE)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def parse_window_range(sql):
+    """ ``(start, end)`` when the query filters on ``WINDOWSTART >= start AND WINDOWSTART < end``. """
+    match = re.search(r"WINDOWSTART\s*>=\s*(\d+)\s+AND\s+WINDOWSTART\s*<\s*(\d+)", sql, re.IGNORECASE)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def parse_keys(sql):
+    """ The ids of a ``WHERE ID IN (...)`` pull query, None for other queries. """
+    match = re.search(r"\bID\s+IN\s*\(([^)]*)\)", sql, re.IGNORECASE)
+    return [int(key) for key in match.group(1).split(",") if key.strip()] if match else None
+
+
+def make_columns(index, row_size):
+    return [index, time.time(), "x" * row_size]
+
+
+class FakeKSQLHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    _chunk_compressor = None
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _read_body(self):
+        body = b""
+        length = self.headers.get("Content-Length")
+        if length is not None:
+            body = self.rfile.read(int(length))
+        elif self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        if self.headers.get("Content-Encoding", "").lower() in ("gzip", "deflate"):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS if self.headers["Content-Encoding"] == "gzip" else 15)
+        return body
+
+    def _content_encoding(self):
+        accepted = [e.split(";")[0].strip() for e in self.headers.get("Accept-Encoding", "").lower().split(",")]
+        for encoding in ("gzip", "deflate"):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def _compressor(self, encoding):
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        encoding = self._content_encoding()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if encoding:
+            compressor = self._compressor(encoding)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_chunked(self, status=200):
+        encoding = self._content_encoding()
+        self._chunk_compressor = self._compressor(encoding) if encoding else None
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        if self._chunk_compressor is not None:
+            data = self._chunk_compressor.compress(data) + self._chunk_compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._write_frame(data)
+
+    def _write_frame(self, data):
+        faults = self.fake.faults
+        size = faults.chunk_size or len(data) or 1
+        for start in range(0, len(data), size):
+            piece = data[start:start + size]
+            self.wfile.write("{:x}\r\n".format(len(piece)).encode("ascii") + piece + b"\r\n")
+            self.wfile.flush()
+            if faults.bandwidth:
+                time.sleep(len(piece) / faults.bandwidth)
+
+    def _disconnect(self):
+        self.wfile.flush()
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.close_connection = True
+        raise Disconnect()
+
+    def _inject_failure(self, path):
+        """ Answer with the configured error instead of handling the request, returns True if it did. """
+        faults = self.fake.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        if faults.statement_error and path == "/ksql":
+            payload = {
+                "@type": "statement_error",
+                "error_code": 40001,
+                "message": faults.statement_error,
+                "stack_trace": [],
+                "statementText": "",
+                "entities": [],
+            }
+            status = 400
+        elif faults.status:
+            payload = {"@type": "generic_error", "error_code": faults.status * 100, "message": "Injected failure"}
+            status = faults.status
+        else:
+            return False
+        if not self.fake.take_failure():
+            return False
+        self._send_json(status, payload)
+        return True
+
+    def _end_chunked(self):
+        if self._chunk_compressor is not None:
+            self._write_frame(self._chunk_compressor.flush())
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.fake.record(self)
+        if self._inject_failure(self.path):
+            return
+        if self.path == "/info":
+            self._send_json(200, {"KsqlServerInfo": {"version": self.fake.version, "kafkaClusterId": "fake"}})
+        elif self.path.startswith("/status/"):
+            self._send_json(200, self.fake.poll_command(self.path[len("/status/"):]))
+        else:
+            self._send_json(404, {"@type": "generic_error", "error_code": 40400, "message": "Not found"})
+
+    def do_POST(self):
+        body = self._read_body()
+        self.fake.record(self, body)
+        if self._inject_failure(self.path):
+            return
+        handler = {
+            "/ksql": self.handle_ksql,
+            "/query": self.handle_query,
+            "/query-stream": self.handle_query_stream,
+            "/inserts-stream": self.handle_inserts_stream,
+            "/close-query": self.handle_close_query,
+        }.get(self.path)
+        if handler is None:
+            self._send_json(404, {"@type": "generic_error", "error_code": 40400, "message": "Not found"})
+            return
+        try:
+            handler(body)
+        except (BrokenPipeError, ConnectionResetError, Disconnect):
+            self.close_connection = True
+
+    def handle_ksql(self, body):
+        statements = [s.strip() for s in json.loads(body)["ksql"].split(";") if s.strip()]
+        if any(statement.upper().startswith(("SHOW QUERIES", "LIST QUERIES")) for statement in statements):
+            self._stream_listing(statements)
+            return
+        entities = []
+        for statement in statements:
+            command_id = "stream/{}/create".format(uuid.uuid4().hex[:8])
+            entities.append(
+                {
+                    "@type": "currentStatus",
+                    "statementText": statement + ";",
+                    "commandId": command_id,
+                    "commandStatus": self.fake.command_status(command_id),
+                    "commandSequenceNumber": self.fake.next_sequence_number(),
+                    "warnings": [],
+                }
+            )
+        self._send_json(200, entities)
+
+    def _stream_listing(self, statements, batch_bytes=65536):
+        """ Stream ``queries`` listings chunk by chunk, without rendering the whole response in memory. """
+        self._start_chunked()
+        pending = [b"["]
+        size = 1
+        for number, statement in enumerate(statements):
+            head = {"@type": "queries", "statementText": statement + ";", "warnings": []}
+            pending.append((b"," if number else b"") + json.dumps(head)[:-1].encode("utf-8") + b', "queries": [')
+            for index in range(self.fake.stream.rows or 0):
+                item = json.dumps(self.fake.query_description(index)).encode("utf-8")
+                pending.append(b"," + item if index else item)
+                size += len(item) + 1
+                if size >= batch_bytes:
+                    self._write_chunk(b"".join(pending))
+                    pending, size = [], 0
+            pending.append(b"]}")
+        pending.append(b"]")
+        self._write_chunk(b"".join(pending))
+        self._end_chunked()
+
+    def _stream_rows(self, frame_row, stream, shard=None):
+        disconnect_after = self.fake.faults.disconnect_after
+        if disconnect_after is not None and not self.fake.take_failure():
+            disconnect_after = None
+        interval = 1.0 / stream.rate if stream.rate else None
+        started = time.time()
+        index = 0
+        while stream.rows is None or index < stream.rows:
+            if disconnect_after is not None and index >= disconnect_after:
+                self._disconnect()
+            if interval is not None:
+                delay = started + index * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            last = stream.rows is not None and index == stream.rows - 1
+            if shard is None or index % stream.partitions % shard[0] == shard[1]:
+                self._write_chunk(frame_row(make_columns(index, stream.row_size), last))
+            index += 1
+            if stream.heartbeat_every and index % stream.heartbeat_every == 0 and not last:
+                self._write_chunk(b"\n")
+        for _ in range(stream.trailing_heartbeats):
+            time.sleep(stream.heartbeat_interval)
+            self._write_chunk(b"\n")
+
+    def handle_query(self, body):
+        stream = self.fake.stream
+        sql = json.loads(body)["ksql"]
+        if stream.window_size:
+            self._pull_windows(sql, stream)
+            return
+        keys = parse_keys(sql)
+        if keys is not None:
+            rows = [make_columns(key, stream.row_size) for key in keys if 0 <= key < (stream.rows or 0)]
+            self._pull_rows(COLUMNS, rows)
+            return
+        query_id = "transient_{}".format(uuid.uuid4().hex[:8])
+        schema = ", ".join("`{}` {}".format(name, kind) for name, kind in COLUMNS)
+        self._start_chunked()
+        header = [{"header": {"queryId": query_id, "schema": schema}}]
+        self._write_chunk(json.dumps(header)[:-1].encode("utf-8") + b",\n")
+
+        def frame_row(columns, last):
+            suffix = b"]\n" if last else b",\n"
+            return json.dumps({"row": {"columns": columns}}).encode("utf-8") + suffix
+
+        self._stream_rows(frame_row, stream, parse_shard(json.loads(body)["ksql"]))
+        if stream.rows == 0:
+            self._write_chunk(b"]\n")
+        self._end_chunked()
+
+    def _pull_windows(self, sql, stream):
+        start, end = parse_window_range(sql) or (0, stream.rows * stream.window_size)
+        windows = [
+            window
+            for window in range(0, stream.rows * stream.window_size, stream.window_size)
+            if start <= window < end
+        ]
+        rows = [
+            [window // stream.window_size % 3, window, window + stream.window_size, window]
+            for window in reversed(windows)
+        ]
+        self._pull_rows(WINDOWED_COLUMNS, rows)
+
+    def _pull_rows(self, columns, rows):
+        """ Answer a pull query with all its rows in one chunk. """
+        schema = ", ".join("`{}` {}".format(name, kind) for name, kind in columns)
+        header = [{"header": {"queryId": "pull_{}".format(uuid.uuid4().hex[:8]), "schema": schema}}]
+        lines = [json.dumps(header)[:-1]]
+        for row in rows:
+            lines.append(json.dumps({"row": {"columns": row}}))
+        self._start_chunked()
+        self._write_chunk((",\n".join(lines) + "]\n").encode("utf-8"))
+        self._end_chunked()
+
+    def handle_query_stream(self, body):
+        stream = self.fake.stream
+        header = {
+            "queryId": str(uuid.uuid4()),
+            "columnNames": [name for name, _ in COLUMNS],
+            "columnTypes": [kind for _, kind in COLUMNS],
+        }
+        self._start_chunked()
+        self._write_chunk(json.dumps(header).encode("utf-8") + b"\n")
+
+        def frame_row(columns, last):
+            return json.dumps(columns).encode("utf-8") + b"\n"
+
+        self._stream_rows(frame_row, stream, parse_shard(json.loads(body)["sql"]))
+        self._end_chunked()
+
+    def handle_inserts_stream(self, body):
+        lines = body.decode("utf-8").split("\n")
+        self._start_chunked()
+        for seq, line in enumerate(lines[1:]):
+            if line:
+                self._write_chunk(json.dumps({"status": "ok", "seq": seq}).encode("utf-8") + b"\n")
+        self._end_chunked()
+
+    def handle_close_query(self, body):
+        self._send_json(200, {})
+
+
+class FakeKSQLServer(object):
+    """
+    Runs a fake ksqlDB server on a background thread.
+
+    Use it as a context manager, ``url`` points at the bound port:
+
+        with FakeKSQLServer(stream=StreamConfig(rows=100), faults=Faults(chunk_size=7)) as server:
+            client = KSQLAPI(server.url)
+
+    """
+
+    handler_class = FakeKSQLHandler
+
+    def __init__(
+        self, stream=None, faults=None, version="0.10.1", host="127.0.0.1", port=0, ssl_context=None, command_polls=0
+    ):
+        self.stream = stream or StreamConfig()
+        self.faults = faults or Faults()
+        self.version = version
+        # commands stay QUEUED for this many /status polls, like DDL still being applied
+        self.command_polls = command_polls
+        self._pending_commands = {}
+        self.requests = []
+        self._sequence_number = 0
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self.handler_class)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self.ssl_context = ssl_context
+        if ssl_context is not None:
+            self._httpd.socket = ssl_context.wrap_socket(self._httpd.socket, server_side=True)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        scheme = "https" if self.ssl_context is not None else "http"
+        return "{}://{}:{}".format(scheme, host, port)
+
+    def record(self, handler, body=b""):
+        with self._lock:
+            self.requests.append((handler.command, handler.path, body))
+
+    def query_description(self, index):
+        return {
+            "queryString": "CREATE STREAM S_{0} AS SELECT * FROM SOURCE EMIT CHANGES;".format(index),
+            "sinks": ["S_{}".format(index)],
+            "id": "CSAS_S_{}_{}".format(index, index),
+            "queryType": "PERSISTENT",
+            "state": "RUNNING",
+        }
+
+    def command_status(self, command_id=None):
+        if self.faults.command_error and self.take_failure():
+            return {"status": "ERROR", "message": self.faults.command_error}
+        if self.command_polls and command_id is not None:
+            with self._lock:
+                self._pending_commands[command_id] = self.command_polls
+            return {"status": "QUEUED", "message": "Statement written to command topic"}
+        return {"status": "SUCCESS", "message": "Executed"}
+
+    def poll_command(self, command_id):
+        with self._lock:
+            remaining = self._pending_commands.get(command_id, 0)
+            if remaining:
+                self._pending_commands[command_id] = remaining - 1
+                return {"status": "EXECUTING", "message": "Executing statement"}
+        return {"status": "SUCCESS", "message": "Executed"}
+
+    def take_failure(self):
+        with self._lock:
+            if self.faults.fail_requests is not None and self._failures >= self.faults.fail_requests:
+                return False
+            self._failures += 1
+            return True
+
+    def next_sequence_number(self):
+        with self._lock:
+            self._sequence_number += 1
+            return self._sequence_number
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,436 @@
+"""
+Benchmarks for the client, run against the in-process fake server.
+
+Run from the repository root:
+
+    python -m tests.benchmarks.run                    # run everything and compare against the baselines
+    python -m tests.benchmarks.run query sql_builder  # run a subset
+    python -m tests.benchmarks.run --save             # store the results as the new baselines
+    python -m tests.benchmarks.run query --chunk-size 7 --latency 0.05
+    python -m tests.benchmarks.run import_time        # python -X importtime -c "import ksql", target 10 ms
+
+Faults (latency, bandwidth, chunk boundaries) can be injected to measure the client under degraded conditions.
+
+Throughput is compared against ``baselines.json``; a benchmark slower than its baseline by more than
+``--tolerance`` is reported as a regression and makes the run exit with a non-zero status, as does a benchmark that
+fails. Benchmarks whose optional dependency can't be imported are reported as skipped, and saved as such in the
+baselines until a host that has it saves their numbers. Baselines are machine specific, refresh them with ``--save``
+when moving to a different host.
+
+The fake server only speaks HTTP/1.1: the ``/query-stream`` and ``/inserts-stream`` benchmarks measure those
+endpoints' framing and the client, not HTTP/2 itself.
+
+"""
+import argparse
+import importlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from tests.benchmarks.fake_server import COLUMNS, FakeKSQLServer, Faults, StreamConfig
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+# Cumulative ``python -X importtime -c "import ksql"`` budget for the ksql package itself.
+IMPORT_TIME_TARGET_MS = 10
+BENCHMARKS = {}
+HTTP1_NOTE = "the fake server answers in HTTP/1.1, this is not an HTTP/2 measurement"
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+
+    return register
+
+
+def require(module):
+    """ Import an optional dependency, raising an ImportError naming it when it can't be used on this host. """
+    try:
+        importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError("{} can't be imported: {}".format(module, re.sub(r" \(.*\)$", "", str(e))))
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {"p{}".format(p): ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def measure(run, rows):
+    """
+    Call ``run()`` twice, once for throughput and once under tracemalloc for the memory peak.
+
+    ``run`` returns a list of per-item latencies in seconds, which may be empty.
+
+    """
+    started = time.perf_counter()
+    latencies = run()
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {"items_per_sec": round(rows / elapsed, 1), "seconds": round(elapsed, 4), "peak_memory_bytes": peak}
+    result.update({"latency_{}_ms".format(k): round(v * 1000, 3) for k, v in percentiles(latencies).items()})
+    return result
+
+
+def fake_server(options, stream=None):
+    faults = Faults(latency=options.latency, bandwidth=options.bandwidth, chunk_size=options.chunk_size)
+    return FakeKSQLServer(stream=stream, faults=faults)
+
+
+def stream_latencies(rows, sent_at):
+    latencies = []
+    for row in rows:
+        received = time.time()
+        latencies.append(received - sent_at(row))
+    return latencies
+
+
+@benchmark("query")
+def bench_query(options):
+    from ksql import KSQLAPI
+
+    stream = StreamConfig(rows=options.rows, row_size=options.row_size, heartbeat_every=options.heartbeat_every)
+    with fake_server(options, stream) as server:
+        client = KSQLAPI(server.url, check_version=False)
+        rows = lambda: client.query("select * from bench emit changes", return_objects=True)  # noqa: E731
+        return measure(lambda: stream_latencies(rows(), lambda row: row["SENT_AT"]), options.rows)
+
+
+@benchmark("query_compressed")
+def bench_query_compressed(options):
+    from ksql import KSQLAPI
+
+    stream = StreamConfig(rows=options.rows, row_size=options.row_size, heartbeat_every=options.heartbeat_every)
+    with fake_server(options, stream) as server:
+        client = KSQLAPI(server.url, check_version=False, compression=True)
+        rows = lambda: client.query("select * from bench emit changes", return_objects=True)  # noqa: E731
+        result = measure(lambda: stream_latencies(rows(), lambda row: row["SENT_AT"]), options.rows)
+    stats = client.compression_stats
+    # measure() runs the query twice
+    result["wire_bytes_per_row"] = round(stats.wire_bytes / options.rows / 2, 1)
+    result["decoded_bytes_per_row"] = round(stats.decoded_bytes / options.rows / 2, 1)
+    result["decompress_cpu_seconds"] = round(stats.cpu_seconds / 2, 4)
+    return result
+
+
+@benchmark("query2")
+def bench_query2(options):
+    from ksql import KSQLAPI
+
+    require("hyper")
+
+    stream = StreamConfig(rows=options.rows, row_size=options.row_size, heartbeat_every=options.heartbeat_every)
+    with fake_server(options, stream) as server:
+        client = KSQLAPI(server.url, check_version=False)
+
+        def run():
+            chunks = client.query("select * from bench emit changes", use_http2=True)
+            next(chunks)  # header
+            return stream_latencies(chunks, lambda chunk: json.loads(chunk)[1])
+
+        return dict(measure(run, options.rows), note=HTTP1_NOTE)
+
+
+def query_lines(rows, row_size):
+    """ The raw lines of a ``/query`` response streaming ``rows`` rows. """
+    schema = ", ".join("`{}` {}".format(name, kind) for name, kind in COLUMNS)
+    header = json.dumps([{"header": {"queryId": "bench", "schema": schema}}])[:-1] + ",\n"
+    lines = [header]
+    for index in range(rows):
+        suffix = "]\n" if index == rows - 1 else ",\n"
+        lines.append(json.dumps({"row": {"columns": [index, 0.0, "x" * row_size]}}) + suffix)
+    return lines
+
+
+def row_id(row):
+    # picklable transform for the parallel_decode_wide benchmark
+    return row["ID"]
+
+
+@benchmark("process_query_result")
+def bench_process_query_result(options):
+    from ksql.utils import process_query_result
+
+    lines = query_lines(options.rows, options.row_size)
+
+    def run():
+        for _ in process_query_result(iter(lines), return_objects=True):
+            pass
+        return []
+
+    return measure(run, options.rows)
+
+
+@benchmark("parallel_decode")
+def bench_parallel_decode(options):
+    from ksql.parallel import ParallelDecoder
+
+    lines = query_lines(options.rows, options.row_size)
+
+    def run():
+        for _ in ParallelDecoder(iter(lines), batch_size=1000):
+            pass
+        return []
+
+    return measure(run, options.rows)
+
+
+@benchmark("parallel_decode_wide")
+def bench_parallel_decode_wide(options):
+    """
+    The case ``ParallelDecoder`` is meant for: rows 64 times wider than ``--row-size`` reduced to their ID by a
+    transform in the workers, with 1, 2 and 4 workers. Compare the ``items_per_sec_*`` with ``serial_items_per_sec``,
+    the rows decoded and transformed in the consumer: the speed-up is bounded by the number of cores of the host.
+
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    from ksql.parallel import ParallelDecoder
+    from ksql.utils import process_query_result
+
+    lines = query_lines(options.rows, options.row_size * 64)
+
+    def serial():
+        for row in process_query_result(iter(lines), return_objects=True):
+            row_id(row)
+        return []
+
+    result = {"serial_items_per_sec": measure(serial, options.rows)["items_per_sec"], "cpus": os.cpu_count()}
+    for workers in (1, 2, 4):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # start the workers before measuring
+            list(executor.map(abs, range(workers)))
+
+            def run():
+                for _ in ParallelDecoder(iter(lines), processes=workers, transform=row_id, executor=executor):
+                    pass
+                return []
+
+            measured = measure(run, options.rows)
+        result["items_per_sec_{}_workers".format(workers)] = measured["items_per_sec"]
+    # the 4 workers run is the one compared with the baseline
+    measured.update(result)
+    scaling = ", ".join(
+        "{} {:.0f}/s".format(label, result[key])
+        for label, key in (
+            ("serial", "serial_items_per_sec"),
+            ("1 worker", "items_per_sec_1_workers"),
+            ("2 workers", "items_per_sec_2_workers"),
+            ("4 workers", "items_per_sec_4_workers"),
+        )
+    )
+    return dict(measured, note="{} on {} CPUs".format(scaling, result["cpus"]))
+
+
+@benchmark("inserts_stream")
+def bench_inserts_stream(options):
+    from ksql import KSQLAPI
+
+    require("hyper")
+
+    rows = [{"ID": index, "PAYLOAD": "x" * options.row_size} for index in range(options.rows)]
+    with fake_server(options) as server:
+        client = KSQLAPI(server.url, check_version=False)
+
+        def run():
+            client.inserts_stream("bench", rows)
+            return []
+
+        return dict(measure(run, options.rows), note=HTTP1_NOTE)
+
+
+def bench_listing(iterative):
+    def run_benchmark(options):
+        from ksql import KSQLAPI
+
+        with fake_server(options, StreamConfig(rows=options.rows)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+
+            def run():
+                if iterative:
+                    for _ in client.ksql_iter("SHOW QUERIES EXTENDED;"):
+                        pass
+                else:
+                    client.ksql("SHOW QUERIES EXTENDED;")
+                return []
+
+            return measure(run, options.rows)
+
+    return run_benchmark
+
+
+benchmark("ksql_listing")(bench_listing(iterative=False))
+benchmark("ksql_iter_listing")(bench_listing(iterative=True))
+
+
+@benchmark("file_upload")
+def bench_file_upload(options):
+    from ksql.upload import FileUpload
+
+    statements = max(1, options.rows // 100)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.ksql")
+        with open(path, "w") as f:
+            for index in range(statements):
+                f.write("CREATE STREAM bench_{} (id BIGINT)\n".format(index))
+                f.write("  WITH (kafka_topic='bench', value_format='JSON');\n")
+        with fake_server(options) as server:
+            uploader = FileUpload(server.url, check_version=False)
+
+            def run():
+                # the statements are batched, there is no latency per statement
+                uploader.upload(path)
+                return []
+
+            return measure(run, statements)
+
+
+@benchmark("sql_builder")
+def bench_sql_builder(options):
+    from ksql.builder import SQLBuilder
+
+    def run():
+        for index in range(options.rows):
+            SQLBuilder.build(
+                sql_type="create_as",
+                table_type="stream",
+                table_name="bench_{}".format(index),
+                select_columns=["id", "payload"],
+                src_table="source",
+                kafka_topic="bench",
+                value_format="JSON",
+                conditions=["id > 10"],
+                partition_by="id",
+            )
+        return []
+
+    return measure(run, options.rows)
+
+
+def bench_codec(name):
+    def run_benchmark(options):
+        from ksql.codec import get_codec
+
+        codec = get_codec(name)
+        rows = [{"row": {"columns": [index, 0.0, "x" * options.row_size]}} for index in range(options.rows)]
+        encoded = [codec.dumps(row) for row in rows]
+
+        def run():
+            for row in rows:
+                codec.dumps(row)
+            for data in encoded:
+                codec.loads(data)
+            return []
+
+        return measure(run, options.rows)
+
+    return run_benchmark
+
+
+for codec_name in ("json", "orjson", "ujson", "simdjson"):
+    benchmark("codec_{}".format(codec_name))(bench_codec(codec_name))
+
+
+@benchmark("import_time")
+def bench_import_time(options):
+    samples = []
+    for _ in range(20):
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import ksql"], stderr=subprocess.PIPE, check=True
+        ).stderr.decode("utf-8")
+        ksql_line = [line for line in output.splitlines() if line.rstrip().endswith("| ksql")][-1]
+        samples.append(int(ksql_line.split("|")[1]) / 1000.0)
+    median = percentiles(samples, points=(50,))["p50"]
+    if median > IMPORT_TIME_TARGET_MS:
+        print("import_time            over the {} ms target".format(IMPORT_TIME_TARGET_MS))
+    return {
+        "items_per_sec": round(1000.0 / median, 1),
+        "import_ms": round(median, 3),
+        "peak_memory_bytes": 0,
+    }
+
+
+def compare(name, result, baselines, tolerance):
+    baseline = baselines.get(name)
+    if not baseline or "items_per_sec" not in baseline:
+        return "no baseline"
+    ratio = result["items_per_sec"] / baseline["items_per_sec"]
+    status = "REGRESSION" if ratio < 1 - tolerance else "ok"
+    return "{} ({:+.1%} vs baseline)".format(status, ratio - 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="Benchmarks to run: {}".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--row-size", type=int, default=64)
+    parser.add_argument("--heartbeat-every", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.0, help="Injected per-request latency in seconds")
+    parser.add_argument("--bandwidth", type=int, default=None, help="Throttle responses to this many bytes/s")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Split frames into chunks of this size")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baselines")
+    options = parser.parse_args(argv)
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    results = {}
+    skipped = {}
+    regressions = 0
+    failures = 0
+    for name in options.names or list(BENCHMARKS):
+        try:
+            result = BENCHMARKS[name](options)
+        except ImportError as e:
+            # an optional dependency this host doesn't have
+            print("{:<22} skipped: {}".format(name, e))
+            skipped[name] = "missing dependency: {}".format(e)
+            continue
+        except Exception as e:
+            print("{:<22} failed: {!r}".format(name, e))
+            failures += 1
+            continue
+        note = result.pop("note", None)
+        results[name] = result
+        verdict = compare(name, result, baselines, options.tolerance)
+        regressions += verdict.startswith("REGRESSION")
+        latency = " ".join("{}={:.2f}ms".format(k[8:], v) for k, v in result.items() if k.startswith("latency_"))
+        print(
+            "{:<22} {:>12.0f} items/s  peak {:>8.0f} KiB  {}  {}".format(
+                name, result["items_per_sec"], result["peak_memory_bytes"] / 1024, latency, verdict
+            )
+        )
+        if note:
+            print("{:<22} note: {}".format("", note))
+
+    if options.save:
+        baselines.update(results)
+        for name, reason in skipped.items():
+            # numbers saved on a host that has the dependency are kept
+            if "items_per_sec" not in baselines.get(name, {}):
+                baselines[name] = {"skipped": reason}
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    return 1 if regressions or failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
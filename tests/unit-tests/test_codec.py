@@ -0,0 +1,54 @@
+import unittest
+
+from ksql import KSQLAPI
+from ksql.codec import JSONCodec, available_codecs, get_codec
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+
+class CountingCodec(JSONCodec):
+    def __init__(self):
+        self.loads_calls = 0
+
+    def loads(self, data):
+        self.loads_calls += 1
+        return super(CountingCodec, self).loads(data)
+
+
+class TestCodec(unittest.TestCase):
+    def test_default_is_stdlib(self):
+        self.assertEqual(get_codec().name, "json")
+
+    def test_auto_picks_an_available_codec(self):
+        self.assertEqual(get_codec("auto").name, available_codecs()[0])
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            get_codec("yaml")
+
+    def test_instance_is_passed_through(self):
+        codec = CountingCodec()
+        self.assertIs(get_codec(codec), codec)
+
+    def test_round_trip_for_every_available_codec(self):
+        row = {"ID": 1, "NAME": "café", "VALUES": [1.5, None, True]}
+        for name in available_codecs():
+            codec = get_codec(name)
+            encoded = codec.dumps(row)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(codec.loads(encoded), row, name)
+
+    def test_ksql_response_is_parsed_once(self):
+        codec = CountingCodec()
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False, codec=codec)
+            result = client.ksql("show streams;")
+        self.assertEqual(result[0]["commandStatus"]["status"], "SUCCESS")
+        self.assertEqual(codec.loads_calls, 1)
+
+    def test_rows_are_decoded_with_the_codec(self):
+        codec = CountingCodec()
+        with FakeKSQLServer(stream=StreamConfig(rows=5)) as server:
+            client = KSQLAPI(server.url, check_version=False, codec=codec)
+            rows = list(client.query("select * from foo emit changes", return_objects=True))
+        self.assertEqual([row["ID"] for row in rows], list(range(5)))
+        self.assertEqual(codec.loads_calls, 5)
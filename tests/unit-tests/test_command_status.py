@@ -0,0 +1,51 @@
+import time
+import unittest
+
+from ksql import KSQLAPI
+from ksql.errors import CommandTimeoutError, KSQLError
+from tests.benchmarks.fake_server import FakeKSQLServer, Faults
+
+
+class TestCommandStatus(unittest.TestCase):
+    def status_polls(self, server):
+        return [path for command, path, body in server.requests if path.startswith("/status/")]
+
+    def test_create_as_waits_for_command(self):
+        with FakeKSQLServer(command_polls=3) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            started = time.time()
+            self.assertTrue(client.create_stream_as("foo", ["id"], "bar"))
+            polls = self.status_polls(server)
+        self.assertEqual(len(polls), 4)
+        self.assertTrue(polls[0].startswith("/status/stream/"))
+        self.assertLess(time.time() - started, 1)
+
+    def test_no_poll_when_already_done(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            client.create_stream_as("foo", ["id"], "bar")
+            self.assertEqual(self.status_polls(server), [])
+
+    def test_wait_for_commands_updates_status(self):
+        with FakeKSQLServer(command_polls=1) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            entities = client.ksql("CREATE STREAM foo (id INT) WITH (kafka_topic='foo', value_format='JSON');")
+            self.assertEqual(entities[0]["commandStatus"]["status"], "QUEUED")
+            client.sa.wait_for_commands(entities)
+        self.assertEqual(entities[0]["commandStatus"]["status"], "SUCCESS")
+
+    def test_timeout(self):
+        with FakeKSQLServer(command_polls=1000) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            entities = client.ksql("CREATE STREAM foo (id INT) WITH (kafka_topic='foo', value_format='JSON');")
+            with self.assertRaises(CommandTimeoutError) as e:
+                client.sa.wait_for_commands(entities, timeout=0.1, max_poll_interval=0.02)
+        self.assertEqual(e.exception.command_id, entities[0]["commandId"])
+        self.assertEqual(e.exception.status["status"], "EXECUTING")
+
+    def test_command_error(self):
+        with FakeKSQLServer(faults=Faults(command_error="Topic does not exist")) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            with self.assertRaises(KSQLError) as e:
+                client.create_stream_as("foo", ["id"], "bar")
+        self.assertIn("Topic does not exist", e.exception.msg)
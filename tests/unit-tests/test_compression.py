@@ -0,0 +1,85 @@
+import json
+import sys
+import threading
+import unittest
+import zlib
+
+from ksql import KSQLAPI
+from ksql.errors import KSQLError
+from ksql.compression import CompressionStats, Decompressor, compress, iter_lines
+from tests.benchmarks.fake_server import FakeKSQLServer, Faults, StreamConfig
+
+
+class TestCompression(unittest.TestCase):
+    def test_streaming_decompression(self):
+        data = b"".join(json.dumps({"row": {"columns": [i, "x" * 50]}}).encode("utf-8") + b"\n" for i in range(100))
+        for encoding in ("gzip", "deflate"):
+            compressed = compress(data, encoding)
+            chunks = [compressed[i:i + 13] for i in range(0, len(compressed), 13)]
+            stats = CompressionStats()
+            decoded = b"".join(Decompressor(encoding, stats).iter_decompress(chunks))
+            self.assertEqual(decoded, data)
+            self.assertEqual(stats.decoded_bytes, len(data))
+            self.assertGreater(stats.bytes_saved, 0)
+
+    def test_raw_deflate(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        compressed = compressor.compress(b"hello") + compressor.flush()
+        self.assertEqual(Decompressor("deflate").decompress(compressed), b"hello")
+
+    def test_identity(self):
+        self.assertEqual(Decompressor(None).decompress(b"abc"), b"abc")
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(ValueError):
+            Decompressor("br")
+
+    def test_stats_shared_by_threads(self):
+        stats = CompressionStats()
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [
+                threading.Thread(target=lambda: [stats.record(1, 2, 0.0) for _ in range(20000)]) for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(stats.as_dict()["wire_bytes"], 80000)
+        self.assertEqual(stats.decoded_bytes, 160000)
+
+    def test_iter_lines(self):
+        self.assertEqual(list(iter_lines([b"a\nb", b"c\n\n", b"d"])), [b"a\n", b"bc\n", b"\n", b"d"])
+
+
+class TestCompressedClient(unittest.TestCase):
+    def test_ksql(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False, compression=True)
+            result = client.ksql("show streams;")
+        self.assertEqual(result[0]["commandStatus"]["status"], "SUCCESS")
+        self.assertGreater(client.compression_stats.decoded_bytes, 0)
+
+    def test_query_with_heartbeats(self):
+        stream = StreamConfig(rows=50, row_size=200, heartbeat_every=10)
+        with FakeKSQLServer(stream=stream, faults=Faults(chunk_size=5)) as server:
+            client = KSQLAPI(server.url, check_version=False, compression=True)
+            rows = list(client.query("select * from foo emit changes", return_objects=True))
+        self.assertEqual([row["ID"] for row in rows], list(range(50)))
+        self.assertLess(client.compression_stats.ratio, 0.5)
+
+    def test_ksql_iter(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=100)) as server:
+            client = KSQLAPI(server.url, check_version=False, compression=True)
+            queries = list(client.ksql_iter("SHOW QUERIES;", chunk_size=100))
+        self.assertEqual(len(queries), 100)
+
+    def test_error_body(self):
+        with FakeKSQLServer(faults=Faults(statement_error="boom")) as server:
+            client = KSQLAPI(server.url, check_version=False, compression=True)
+            with self.assertRaises(KSQLError) as e:
+                client.ksql("show streams;")
+        self.assertEqual(e.exception.msg, "boom")
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+import unittest
+
+HEAVY_MODULES = ["requests", "hyper", "urllib.request", "http.client", "telnetlib"]
+
+
+def imported_after(statement):
+    script = "import sys; {}; print(' '.join(m for m in {!r} if m in sys.modules))".format(statement, HEAVY_MODULES)
+    return subprocess.check_output([sys.executable, "-c", script]).decode("utf-8").split()
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_import_ksql_does_not_load_transports(self):
+        self.assertEqual(imported_after("import ksql"), [])
+
+    def test_sql_builder_does_not_load_transports(self):
+        self.assertEqual(imported_after("from ksql import SQLBuilder"), [])
+
+    def test_client_is_importable_from_package(self):
+        self.assertEqual(imported_after("from ksql import KSQLAPI, SimplifiedAPI"), [])
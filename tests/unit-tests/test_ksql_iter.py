@@ -0,0 +1,60 @@
+import json
+import unittest
+
+from ksql import KSQLAPI
+from ksql.errors import KSQLError
+from ksql.utils import iter_json_array
+from tests.benchmarks.fake_server import FakeKSQLServer, Faults, StreamConfig
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestIterJsonArray(unittest.TestCase):
+    def test_elements_across_chunk_boundaries(self):
+        elements = [{"a": 1, "b": 'ü"\\' * 3}, {"c": [1, {"x": "]"}]}, 12, "x", [], {}, True, None, -1.5e3]
+        data = json.dumps(elements).encode("utf-8")
+        for size in (1, 2, 7, 1000):
+            self.assertEqual(list(iter_json_array(split(data, size))), elements)
+
+    def test_empty(self):
+        self.assertEqual(list(iter_json_array([b"[", b"]"])), [])
+        self.assertEqual(list(iter_json_array([])), [])
+
+    def test_expand_listing(self):
+        data = json.dumps(
+            [{"@type": "queries", "queries": [{"id": 1}, {"id": 2}], "warnings": []}, {"@type": "currentStatus"}]
+        ).encode("utf-8")
+        actual = list(iter_json_array(split(data, 5), expand=("queries",)))
+        self.assertEqual(actual, [{"id": 1}, {"id": 2}, {"@type": "currentStatus"}])
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[{"a": 1}, {"b"']))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"a": 1}']))
+
+
+class TestKsqlIter(unittest.TestCase):
+    def test_yields_listing_items(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=50)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            queries = list(client.ksql_iter("SHOW QUERIES EXTENDED;", chunk_size=64))
+            entities = client.ksql("SHOW QUERIES EXTENDED;")
+        self.assertEqual(queries, entities[0]["queries"])
+
+    def test_yields_entities(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            entities = list(client.ksql_iter("DROP STREAM a; DROP STREAM b;"))
+        self.assertEqual([e["statementText"] for e in entities], ["DROP STREAM a;", "DROP STREAM b;"])
+
+    def test_raises_on_error_status(self):
+        with FakeKSQLServer(faults=Faults(command_error="boom")) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            with self.assertRaises(KSQLError) as e:
+                list(client.ksql_iter("DROP STREAM a;"))
+        self.assertEqual(e.exception.msg, "boom")
@@ -0,0 +1,112 @@
+import json
+import os
+import tempfile
+import unittest
+
+from ksql import KSQLAPI
+from ksql.api import split_entities
+from ksql.errors import KSQLError
+from ksql.upload import FileUpload
+from tests.benchmarks.fake_server import FakeKSQLServer, Faults
+
+STATEMENTS = [
+    "CREATE STREAM s{} (id INT) WITH (kafka_topic='t{}', value_format='JSON');".format(i, i) for i in range(7)
+]
+
+
+class TestKsqlMany(unittest.TestCase):
+    def ksql_bodies(self, server):
+        return [json.loads(body) for command, path, body in server.requests if path == "/ksql"]
+
+    def test_batches_and_splits_per_statement(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.ksql_many(STATEMENTS, max_statements=3)
+            bodies = self.ksql_bodies(server)
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(len(results), len(STATEMENTS))
+        for statement, entities in zip(STATEMENTS, results):
+            self.assertEqual(len(entities), 1)
+            self.assertEqual(entities[0]["statementText"], statement)
+
+    def test_max_bytes(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            client.ksql_many(STATEMENTS, max_bytes=len(STATEMENTS[0]) * 2 + 2)
+            bodies = self.ksql_bodies(server)
+        self.assertEqual(len(bodies), 4)
+
+    def test_max_bytes_counts_encoded_bytes(self):
+        statements = ["INSERT INTO s (name) VALUES ('{}');".format("\u00e9" * 20) for _ in range(4)]
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            # two statements fit in characters, not in bytes
+            client.ksql_many(statements, max_bytes=len(statements[0]) * 2 + 2)
+            bodies = self.ksql_bodies(server)
+        self.assertEqual(len(bodies), 4)
+
+    def test_forwards_command_sequence_number(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.ksql_many(STATEMENTS, max_statements=4)
+            bodies = self.ksql_bodies(server)
+        self.assertNotIn("commandSequenceNumber", bodies[0])
+        last_of_first_batch = results[3][0]["commandSequenceNumber"]
+        self.assertEqual(bodies[1]["commandSequenceNumber"], last_of_first_batch)
+        self.assertEqual(client.sa.command_sequence_number, results[-1][0]["commandSequenceNumber"])
+
+    def test_file_upload_uses_one_request(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".ksql", delete=False) as f:
+            f.write("\n".join(STATEMENTS[:3]))
+        try:
+            with FakeKSQLServer() as server:
+                results = FileUpload(server.url, check_version=False).upload(f.name)
+                bodies = self.ksql_bodies(server)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(len(results), 3)
+
+    def test_file_upload_fails_by_batch(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".ksql", delete=False) as f:
+            f.write("\n".join(STATEMENTS[:3]))
+        try:
+            with FakeKSQLServer(faults=Faults(statement_error="Invalid statement")) as server:
+                with self.assertRaises(KSQLError):
+                    FileUpload(server.url, check_version=False).upload(f.name)
+                bodies = self.ksql_bodies(server)
+        finally:
+            os.remove(f.name)
+        # the whole batch was rejected in one request
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(bodies[0]["ksql"].count(";"), 3)
+
+
+class TestSplitEntities(unittest.TestCase):
+    def test_matches_statement_text(self):
+        statements = ["show streams;", "CREATE  STREAM foo (id INT);"]
+        entities = [
+            {"statementText": "SHOW STREAMS;", "streams": []},
+            {"statementText": "CREATE STREAM foo (id INT);"},
+            {"@type": "warning"},
+        ]
+        result = split_entities(statements, entities)
+        self.assertEqual(result, [[entities[0]], entities[1:]])
+
+    def test_positional_when_one_entity_each(self):
+        entities = [{"statementText": "x"}, {"statementText": "y"}]
+        self.assertEqual(split_entities(["a;", "b;"], entities), [[entities[0]], [entities[1]]])
+
+    def test_statements_without_or_with_several_entities(self):
+        statements = ["SET 'a'='b';", "CREATE STREAM foo (id INT);", "SHOW STREAMS;"]
+        entities = [
+            {"statementText": "CREATE STREAM foo (id INT);"},
+            {"statementText": "SHOW STREAMS;", "streams": []},
+            {"statementText": "SHOW STREAMS;", "streams": []},
+        ]
+        self.assertEqual(split_entities(statements, entities), [[], [entities[0]], entities[1:]])
+
+    def test_identical_statements_in_order(self):
+        statements = ["DROP STREAM a;", "DROP STREAM a;"]
+        entities = [{"statementText": "DROP STREAM a;", "n": 1}, {"statementText": "DROP STREAM a;", "n": 2}]
+        self.assertEqual(split_entities(statements, entities), [[entities[0]], [entities[1]]])
@@ -0,0 +1,130 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from ksql import KSQLAPI
+from ksql.materialized import MaterializedView
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+SCHEMA = "`ID` BIGINT KEY, `REGION` STRING, `TOTAL` BIGINT"
+HEADER = json.dumps([{"header": {"queryId": "q", "schema": SCHEMA}}])[:-1] + ",\n"
+
+
+def row(*columns, **flags):
+    return json.dumps({"row": dict({"columns": list(columns)}, **flags)}) + ",\n"
+
+
+class TestMaterializedView(unittest.TestCase):
+    def view(self, *lines, **kwargs):
+        view = MaterializedView(None, "totals", indexes=kwargs.pop("indexes", ("REGION",)), **kwargs)
+        for line in (HEADER,) + lines:
+            view.apply(line)
+        return view
+
+    def test_upserts_by_key(self):
+        view = self.view(row(1, "eu", 10), row(2, "us", 5), row(1, "eu", 12))
+        self.assertEqual(len(view), 2)
+        self.assertEqual(view.get(1), {"ID": 1, "REGION": "eu", "TOTAL": 12})
+        self.assertEqual(view.get_tuple(2), (2, "us", 5))
+        self.assertIsNone(view.get(3))
+        self.assertEqual(view.updates, 3)
+
+    def test_tombstone_deletes(self):
+        view = self.view(row(1, "eu", 10), row(1, None, None, tombstone=True))
+        self.assertNotIn(1, view)
+        self.assertEqual(view.lookup("REGION", "eu"), [])
+        self.assertEqual(view.deletes, 1)
+
+    def test_custom_tombstone(self):
+        view = self.view(row(1, "eu", 10), row(1, "eu", None), is_tombstone=lambda row: row["TOTAL"] is None)
+        self.assertEqual(len(view), 0)
+
+    def test_secondary_index_follows_updates(self):
+        view = self.view(row(1, "eu", 10), row(2, "eu", 5), row(1, "us", 12))
+        self.assertEqual([r["ID"] for r in view.lookup("REGION", "eu")], [2])
+        self.assertEqual([r["ID"] for r in view.lookup("REGION", "us")], [1])
+
+    def test_composite_key(self):
+        view = self.view(row(1, "eu", 10), row(1, "us", 3), key_columns=("ID", "REGION"))
+        self.assertEqual(view.get((1, "us"))["TOTAL"], 3)
+        self.assertEqual(len(view), 2)
+
+    def test_query_stream_format(self):
+        view = MaterializedView(None, "totals")
+        view.apply('{"queryId":"q","columnNames":["ID","TOTAL"],"columnTypes":["BIGINT","BIGINT"]}\n')
+        view.apply("[1,10]\n")
+        view.apply("[1,11]\n")
+        self.assertEqual(view.get(1), {"ID": 1, "TOTAL": 11})
+
+    def test_snapshot_warm_start(self):
+        path = os.path.join(tempfile.mkdtemp(), "totals.snapshot")
+        self.view(row(1, "eu", 10), row(2, "us", 5)).save(path)
+        restored = MaterializedView(None, "totals", indexes=("REGION",), snapshot=path)
+        self.assertEqual(restored.get(2), {"ID": 2, "REGION": "us", "TOTAL": 5})
+        self.assertEqual([r["ID"] for r in restored.lookup("REGION", "eu")], [1])
+        # the replayed changelog applies on top of the snapshot
+        for line in (HEADER, row(2, "eu", 6)):
+            restored.apply(line)
+        self.assertEqual(len(restored.lookup("REGION", "eu")), 2)
+        with self.assertRaises(ValueError):
+            MaterializedView(None, "other", snapshot=path)
+
+    def test_follows_push_query(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=200)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            view = MaterializedView(client, "bench").start()
+            deadline = time.time() + 5
+            while len(view) < 200 and time.time() < deadline:
+                time.sleep(0.01)
+            view.stop(timeout=5)
+            body = json.loads([body for command, path, body in server.requests if path == "/query"][0])
+        self.assertEqual(len(view), 200)
+        self.assertEqual(view.get(7)["PAYLOAD"], "x" * 64)
+        self.assertEqual(body["ksql"], "SELECT * FROM bench EMIT CHANGES;")
+        self.assertEqual(body["streamsProperties"], {"auto.offset.reset": "earliest"})
+
+    def test_stop_with_idle_query(self):
+        # one change then nothing for a minute
+        with FakeKSQLServer(stream=StreamConfig(rows=2, rate=1.0 / 60)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            view = MaterializedView(client, "bench").start()
+            deadline = time.time() + 5
+            while not len(view) and time.time() < deadline:
+                time.sleep(0.01)
+            started = time.time()
+            view.stop(timeout=5)
+            self.assertLess(time.time() - started, 1)
+            self.assertFalse(view._thread.is_alive())
+            self.assertEqual(client.active_queries, [])
+        self.assertEqual(len(view), 1)
+
+    def test_decodes_with_client_codec(self):
+        decoded = []
+
+        class Codec(object):
+            def loads(self, data):
+                decoded.append(data)
+                return json.loads(data)
+
+        client = KSQLAPI("http://localhost:8088", check_version=False)
+        client.sa.codec = Codec()
+        view = MaterializedView(client, "totals")
+        for line in (HEADER, row(1, "eu", 10)):
+            view.apply(line)
+        self.assertEqual(view.get(1)["TOTAL"], 10)
+        self.assertEqual(len(decoded), 2)
+
+    def test_save_while_following(self):
+        path = os.path.join(tempfile.mkdtemp(), "bench.snapshot")
+        with FakeKSQLServer(stream=StreamConfig(rows=20000, row_size=8)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            view = MaterializedView(client, "bench").start()
+            deadline = time.time() + 10
+            while len(view) < 20000 and time.time() < deadline:
+                view.save(path)
+            view.stop(timeout=5)
+        restored = MaterializedView(None, "bench", snapshot=path)
+        self.assertGreater(len(restored), 0)
+        self.assertEqual(restored.get(0)["PAYLOAD"], "x" * 8)
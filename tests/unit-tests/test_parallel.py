@@ -0,0 +1,160 @@
+import json
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
+
+from ksql import KSQLAPI
+from ksql.errors import KSQLError
+from ksql.parallel import ParallelDecoder, ShardedQuery, shard_query
+from tests.benchmarks.fake_server import COLUMNS, FakeKSQLServer, Faults, StreamConfig
+
+
+def identifier(row):
+    return row["ID"]
+
+
+def slow_identifier(row):
+    time.sleep(0.005)
+    return row["ID"]
+
+
+class RecordingDecoder(ParallelDecoder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = []
+
+    def _submit(self, executor, batch, columns):
+        entry = super()._submit(executor, batch, columns)
+        self.submitted.append(entry)
+        return entry
+
+
+def stream_lines(count, final_message=False):
+    schema = ", ".join("`{}` {}".format(name, kind) for name, kind in COLUMNS)
+    yield json.dumps([{"header": {"queryId": "q", "schema": schema}}])[:-1] + ",\n"
+    for index in range(count):
+        suffix = "]\n" if index == count - 1 and not final_message else ",\n"
+        yield json.dumps({"row": {"columns": [index, 0.0, "x"]}}) + suffix
+    if final_message:
+        yield json.dumps({"finalMessage": "Limit Reached"}) + "]\n"
+
+
+class TestParallelDecoder(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = ProcessPoolExecutor(max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def test_rows_in_order(self):
+        decoder = ParallelDecoder(stream_lines(1000), processes=2, batch_size=64, executor=self.executor)
+        rows = list(decoder)
+        self.assertEqual([row["ID"] for row in rows], list(range(1000)))
+        self.assertEqual(rows[0], {"ID": 0, "SENT_AT": 0.0, "PAYLOAD": "x"})
+        self.assertEqual(decoder.batches, 16)
+
+    def test_transform_runs_in_workers(self):
+        decoder = ParallelDecoder(stream_lines(10), transform=identifier, batch_size=3, executor=self.executor)
+        self.assertEqual(list(decoder), list(range(10)))
+
+    def test_final_message_ends_the_stream(self):
+        decoder = ParallelDecoder(stream_lines(5, final_message=True), batch_size=2, executor=self.executor)
+        self.assertEqual(len(list(decoder)), 5)
+
+    def test_empty_stream(self):
+        self.assertEqual(list(ParallelDecoder(iter([]), executor=self.executor)), [])
+
+    def test_close_releases_blocks_once_decoded(self):
+        decoder = RecordingDecoder(
+            stream_lines(400), processes=2, batch_size=20, transform=slow_identifier, executor=self.executor
+        )
+        rows = iter(decoder)
+        next(rows)
+        rows.close()
+        wait([future for future, block in decoder.submitted])
+        # batches being decoded when the decoder was closed were not cancelled and could still read their block
+        for future, block in decoder.submitted:
+            if not future.cancelled():
+                self.assertIsNone(future.exception())
+        names = [block.name for future, block in decoder.submitted]
+        deadline = time.time() + 2
+        while time.time() < deadline and any(self.exists(name) for name in names):
+            time.sleep(0.01)
+        self.assertFalse(any(self.exists(name) for name in names))
+
+    @staticmethod
+    def exists(name):
+        try:
+            block = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return False
+        resource_tracker.unregister(block._name, "shared_memory")
+        block.close()
+        return True
+
+    def test_client_query_parallel(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=500)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            ids = list(
+                client.query_parallel(
+                    "select * from foo emit changes", transform=identifier, batch_size=50, executor=self.executor
+                )
+            )
+        self.assertEqual(ids, list(range(500)))
+
+
+class TestShardQuery(unittest.TestCase):
+    def test_adds_where_clause(self):
+        self.assertEqual(
+            shard_query("select * from foo emit changes;", 3, 1),
+            "select * from foo WHERE ROWPARTITION % 3 = 1 emit changes;",
+        )
+
+    def test_extends_where_clause(self):
+        self.assertEqual(
+            shard_query("SELECT id FROM foo WHERE id > 3 OR id < 1 EMIT CHANGES LIMIT 5", 2, 0),
+            "SELECT id FROM foo WHERE (id > 3 OR id < 1) AND ROWPARTITION % 2 = 0 EMIT CHANGES LIMIT 5;",
+        )
+
+    def test_before_group_by(self):
+        self.assertEqual(
+            shard_query("select region, count(*) from foo group by region emit changes", 4, 3, "ABS(ID)"),
+            "select region, count(*) from foo WHERE (ABS(ID)) % 4 = 3 group by region emit changes;",
+        )
+
+
+class TestShardedQuery(unittest.TestCase):
+    def test_shards_cover_every_row_once(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=300, partitions=6)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            sharded = client.sharded_query("select * from foo emit changes", shards=3, batch_size=20)
+            ids = [row["ID"] for row in sharded]
+            queries = [json.loads(body)["ksql"] for command, path, body in server.requests if path == "/query"]
+        self.assertEqual(sorted(ids), list(range(300)))
+        self.assertEqual(len(queries), 3)
+        stats = sharded.stats()
+        self.assertEqual({shard: stats[shard]["rows"] for shard in stats}, {0: 100, 1: 100, 2: 100})
+        self.assertTrue(all(shard["state"] == "done" for shard in stats.values()))
+
+    def test_transform_runs_in_workers(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=40, partitions=4)) as server:
+            sharded = ShardedQuery(server.url, "select * from foo emit changes", shards=2, transform=identifier,
+                                   options={"check_version": False})
+            self.assertEqual(sorted(sharded), list(range(40)))
+
+    def test_shard_error(self):
+        with FakeKSQLServer(faults=Faults(status=400)) as server:
+            sharded = ShardedQuery(server.url, "select * from foo emit changes", options={"check_version": False})
+            with self.assertRaises(KSQLError):
+                list(sharded)
+        self.assertIn("error", [shard["state"] for shard in sharded.stats().values()])
+
+    def test_close_stops_workers(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=None, rate=200, partitions=2)) as server:
+            sharded = ShardedQuery(server.url, "select * from foo emit changes", options={"check_version": False})
+            next(sharded)
+            sharded.close()
+        self.assertFalse(any(process.is_alive() for process in sharded._processes))
@@ -0,0 +1,73 @@
+import unittest
+
+from ksql.profiling import QueryProfiler
+
+
+class FakeClock(object):
+    """ Time that only moves when a stage says it spent some. """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def slow_chunks(clock, chunks, delay):
+    for chunk in chunks:
+        clock.advance(delay)
+        yield chunk
+
+
+def decode(clock, chunks, delay):
+    for chunk in chunks:
+        clock.advance(delay)
+        yield chunk.decode("utf-8")
+
+
+class TestQueryProfiler(unittest.TestCase):
+    def test_phases_are_measured_exclusively(self):
+        clock = FakeClock()
+        profiler = QueryProfiler(clock=clock)
+        chunks = profiler.wrap(slow_chunks(clock, [b"ab", b"cde"], 2.0), "network")
+        rows = profiler.wrap(decode(clock, chunks, 1.0), "decode", outer=True)
+
+        for _ in rows:
+            clock.advance(3.0)
+        report = profiler.finish()
+
+        self.assertEqual(report["rows"], 2)
+        self.assertEqual(report["bytes"], 5)
+        self.assertEqual(report["network_seconds"], 4.0)
+        self.assertEqual(report["decode_seconds"], 2.0)
+        self.assertEqual(report["consumer_seconds"], 6.0)
+        self.assertEqual(report["wall_seconds"], 12.0)
+
+    def test_consumer_time_ends_at_finish(self):
+        clock = FakeClock()
+        profiler = QueryProfiler(clock=clock)
+        rows = profiler.wrap(iter(["a", "b"]), "decode", outer=True)
+        next(rows)
+        clock.advance(5.0)
+        report = profiler.finish()
+        self.assertEqual(report["rows"], 1)
+        self.assertEqual(report["decode_seconds"], 0.0)
+        self.assertEqual(report["consumer_seconds"], 5.0)
+
+    def test_trace_malloc(self):
+        profiler = QueryProfiler(trace_malloc=True)
+        rows = profiler.wrap((["x"] * 100 for _ in range(10)), "decode", outer=True)
+        kept = list(rows)
+        report = profiler.finish()
+
+        self.assertEqual(len(kept), 10)
+        self.assertGreater(report["allocated_blocks"], 0)
+        self.assertIn("peak_traced_bytes", report)
+
+    def test_finish_is_idempotent(self):
+        profiler = QueryProfiler()
+        list(profiler.wrap(iter([1]), "decode", outer=True))
+        self.assertIs(profiler.finish(), profiler.finish())
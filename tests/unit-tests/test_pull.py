@@ -0,0 +1,98 @@
+import datetime
+import json
+import time
+import unittest
+
+from ksql import KSQLAPI
+from ksql.pull import batch_keys, format_literal, split_range, to_millis, window_query
+from tests.benchmarks.fake_server import FakeKSQLServer, Faults, StreamConfig
+
+
+class TestParallelPull(unittest.TestCase):
+    def test_rows_in_window_order(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=100, window_size=1000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            rows = list(client.parallel_pull("totals", 10000, 90000, shards=4))
+            queries = [json.loads(body)["ksql"] for command, path, body in server.requests if path == "/query"]
+        self.assertEqual([row["WINDOWSTART"] for row in rows], list(range(10000, 90000, 1000)))
+        self.assertEqual(len(queries), 4)
+        self.assertIn("SELECT * FROM totals WHERE WINDOWSTART >= 30000 AND WINDOWSTART < 50000;", queries)
+
+    def test_requests_run_concurrently(self):
+        stream = StreamConfig(rows=100, window_size=1000)
+        with FakeKSQLServer(stream=stream, faults=Faults(latency=0.2)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            started = time.time()
+            rows = list(client.parallel_pull("totals", 0, 100000, shards=5))
+        self.assertEqual(len(rows), 100)
+        self.assertLess(time.time() - started, 0.6)
+
+    def test_stopping_early_cancels_pending_slices(self):
+        stream = StreamConfig(rows=100, window_size=1000)
+        with FakeKSQLServer(stream=stream, faults=Faults(latency=0.1)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            rows = client.parallel_pull("totals", 0, 100000, shards=5, max_workers=1)
+            self.assertEqual(next(rows)["WINDOWSTART"], 0)
+            rows.close()
+            time.sleep(0.3)
+            queries = [path for command, path, body in server.requests if path == "/query"]
+        self.assertLess(len(queries), 5)
+
+    def test_empty_range(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=10, window_size=1000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            self.assertEqual(list(client.parallel_pull("totals", 5000, 5000)), [])
+            self.assertEqual(list(client.parallel_pull("totals", 50000, 60000, shards=2)), [])
+
+
+class TestGetMany(unittest.TestCase):
+    def test_batches_and_maps_rows_by_key(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=1000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            keys = list(range(0, 1500, 3))
+            rows = client.get_many("users", keys + keys[:10], batch_size=120)
+            queries = [json.loads(body)["ksql"] for command, path, body in server.requests if path == "/query"]
+        self.assertEqual(sorted(rows), list(range(0, 1000, 3)))
+        self.assertEqual(rows[300]["ID"], 300)
+        self.assertEqual(len(queries), 5)
+        self.assertTrue(all(query.startswith("SELECT * FROM users WHERE ID IN (") for query in queries))
+        self.assertEqual([batch["keys"] for batch in rows.batches], [120, 120, 120, 120, 20])
+        self.assertEqual(sum(batch["rows"] for batch in rows.batches), 334)
+        self.assertTrue(all(batch["seconds"] > 0 for batch in rows.batches))
+
+    def test_batches_run_concurrently(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=100), faults=Faults(latency=0.2)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            started = time.time()
+            rows = client.get_many("users", range(100), batch_size=25, max_workers=4)
+        self.assertEqual(len(rows), 100)
+        self.assertLess(time.time() - started, 0.6)
+
+    def test_no_keys(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            self.assertEqual(client.get_many("users", []), {})
+            self.assertEqual(server.requests, [])
+
+
+class TestHelpers(unittest.TestCase):
+    def test_format_literal(self):
+        self.assertEqual([format_literal(key) for key in (3, 1.5, True, "o'neil")], ["3", "1.5", "TRUE", "'o''neil'"])
+
+    def test_batch_keys_by_size(self):
+        batches = list(batch_keys(["aaaa", "bbbb", "cccc"], max_bytes=16))
+        self.assertEqual([[key for key, literal in batch] for batch in batches], [["aaaa", "bbbb"], ["cccc"]])
+
+    def test_split_range(self):
+        self.assertEqual(split_range(0, 10, 3), [(0, 4), (4, 7), (7, 10)])
+        self.assertEqual(split_range(0, 2, 4), [(0, 1), (1, 2)])
+
+    def test_to_millis(self):
+        self.assertEqual(to_millis(datetime.datetime(1970, 1, 1, 0, 0, 1)), 1000)
+        self.assertEqual(to_millis(1500), 1500)
+
+    def test_window_query(self):
+        self.assertEqual(
+            window_query("totals", 0, 10, columns=["ID", "WINDOWSTART"], where="ID = 3"),
+            "SELECT ID, WINDOWSTART FROM totals WHERE (ID = 3) AND WINDOWSTART >= 0 AND WINDOWSTART < 10;",
+        )
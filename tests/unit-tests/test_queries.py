@@ -0,0 +1,177 @@
+import gc
+import json
+import threading
+import time
+import unittest
+
+from ksql import KSQLAPI
+from ksql.errors import QueryBudgetExceededError
+from ksql.queries import QueryBudget, _close_all_registries, approximate_size, parse_query_id
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+
+class TestQueryRegistry(unittest.TestCase):
+    def test_query_id_captured_while_running(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=10)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query("select * from foo emit changes")
+            next(results)
+            active = client.active_queries
+            self.assertEqual(len(active), 1)
+            self.assertIsNotNone(active[0].query_id)
+            list(results)
+            self.assertEqual(client.active_queries, [])
+            self.assertFalse(active[0].response.closed)
+
+    def test_generator_close_releases_connection(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=1000, rate=1000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query("select * from foo emit changes")
+            next(results)
+            query = client.active_queries[0]
+            results.close()
+            self.assertEqual(client.active_queries, [])
+            self.assertTrue(query.closed)
+            self.assertTrue(query.response.closed)
+
+    def test_garbage_collected_generator(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=1000, rate=1000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query("select * from foo emit changes")
+            next(results)
+            query = client.active_queries[0]
+            del results
+            gc.collect()
+            self.assertEqual(client.active_queries, [])
+            self.assertTrue(query.response.closed)
+
+    def test_close_wakes_up_idle_reader(self):
+        # one row then nothing for a minute
+        with FakeKSQLServer(stream=StreamConfig(rows=2, rate=1.0 / 60)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query("select * from foo emit changes")
+            lines = []
+            reader = threading.Thread(target=lambda: lines.extend(results))
+            reader.start()
+            while not client.active_queries or client.active_queries[0].query_id is None:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            query = client.active_queries[0]
+            started = time.time()
+            query.close()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+            self.assertLess(time.time() - started, 1)
+            self.assertTrue(query.response.closed)
+            self.assertEqual(client.active_queries, [])
+
+    def test_close_all_sends_close_query(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            for number in range(5):
+                query = client.sa.queries.register("query-stream", "select * from foo emit changes;")
+                query.query_id = "q{}".format(number)
+            results = client.close_all()
+            closed = sorted(
+                json.loads(body)["queryId"] for command, path, body in server.requests if path == "/close-query"
+            )
+        self.assertEqual(closed, ["q0", "q1", "q2", "q3", "q4"])
+        self.assertTrue(all(results.values()))
+        self.assertEqual(client.active_queries, [])
+
+    def test_close_at_exit(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url, check_version=False)
+            query = client.sa.queries.register("query-stream", "select * from foo emit changes;")
+            query.query_id = "q0"
+            _close_all_registries()
+            paths = [path for command, path, body in server.requests]
+        self.assertIn("/close-query", paths)
+        self.assertTrue(query.closed)
+
+
+class TestParseQueryId(unittest.TestCase):
+    def test_query_header(self):
+        line = '[{"header":{"queryId":"transient_FOO_1","schema":"`ID` BIGINT"}},\n'
+        self.assertEqual(parse_query_id(line), "transient_FOO_1")
+
+    def test_query_stream_header(self):
+        line = '{"queryId":"abc","columnNames":["ID"],"columnTypes":["BIGINT"]}\n'
+        self.assertEqual(parse_query_id(line), "abc")
+
+    def test_not_a_header(self):
+        self.assertIsNone(parse_query_id("[1, 2, 3]\n"))
+        self.assertIsNone(parse_query_id("{\"row\": "))
+
+
+class TestQueryBudget(unittest.TestCase):
+    def test_max_rows_stops_the_query(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=None)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            rows = []
+            with self.assertRaises(QueryBudgetExceededError) as context:
+                for row in client.query("select * from foo emit changes", return_objects=True, max_rows=100):
+                    rows.append(row)
+            self.assertEqual(len(rows), 100)
+            self.assertEqual(context.exception.limit, "rows")
+            self.assertIsNotNone(context.exception.query_id)
+            self.assertIn(context.exception.query_id, str(context.exception))
+            self.assertEqual(client.active_queries, [])
+
+    def test_query_within_budget(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=10)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            rows = list(client.query("select * from foo emit changes limit 10;", return_objects=True, max_rows=10))
+        self.assertEqual(len(rows), 10)
+
+    def test_max_bytes(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=None, row_size=1000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query("select * from foo emit changes", max_bytes=50000)
+            with self.assertRaises(QueryBudgetExceededError) as context:
+                for line in results:
+                    pass
+        self.assertEqual(context.exception.limit, "bytes")
+        self.assertGreater(context.exception.value, 50000)
+
+    def test_max_seconds(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=None, rate=200)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            started = time.time()
+            with self.assertRaises(QueryBudgetExceededError) as context:
+                list(client.query("select * from foo emit changes", max_seconds=0.2))
+        self.assertEqual(context.exception.limit, "seconds")
+        self.assertLess(time.time() - started, 1)
+
+    def test_max_buffered_bytes(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=None, row_size=100)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query(
+                "select * from foo emit changes", buffer_size=100000, max_buffered_bytes=20000, return_objects=True
+            )
+            with self.assertRaises(QueryBudgetExceededError) as context:
+                for row in results:
+                    # a consumer slower than the stream
+                    time.sleep(0.001)
+            self.assertEqual(context.exception.limit, "buffered bytes")
+            self.assertEqual(client.active_queries, [])
+        with self.assertRaises(ValueError):
+            next(KSQLAPI("http://localhost:1", check_version=False).query("select 1;", max_buffered_bytes=1))
+
+    def test_accounting(self):
+        budget = QueryBudget(max_rows=1)
+        budget.start()
+        budget.add(100, False)
+        budget.add(10, True)
+        self.assertEqual((budget.rows, budget.bytes), (1, 110))
+        with self.assertRaises(QueryBudgetExceededError):
+            budget.add(10, True)
+        budget = QueryBudget(max_buffered_bytes=10)
+        budget.buffer(8)
+        budget.release(8)
+        budget.buffer(8)
+        self.assertEqual(budget.buffered_bytes, 8)
+
+    def test_approximate_size(self):
+        self.assertEqual(approximate_size("abc"), 3)
+        self.assertGreater(approximate_size({"ID": 1, "NAME": "x" * 100}), 100)
@@ -0,0 +1,75 @@
+import http.client
+import socket
+import time
+import unittest
+import urllib
+
+from ksql import KSQLAPI
+from ksql.errors import KSQLError
+from tests.benchmarks.fake_server import FakeKSQLServer, Faults, StreamConfig
+
+
+class TestClientUnderFaults(unittest.TestCase):
+    """Client behaviour against the fault-injecting fake server."""
+
+    def test_statement_error_body(self):
+        with FakeKSQLServer(faults=Faults(statement_error="Stream FOO already exists")) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            with self.assertRaises(KSQLError) as e:
+                client.ksql("CREATE STREAM foo (id INT) WITH (kafka_topic='foo', value_format='JSON');")
+        self.assertEqual(e.exception.msg, "Stream FOO already exists")
+        self.assertEqual(e.exception.error_code, 40001)
+
+    def test_server_error_status(self):
+        with FakeKSQLServer(faults=Faults(status=503)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            with self.assertRaises(KSQLError) as e:
+                client.ksql("show streams;")
+        self.assertEqual(e.exception.error_code, 50300)
+
+    def test_only_first_requests_fail(self):
+        with FakeKSQLServer(faults=Faults(status=503, fail_requests=1)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            with self.assertRaises(KSQLError):
+                client.ksql("show streams;")
+            result = client.ksql("show streams;")
+        self.assertEqual(result[0]["commandStatus"]["status"], "SUCCESS")
+
+    def test_latency_beyond_timeout(self):
+        with FakeKSQLServer(faults=Faults(latency=0.5)) as server:
+            client = KSQLAPI(server.url, check_version=False, timeout=0.1)
+            with self.assertRaises((socket.timeout, urllib.error.URLError)):
+                client.ksql("show streams;")
+
+    def test_partial_chunk_boundaries(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=20), faults=Faults(chunk_size=7)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            rows = list(client.query("select * from foo emit changes", return_objects=True))
+        self.assertEqual([row["ID"] for row in rows], list(range(20)))
+
+    def test_mid_stream_disconnect(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=20), faults=Faults(disconnect_after=5)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            received = []
+            with self.assertRaises(http.client.HTTPException):
+                for row in client.query("select * from foo emit changes", return_objects=True):
+                    received.append(row)
+        self.assertEqual(len(received), 5)
+
+    def test_slow_heartbeats_hit_idle_timeout(self):
+        stream = StreamConfig(rows=3, trailing_heartbeats=20, heartbeat_interval=0.05)
+        with FakeKSQLServer(stream=stream) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            started = time.time()
+            rows = list(client.query("select * from foo emit changes", idle_timeout=0.2))
+        self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(len(rows), 4)
+
+    def test_throttled_bandwidth(self):
+        stream = StreamConfig(rows=10, row_size=100)
+        with FakeKSQLServer(stream=stream, faults=Faults(bandwidth=10000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            started = time.time()
+            rows = list(client.query("select * from foo emit changes", return_objects=True))
+        self.assertEqual(len(rows), 10)
+        self.assertGreater(time.time() - started, 0.1)
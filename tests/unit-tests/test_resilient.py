@@ -0,0 +1,145 @@
+import http.client
+import json
+import os
+import tempfile
+import unittest
+
+from ksql import KSQLAPI
+from ksql.errors import KSQLError
+from ksql.resilient import CONTINUATION_TOKEN_PROPERTY, ResilientQuery, normalize_line
+from tests.benchmarks.fake_server import FakeKSQLServer, Faults, StreamConfig
+
+
+def row_id(line):
+    return json.loads(line)["row"]["columns"][0]
+
+
+class TestResilientQuery(unittest.TestCase):
+    def test_reconnects_and_drops_replayed_rows(self):
+        faults = Faults(disconnect_after=5, fail_requests=2)
+        with FakeKSQLServer(stream=StreamConfig(rows=20), faults=faults) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            query = ResilientQuery(client.sa, "select * from foo emit changes", key=row_id, initial_delay=0.01)
+            lines = list(query)
+            query_requests = [path for command, path, body in server.requests if path == "/query"]
+        self.assertTrue(lines[0].startswith('[{"header"'))
+        self.assertEqual([row_id(normalize_line(line)) for line in lines[1:]], list(range(20)))
+        self.assertEqual(len(query_requests), 3)
+        self.assertEqual(query.reconnects, 2)
+        self.assertEqual(query.duplicates, 10)
+
+    def test_offset_reset_on_reconnect(self):
+        faults = Faults(disconnect_after=2, fail_requests=1)
+        with FakeKSQLServer(stream=StreamConfig(rows=4), faults=faults) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            query = ResilientQuery(client.sa, "select * from foo emit changes", offset_reset="earliest", key=row_id)
+            list(query)
+            bodies = [json.loads(body) for command, path, body in server.requests if path == "/query"]
+        self.assertNotIn("auto.offset.reset", bodies[0]["streamsProperties"])
+        self.assertEqual(bodies[1]["streamsProperties"]["auto.offset.reset"], "earliest")
+
+    def test_gives_up_after_max_retries(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=10), faults=Faults(disconnect_after=2)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            # no new row after the first attempt, so the retry budget is never reset
+            query = ResilientQuery(
+                client.sa, "select * from foo emit changes", key=row_id, max_retries=2, initial_delay=0.01
+            )
+            with self.assertRaises(http.client.HTTPException):
+                list(query)
+        self.assertEqual(query.reconnects, 2)
+
+    def test_query_errors_are_not_retried(self):
+        with FakeKSQLServer(faults=Faults(status=400)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            with self.assertRaises(KSQLError):
+                list(ResilientQuery(client.sa, "select * from foo emit changes"))
+        self.assertEqual(len(server.requests), 1)
+
+    def test_checkpoint_resumes_after_restart(self):
+        path = os.path.join(tempfile.mkdtemp(), "position.json")
+        with FakeKSQLServer(stream=StreamConfig(rows=10)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            first = iter(ResilientQuery(client.sa, "select * from foo emit changes", key=row_id, checkpoint=path))
+            received = [next(first) for _ in range(5)]
+            first.close()
+            second = ResilientQuery(client.sa, "select * from foo emit changes", key=row_id, checkpoint=path)
+            resumed = list(second)
+        self.assertEqual([row_id(normalize_line(line)) for line in received[1:]], [0, 1, 2, 3])
+        self.assertEqual([row_id(normalize_line(line)) for line in resumed[1:]], [4, 5, 6, 7, 8, 9])
+        self.assertEqual(second.duplicates, 4)
+        with self.assertRaises(ValueError):
+            ResilientQuery(client.sa, "select * from bar emit changes", checkpoint=path)
+
+    def test_client_returns_objects(self):
+        faults = Faults(disconnect_after=3, fail_requests=1)
+        with FakeKSQLServer(stream=StreamConfig(rows=6), faults=faults) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            rows = list(
+                client.resilient_query(
+                    "select * from foo emit changes", return_objects=True, key=row_id, initial_delay=0.01
+                )
+            )
+        self.assertEqual([row["ID"] for row in rows], list(range(6)))
+
+
+class FakeAPI(object):
+    """ Serves query2 from a list of scripted connections. """
+
+    def __init__(self, connections):
+        self.connections = list(connections)
+        self.properties = []
+
+    def query2(self, query_string, stream_properties=None):
+        self.properties.append(stream_properties)
+        for line in self.connections.pop(0):
+            if isinstance(line, Exception):
+                raise line
+            yield line
+
+
+class TestContinuationTokens(unittest.TestCase):
+    def test_resumes_from_token(self):
+        header = '{"queryId":"q1","columnNames":["ID"],"columnTypes":["BIGINT"]}\n'
+        api = FakeAPI(
+            [
+                [header, "[1]\n", '{"continuationToken":"t1"}\n', "[2]\n", ConnectionResetError()],
+                [header, "[3]\n"],
+            ]
+        )
+        query = ResilientQuery(api, "select * from foo emit changes", use_http2=True, initial_delay=0)
+        self.assertEqual(list(query), [header, "[1]\n", "[2]\n", "[3]\n"])
+        self.assertNotIn(CONTINUATION_TOKEN_PROPERTY, api.properties[0])
+        self.assertEqual(api.properties[1][CONTINUATION_TOKEN_PROPERTY], "t1")
+        self.assertEqual(query.continuation_token, "t1")
+
+    def test_identical_rows_are_delivered(self):
+        header = '{"queryId":"q1","columnNames":["ID"],"columnTypes":["BIGINT"]}\n'
+        api = FakeAPI([[header, "[1]\n", "[1]\n", "[1]\n"]])
+        query = ResilientQuery(api, "select * from foo emit changes", use_http2=True)
+        self.assertEqual(list(query), [header, "[1]\n", "[1]\n", "[1]\n"])
+        self.assertEqual(query.duplicates, 0)
+
+    def test_no_deduplication_with_token(self):
+        header = '{"queryId":"q1","columnNames":["ID"],"columnTypes":["BIGINT"]}\n'
+        api = FakeAPI(
+            [
+                [header, "[1]\n", '{"continuationToken":"t1"}\n', ConnectionResetError()],
+                [header, "[1]\n", "[2]\n"],
+            ]
+        )
+        query = ResilientQuery(api, "select * from foo emit changes", use_http2=True, initial_delay=0)
+        self.assertEqual(list(query), [header, "[1]\n", "[1]\n", "[2]\n"])
+        self.assertEqual(query.duplicates, 0)
+
+    def test_replay_ends_at_first_new_row(self):
+        header = '{"queryId":"q1","columnNames":["ID"],"columnTypes":["BIGINT"]}\n'
+        api = FakeAPI(
+            [
+                [header, "[1]\n", "[2]\n", ConnectionResetError()],
+                [header, "[1]\n", "[2]\n", "[3]\n", "[1]\n"],
+            ]
+        )
+        query = ResilientQuery(api, "select * from foo emit changes", use_http2=True, initial_delay=0)
+        self.assertEqual(list(query), [header, "[1]\n", "[2]\n", "[3]\n", "[1]\n"])
+        self.assertEqual(query.duplicates, 2)
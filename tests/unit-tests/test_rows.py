@@ -0,0 +1,91 @@
+import pickle
+import sys
+import unittest
+
+from ksql import KSQLAPI
+from ksql import rows
+from ksql.codec import JSONCodec
+from ksql.rows import LazyRow, Row, row_class
+from ksql.utils import parse_columns, process_query_result
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+HEADER = '[{"header":{"queryId":"q1","schema":"`ID` BIGINT KEY, `NAME` STRING, `GET` STRING"}},\n'
+LINES = [
+    HEADER,
+    '{"row":{"columns":[1,"one","a"]}},\n',
+    '{"row":{"columns":[2,"two","b"]}},\n',
+    '{"finalMessage":"Limit Reached"}]',
+]
+
+
+class TestRowClass(unittest.TestCase):
+    def test_one_class_per_schema(self):
+        columns = parse_columns(HEADER)
+        self.assertIs(row_class(columns), row_class(columns))
+        self.assertIsNot(row_class(columns), row_class(columns, lazy=True))
+        self.assertEqual(row_class(columns)._fields, ("ID", "NAME", "GET"))
+        self.assertEqual(row_class(columns)._types, ("BIGINT", "STRING", "STRING"))
+        self.assertEqual(row_class(["A", "B"])._fields, ("A", "B"))
+
+    def test_lazy_class_shared_by_codec_instances(self):
+        columns = parse_columns(HEADER)
+        self.assertIs(
+            row_class(columns, lazy=True, loads=JSONCodec().loads),
+            row_class(columns, lazy=True, loads=JSONCodec().loads),
+        )
+
+    def test_cache_is_bounded(self):
+        for number in range(rows.MAX_CLASSES + 10):
+            row_class(["C{}".format(number)])
+        self.assertEqual(len(rows._classes), rows.MAX_CLASSES)
+        # the least recently used classes are evicted
+        fields = [key[0] for key in rows._classes]
+        self.assertNotIn(("C0",), fields)
+        self.assertIn(("C{}".format(rows.MAX_CLASSES + 9),), fields)
+
+    def test_typed_rows(self):
+        rows = list(process_query_result(iter(LINES), return_objects="typed"))
+        self.assertEqual(len(rows), 2)
+        row = rows[0]
+        self.assertIsInstance(row, Row)
+        self.assertEqual(row, (1, "one", "a"))
+        self.assertEqual((row["ID"], row.NAME, row[1]), (1, "one", "one"))
+        # a column named like a method is only readable by name
+        self.assertEqual(row["GET"], "a")
+        self.assertEqual(row.get("MISSING", 0), 0)
+        self.assertEqual(row.as_dict(), {"ID": 1, "NAME": "one", "GET": "a"})
+        self.assertEqual(repr(row), "Row(ID=1, NAME='one', GET='a')")
+        with self.assertRaises(KeyError):
+            row["MISSING"]
+        with self.assertRaises(AttributeError):
+            row.other = 1
+
+    def test_lazy_rows_are_decoded_when_read(self):
+        rows = list(process_query_result(iter(LINES), return_objects="lazy"))
+        self.assertEqual(len(rows), 2)
+        row = rows[1]
+        self.assertIsInstance(row, LazyRow)
+        self.assertFalse(row.decoded)
+        self.assertEqual(row.NAME, "two")
+        self.assertTrue(row.decoded)
+        self.assertEqual(row, (2, "two", "b"))
+        self.assertEqual(dict(row.items()), {"ID": 2, "NAME": "two", "GET": "b"})
+
+    def test_pickle(self):
+        typed, = list(process_query_result(iter(LINES[:2]), return_objects="typed"))
+        lazy, = list(process_query_result(iter(LINES[:2]), return_objects="lazy"))
+        self.assertEqual(pickle.loads(pickle.dumps(typed)).as_dict(), typed.as_dict())
+        self.assertEqual(pickle.loads(pickle.dumps(lazy)), typed)
+
+    def test_smaller_than_dicts(self):
+        dicts = list(process_query_result(iter(LINES), return_objects=True))
+        rows = list(process_query_result(iter(LINES), return_objects="typed"))
+        self.assertLess(sys.getsizeof(rows[0]), sys.getsizeof(dicts[0]))
+
+    def test_query(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=20)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            rows = list(client.query("select * from foo emit changes", return_objects="typed"))
+            lazy = list(client.query("select * from foo emit changes", return_objects="lazy"))
+        self.assertEqual([row.ID for row in rows], list(range(20)))
+        self.assertEqual([row["ID"] for row in lazy], list(range(20)))
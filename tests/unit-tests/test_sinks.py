@@ -0,0 +1,171 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ksql import KSQLAPI
+from ksql.sinks import CsvSink, JsonLinesSink, ParquetSink, open_sink
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+HEADER = '[{"header":{"queryId":"q1","schema":"`ID` BIGINT KEY, `TAGS` ARRAY<STRING>, `NAME` STRING"}},\n'
+
+
+def lines(count):
+    yield HEADER
+    for i in range(count):
+        yield '{{"row":{{"columns":[{},["a","b"],"name-{}"]}}}},\n'.format(i, i)
+    yield '{"finalMessage":"Limit Reached"}]'
+
+
+class SinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class TestSinks(SinkTestCase):
+    def test_jsonl_passes_raw_rows_through(self):
+        stats = JsonLinesSink(self.path("out.jsonl"), batch_size=4).consume(lines(10))
+        with open(self.path("out.jsonl")) as f:
+            written = f.read().splitlines()
+        self.assertEqual(written[0], HEADER[1:-2])
+        self.assertEqual(written[1], '{"row":{"columns":[0,["a","b"],"name-0"]}}')
+        self.assertEqual(len(written), 11)
+        self.assertEqual(stats["rows"], 10)
+        self.assertEqual(stats["files"], 1)
+        # the header line is accounted for
+        self.assertEqual(stats["bytes"], os.path.getsize(self.path("out.jsonl")))
+        self.assertGreater(stats["write_bytes_per_second"], 0)
+        self.assertEqual(os.listdir(self.directory), ["out.jsonl"])
+
+    def test_rotation_by_size(self):
+        sink = JsonLinesSink(self.path("out-{index:03d}.jsonl"), max_bytes=200, batch_size=2)
+        stats = sink.consume(lines(20))
+        self.assertEqual(sorted(os.listdir(self.directory)), [os.path.basename(path) for path in sink.files])
+        self.assertEqual(stats["files"], len(sink.files))
+        self.assertGreater(len(sink.files), 3)
+        rows = []
+        for path in sink.files:
+            with open(path) as f:
+                written = f.read().splitlines()
+            # every file starts with the header
+            self.assertTrue(written[0].startswith('{"header"'))
+            rows.extend(json.loads(line)["row"]["columns"][0] for line in written[1:])
+        self.assertEqual(rows, list(range(20)))
+
+    def test_rotation_needs_a_pattern(self):
+        with self.assertRaises(ValueError):
+            JsonLinesSink(self.path("out.jsonl"), max_seconds=60)
+        with self.assertRaises(ValueError):
+            JsonLinesSink(self.path("out.jsonl"), fsync="always")
+
+    def test_partial_file_until_closed(self):
+        sink = JsonLinesSink(self.path("out.jsonl"), batch_size=1, fsync="batch")
+        for line in lines(3):
+            sink.write(line)
+        self.assertEqual(os.listdir(self.directory), ["out.jsonl.part"])
+        sink.close()
+        self.assertEqual(os.listdir(self.directory), ["out.jsonl"])
+
+    def test_csv(self):
+        with CsvSink(self.path("out.csv")) as sink:
+            for line in lines(3):
+                sink.write(line)
+        with open(self.path("out.csv"), newline="") as f:
+            records = list(csv.reader(f))
+        self.assertEqual(records[0], ["ID", "TAGS", "NAME"])
+        self.assertEqual(records[1], ["0", '["a", "b"]', "name-0"])
+        self.assertEqual(len(records), 4)
+
+    def test_objects_and_query_stream_lines(self):
+        with open_sink(self.path("out.csv")) as sink:
+            sink.write({"ID": 1, "NAME": "one"})
+            sink.write({"ID": 2, "NAME": "two"})
+        with open(self.path("out.csv"), newline="") as f:
+            self.assertEqual(list(csv.reader(f)), [["ID", "NAME"], ["1", "one"], ["2", "two"]])
+
+        stream = ['{"queryId":"q1","columnNames":["ID"],"columnTypes":["BIGINT"]}\n', "[1]\n", "[2]\n"]
+        with open_sink(self.path("out.ndjson")) as sink:
+            sink.consume(stream)
+        with open(self.path("out.ndjson")) as f:
+            self.assertEqual(f.read().splitlines(), [stream[0].strip(), "[1]", "[2]"])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            open_sink(self.path("out.xml"))
+
+    @unittest.skipIf(pyarrow is not None, "pyarrow is installed")
+    def test_parquet_needs_pyarrow(self):
+        with self.assertRaises(ImportError):
+            ParquetSink(self.path("out.parquet"))
+
+    def test_query_to_file(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=50)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            stats = client.query_to_file("select * from foo emit changes limit 50;", self.path("foo-{index}.csv"))
+        self.assertEqual(stats["rows"], 50)
+        with open(self.path("foo-0.csv"), newline="") as f:
+            records = list(csv.reader(f))
+        self.assertEqual(records[0], ["ID", "SENT_AT", "PAYLOAD"])
+        self.assertEqual(len(records), 51)
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class TestParquetSink(SinkTestCase):
+    def test_round_trip(self):
+        schema = "`ID` BIGINT KEY, `OK` BOOLEAN, `PRICE` DOUBLE, `COUNT` INT, `TAGS` ARRAY<STRING>, `NAME` STRING"
+        stream = [
+            '[{"header":{"queryId":"q1","schema":"' + schema + '"}},\n',
+            '{"row":{"columns":[1,true,1.5,2,["a"],"one"]}},\n',
+            '{"row":{"columns":[2,false,null,3,[],5]}},\n',
+            '{"finalMessage":"Limit Reached"}]',
+        ]
+        stats = ParquetSink(self.path("out.parquet"), batch_size=1).consume(stream)
+        table = pyarrow.parquet.read_table(self.path("out.parquet"))
+        types = {field.name: field.type for field in table.schema}
+        self.assertEqual(
+            types,
+            {
+                "ID": pyarrow.int64(),
+                "OK": pyarrow.bool_(),
+                "PRICE": pyarrow.float64(),
+                "COUNT": pyarrow.int32(),
+                # types without an Arrow equivalent are written as JSON strings
+                "TAGS": pyarrow.string(),
+                "NAME": pyarrow.string(),
+            },
+        )
+        self.assertEqual(table.column("ID").to_pylist(), [1, 2])
+        self.assertEqual(table.column("OK").to_pylist(), [True, False])
+        self.assertEqual(table.column("PRICE").to_pylist(), [1.5, None])
+        self.assertEqual(table.column("TAGS").to_pylist(), ['["a"]', "[]"])
+        # a value that is not a string in a string column is coerced
+        self.assertEqual(table.column("NAME").to_pylist(), ["one", "5"])
+        self.assertEqual(stats["rows"], 2)
+        self.assertEqual(stats["bytes"], os.path.getsize(self.path("out.parquet")))
+
+    def test_rotation(self):
+        sink = ParquetSink(self.path("out-{index:03d}.parquet"), max_bytes=1, batch_size=5)
+        stats = sink.consume(lines(20))
+        self.assertEqual(len(sink.files), 4)
+        self.assertEqual(stats["files"], 4)
+        ids = []
+        for path in sink.files:
+            table = pyarrow.parquet.read_table(path)
+            self.assertEqual(table.num_rows, 5)
+            ids.extend(table.column("ID").to_pylist())
+        self.assertEqual(ids, list(range(20)))
+        self.assertEqual(stats["bytes"], sum(os.path.getsize(path) for path in sink.files))
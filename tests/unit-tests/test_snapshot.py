@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ksql import KSQLAPI
+from ksql.snapshot import Snapshot, SnapshotWriter
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+COLUMNS = [("ID", "BIGINT"), ("NAME", "STRING"), ("SCORE", "DOUBLE"), ("ACTIVE", "BOOLEAN"), ("TAGS", "ARRAY<STRING>")]
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "table.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, rows, key_column="ID", batch_size=3):
+        writer = SnapshotWriter(self.path, COLUMNS, key_column=key_column, batch_size=batch_size)
+        for row in rows:
+            writer.append(row)
+        writer.close()
+        return writer
+
+    def test_round_trip(self):
+        rows = [[i, "name-{}".format(i), i / 2.0, i % 2 == 0, ["a", str(i)]] for i in range(10, 0, -1)]
+        self.write(rows)
+        self.assertEqual(os.listdir(self.directory), ["table.snapshot"])
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(len(snapshot), 10)
+            self.assertEqual(snapshot.columns, COLUMNS)
+            self.assertEqual(list(snapshot.column("ID")), list(range(10, 0, -1)))
+            self.assertEqual(snapshot.column("NAME")[0], "name-10")
+            self.assertEqual(snapshot.column("SCORE")[-1], 0.5)
+            self.assertEqual(
+                snapshot.row(0), {"ID": 10, "NAME": "name-10", "SCORE": 5.0, "ACTIVE": True, "TAGS": '["a", "10"]'}
+            )
+            self.assertEqual([row["ID"] for row in snapshot], list(range(10, 0, -1)))
+
+    def test_key_lookups(self):
+        rows = [[i % 4, "name-{}".format(i), float(i), True, None] for i in range(20)]
+        self.write(rows)
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(snapshot.key_column, "ID")
+            names = sorted(row["NAME"] for row in snapshot.lookup(3))
+            self.assertEqual(names, sorted("name-{}".format(i) for i in (3, 7, 11, 15, 19)))
+            self.assertEqual(snapshot.get(0)["ID"], 0)
+            self.assertIsNone(snapshot.get(42))
+            self.assertEqual(snapshot.lookup(-1), [])
+
+    def test_string_keys_and_nulls(self):
+        rows = [[1, "b", None, None, None], [2, "a", 1.5, False, ["x"]], [None, "c", 2.5, True, []]]
+        self.write(rows, key_column="NAME")
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(snapshot.get("a")["ID"], 2)
+            self.assertEqual(snapshot.get("c"), {"ID": None, "NAME": "c", "SCORE": 2.5, "ACTIVE": True, "TAGS": "[]"})
+            self.assertEqual(snapshot.row(0)["SCORE"], None)
+            self.assertIsNone(snapshot.nulls("NAME"))
+            self.assertEqual(list(snapshot.nulls("ID")), [0, 0, 1])
+            self.assertEqual(snapshot.column_values("ACTIVE"), [None, False, True])
+
+    def test_index_merged_from_sorted_runs(self):
+        names = ["name-{:02d}".format(i % 7) for i in range(50)]
+        writer = SnapshotWriter(self.path, COLUMNS, key_column="NAME", batch_size=8)
+        writer.sort_run_rows = 6
+        for i, name in enumerate(names):
+            writer.append([i, name, 0.0, True, None])
+        writer.close()
+        self.assertEqual(os.listdir(self.directory), ["table.snapshot"])
+        with Snapshot(self.path) as snapshot:
+            order = list(snapshot._index)
+            self.assertEqual(order, sorted(range(50), key=names.__getitem__))
+            self.assertEqual([row["ID"] for row in snapshot.lookup("name-03")], [3, 10, 17, 24, 31, 38, 45])
+
+    def test_numeric_index_is_stable(self):
+        rows = [[i % 3, "name-{}".format(i), 0.0, True, None] for i in range(30)]
+        self.write(rows)
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(list(snapshot._index), sorted(range(30), key=lambda i: i % 3))
+
+    def test_numpy_reads_in_place(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        self.write([[i, "", float(i), True, None] for i in range(100)], key_column=None)
+        with Snapshot(self.path) as snapshot:
+            scores = numpy.asarray(snapshot.column("SCORE"))
+            self.assertEqual(scores.sum(), 4950.0)
+            self.assertFalse(scores.flags.owndata)
+            del scores
+            with self.assertRaises(ValueError):
+                snapshot.get(1)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"x" * 64)
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+    def test_export_snapshot(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=500, row_size=10)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            count = client.export_snapshot("users", self.path, key_column="ID", batch_size=64)
+            queries = [body for command, path, body in server.requests if path == "/query"]
+        self.assertEqual(count, 500)
+        self.assertIn(b'"SELECT * FROM users;"', queries[0])
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(snapshot.metadata, {"table": "users"})
+            self.assertEqual(snapshot.get(123)["PAYLOAD"], "x" * 10)
+            self.assertEqual(len(snapshot.column("PAYLOAD")), 500)
@@ -0,0 +1,186 @@
+import threading
+import time
+import unittest
+
+from ksql import KSQLAPI
+from ksql.profiling import QueryProfiler
+from ksql.streaming import BackgroundReader, merge_queries
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+
+def rows(name, count, delay=0.0):
+    for number in range(count):
+        if delay:
+            time.sleep(delay)
+        yield "{}-{}".format(name, number)
+
+
+def failing(count):
+    for number in range(count):
+        yield number
+    raise ValueError("connection lost")
+
+
+class TestMergeQueries(unittest.TestCase):
+    def test_yields_every_row_with_its_tag(self):
+        merged = list(merge_queries({"a": rows("a", 50), "b": rows("b", 30)}, buffer_size=4))
+        self.assertEqual([row for tag, row in merged if tag == "a"], list(rows("a", 50)))
+        self.assertEqual([row for tag, row in merged if tag == "b"], list(rows("b", 30)))
+
+    def test_list_is_tagged_by_index(self):
+        merged = list(merge_queries([rows("a", 2), rows("b", 2)]))
+        self.assertEqual(sorted(tag for tag, row in merged), [0, 0, 1, 1])
+
+    def test_fair_scheduling(self):
+        merged = merge_queries({"a": rows("a", 100), "b": rows("b", 100)}, buffer_size=10)
+        # let both readers fill their buffers before consuming
+        time.sleep(0.1)
+        tags = [tag for tag, row in (next(merged) for _ in range(20))]
+        merged.close()
+        self.assertEqual(tags.count("a"), 10)
+        self.assertEqual(tags.count("b"), 10)
+
+    def test_slow_query_does_not_block_fast_one(self):
+        started = time.time()
+        merged = merge_queries({"slow": rows("slow", 3, delay=0.2), "fast": rows("fast", 100)})
+        first = [next(merged) for _ in range(50)]
+        self.assertLess(time.time() - started, 0.3)
+        self.assertGreaterEqual(sum(tag == "fast" for tag, row in first), 49)
+        merged.close()
+
+    def test_bounded_buffers(self):
+        merged = merge_queries({"a": rows("a", 1000)}, buffer_size=5)
+        next(merged)
+        time.sleep(0.05)
+        self.assertLessEqual(merged.depths()["a"], 5)
+        self.assertLessEqual(merged.rows()["a"], 7)
+        merged.close()
+
+    def test_error_is_raised_after_buffered_rows(self):
+        merged = merge_queries({"bad": failing(3)})
+        received = []
+        with self.assertRaises(ValueError):
+            for tag, row in merged:
+                received.append(row)
+        self.assertEqual(received, [0, 1, 2])
+
+    def test_close_stops_readers(self):
+        before = threading.active_count()
+        merged = merge_queries([rows("a", 10 ** 6), rows("b", 10 ** 6)], buffer_size=2)
+        next(merged)
+        merged.close()
+        time.sleep(0.1)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_close_with_idle_source(self):
+        # one row then nothing for a minute
+        with FakeKSQLServer(stream=StreamConfig(rows=2, rate=1.0 / 60)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            merged = client.merge_queries(["select * from a emit changes"], return_objects=True)
+            next(merged)
+            time.sleep(0.1)
+            self.assertEqual(len(client.active_queries), 1)
+            started = time.time()
+            merged.close(timeout=5)
+            self.assertLess(time.time() - started, 1)
+            self.assertFalse(any(thread.is_alive() for thread in merged._threads))
+            self.assertEqual(client.active_queries, [])
+
+    def test_client_merges_push_queries(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=25)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            queries = ["select * from a emit changes", "select * from b emit changes"]
+            merged = list(client.merge_queries(queries, return_objects=True))
+        self.assertEqual(len(merged), 50)
+        self.assertEqual(
+            sorted(row["ID"] for tag, row in merged if tag == "select * from a emit changes"), list(range(25))
+        )
+
+
+class TestBackgroundReader(unittest.TestCase):
+    def fill(self, reader, expected_received):
+        # read ahead until the reader has seen every row, before consuming anything
+        reader.start()
+        deadline = time.time() + 2
+        while reader.received < expected_received and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.02)
+
+    def test_block_keeps_every_row(self):
+        reader = BackgroundReader(rows("a", 100), buffer_size=5)
+        self.assertEqual(list(reader), list(rows("a", 100)))
+        stats = reader.stats()
+        self.assertEqual(stats["dropped"], 0)
+        self.assertLessEqual(stats["max_depth"], 5)
+
+    def test_block_bounds_the_reader(self):
+        reader = BackgroundReader(rows("a", 1000), buffer_size=5)
+        self.fill(reader, 6)
+        self.assertEqual(reader.received, 6)
+        self.assertEqual(reader.depth, 5)
+        reader.close()
+
+    def test_drop_oldest_keeps_first_row(self):
+        reader = BackgroundReader(rows("a", 10), buffer_size=3, overflow="drop-oldest")
+        self.fill(reader, 10)
+        self.assertEqual(list(reader), ["a-0", "a-8", "a-9"])
+        self.assertEqual(reader.dropped, 7)
+
+    def test_drop_newest(self):
+        reader = BackgroundReader(rows("a", 10), buffer_size=3, overflow="drop-newest")
+        self.fill(reader, 10)
+        self.assertEqual(list(reader), ["a-0", "a-1", "a-2"])
+        self.assertEqual(reader.dropped, 7)
+
+    def test_sample(self):
+        reader = BackgroundReader(rows("a", 24), buffer_size=3, overflow="sample", sample_every=5)
+        self.fill(reader, 24)
+        self.assertEqual(list(reader), ["a-0", "a-17", "a-22"])
+        self.assertEqual(reader.stats()["dropped"], 21)
+
+    def test_error_after_buffered_rows(self):
+        reader = BackgroundReader(failing(3))
+        received = []
+        with self.assertRaises(ValueError):
+            for row in reader:
+                received.append(row)
+        self.assertEqual(received, [0, 1, 2])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            BackgroundReader([], overflow="drop-all")
+
+    def test_client_query_with_buffer(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=30)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = list(client.query("select * from foo emit changes", return_objects=True, buffer_size=8))
+        self.assertEqual([row["ID"] for row in results], list(range(30)))
+
+    def test_client_query_exposes_reader_stats(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=30)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query("select * from foo emit changes", return_objects=True, buffer_size=8)
+            self.assertIsNone(results.stats())
+            self.assertEqual(len(list(results)), 30)
+        self.assertIsInstance(results.reader, BackgroundReader)
+        self.assertEqual(results.stats()["delivered"], 30)
+
+    def test_client_query_close_with_idle_stream(self):
+        # one row then nothing for a minute
+        with FakeKSQLServer(stream=StreamConfig(rows=2, rate=1.0 / 60)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = client.query("select * from foo emit changes", return_objects=True, buffer_size=8)
+            next(results)
+            time.sleep(0.1)
+            query = client.active_queries[0]
+            started = time.time()
+            results.close()
+            self.assertLess(time.time() - started, 1)
+            self.assertFalse(results.reader._thread.is_alive())
+            self.assertTrue(query.response.closed)
+            self.assertEqual(client.active_queries, [])
+
+    def test_client_query_buffer_and_profiler(self):
+        client = KSQLAPI("http://localhost:8088", check_version=False)
+        with self.assertRaises(ValueError):
+            next(client.query("select * from foo emit changes", buffer_size=8, profiler=QueryProfiler()))
@@ -0,0 +1,93 @@
+import os
+import socket
+import ssl
+import unittest
+import urllib
+
+from ksql import KSQLAPI
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+CERTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "certs")
+CA = os.path.join(CERTS, "ca.pem")
+
+
+def server_context(require_client_cert=False):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.path.join(CERTS, "server.pem"), os.path.join(CERTS, "server.key"))
+    if require_client_cert:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(CA)
+    return context
+
+
+class TestTLS(unittest.TestCase):
+    def test_context_is_shared_and_sessions_resumed(self):
+        with FakeKSQLServer(ssl_context=server_context(), stream=StreamConfig(rows=3)) as server:
+            client = KSQLAPI(server.url, check_version=False, cert=CA)
+            for _ in range(3):
+                client.ksql("show streams;")
+            rows = list(client.query("select * from foo emit changes", return_objects=True))
+            context = client.sa.ssl_context
+        self.assertEqual(len(rows), 3)
+        self.assertIs(client.sa.ssl_context, context)
+        sessions = client.sa.tls_sessions
+        self.assertEqual(sessions.handshakes, 4)
+        self.assertEqual(sessions.resumed, 3)
+
+    def test_requests_path_resumes_sessions(self):
+        with FakeKSQLServer(ssl_context=server_context()) as server:
+            client = KSQLAPI(server.url, check_version=False, cert=CA)
+            client.ksql("show streams;")
+            # a new connection of the requests session, after the urllib one
+            self.assertEqual(client.get_ksql_version(use_cache=False), "0.10.1")
+            client.sa._get_session().close()
+            self.assertEqual(client.get_ksql_version(use_cache=False), "0.10.1")
+        sessions = client.sa.tls_sessions
+        self.assertEqual(sessions.handshakes, 3)
+        self.assertEqual(sessions.resumed, 2)
+
+    def test_http2_context_resumes_sessions(self):
+        # hyper wraps its sockets with this context, the handshakes are checked on the context itself
+        with FakeKSQLServer(ssl_context=server_context()) as server:
+            client = KSQLAPI(server.url, check_version=False, cert=CA)
+            context = client.sa.http2_ssl_context
+            host, port = server.url.split("//")[1].split(":")
+            for _ in range(2):
+                with context.wrap_socket(socket.create_connection((host, int(port))), server_hostname=host) as sock:
+                    sock.sendall(b"GET /info HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+                    self.assertTrue(sock.recv(1024).startswith(b"HTTP/1"))
+        sessions = client.sa.http2_tls_sessions
+        self.assertEqual(sessions.handshakes, 2)
+        self.assertEqual(sessions.resumed, 1)
+
+    def test_requests_path_uses_the_context(self):
+        with FakeKSQLServer(ssl_context=server_context()) as server:
+            client = KSQLAPI(server.url, cert=CA)
+            self.assertEqual(client.get_ksql_version(use_cache=False), "0.10.1")
+            self.assertTrue(client.close_query("query_1"))
+
+    def test_requests_path_keeps_the_trust_store(self):
+        with FakeKSQLServer(ssl_context=server_context()) as server:
+            client = KSQLAPI(server.url, check_version=False, cert=CA)
+            stats = client.sa.ssl_context.cert_store_stats()
+            self.assertEqual(client.get_ksql_version(use_cache=False), "0.10.1")
+            self.assertTrue(client.close_query("query_1"))
+        self.assertEqual(client.sa.ssl_context.cert_store_stats(), stats)
+
+    def test_unknown_ca_is_rejected(self):
+        with FakeKSQLServer(ssl_context=server_context()) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            with self.assertRaises(urllib.error.URLError):
+                client.ksql("show streams;")
+
+    def test_client_certificate(self):
+        with FakeKSQLServer(ssl_context=server_context(require_client_cert=True)) as server:
+            client = KSQLAPI(
+                server.url,
+                check_version=False,
+                cert=CA,
+                client_cert=os.path.join(CERTS, "client.pem"),
+                client_key=os.path.join(CERTS, "client.key"),
+            )
+            result = client.ksql("show streams;")
+        self.assertEqual(result[0]["commandStatus"]["status"], "SUCCESS")
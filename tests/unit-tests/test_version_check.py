@@ -0,0 +1,86 @@
+import unittest
+
+import ksql.client
+from ksql import KSQLAPI
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+
+def paths(server):
+    return [path for _, path, _ in server.requests]
+
+
+class TestVersionCheck(unittest.TestCase):
+    def setUp(self):
+        ksql.client._version_cache.clear()
+
+    def test_version_is_checked_on_first_request(self):
+        with FakeKSQLServer() as server:
+            client = KSQLAPI(server.url)
+            self.assertEqual(paths(server), [])
+            client.ksql("show streams;")
+            client.ksql("show streams;")
+        self.assertEqual(paths(server), ["/info", "/ksql", "/ksql"])
+
+    def test_version_is_cached_per_url(self):
+        with FakeKSQLServer() as server:
+            KSQLAPI(server.url).ksql("show streams;")
+            KSQLAPI(server.url).ksql("show streams;")
+        self.assertEqual(paths(server).count("/info"), 1)
+
+    def test_version_cache_expires(self):
+        with FakeKSQLServer() as server:
+            KSQLAPI(server.url, version_cache_ttl=0).ksql("show streams;")
+            KSQLAPI(server.url, version_cache_ttl=0).ksql("show streams;")
+        self.assertEqual(paths(server).count("/info"), 2)
+
+    def test_no_check_version(self):
+        with FakeKSQLServer() as server:
+            KSQLAPI(server.url, check_version=False).ksql("show streams;")
+        self.assertEqual(paths(server), ["/ksql"])
+
+    def test_supports_query_stream(self):
+        with FakeKSQLServer(version="0.9.0") as server:
+            self.assertFalse(KSQLAPI(server.url).supports_query_stream())
+        with FakeKSQLServer(version="7.3.0-ccs") as server:
+            self.assertTrue(KSQLAPI(server.url).supports_query_stream())
+        # Confluent Platform versions, 5.5 predates the endpoint
+        with FakeKSQLServer(version="5.5.0") as server:
+            self.assertFalse(KSQLAPI(server.url).supports_query_stream())
+        with FakeKSQLServer(version="6.0.0") as server:
+            self.assertTrue(KSQLAPI(server.url).supports_query_stream())
+
+    def test_auto_endpoint_falls_back_to_query(self):
+        with FakeKSQLServer(version="0.9.0", stream=StreamConfig(rows=3)) as server:
+            client = KSQLAPI(server.url)
+            rows = list(client.query("select * from foo emit changes", use_http2="auto", return_objects=True))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(paths(server), ["/info", "/query"])
+
+    def test_auto_endpoint_uses_query_stream(self):
+        header = '{"queryId":"q1","columnNames":["ID","NAME"],"columnTypes":["BIGINT","STRING"]}\n'
+
+        def query2(query_string, **kwargs):
+            yield header
+            yield '[1,"one"]\n'
+            yield '[2,"two"]\n'
+
+        with FakeKSQLServer(version="0.10.1") as server:
+            client = KSQLAPI(server.url)
+            # the HTTP/2 transport is replaced, the fake server only speaks HTTP/1.1
+            client.sa.query2 = query2
+            rows = list(client.query("select * from foo emit changes", use_http2="auto", return_objects=True))
+            typed = list(client.query("select * from foo emit changes", use_http2="auto", return_objects="typed"))
+            lazy = list(client.query("select * from foo emit changes", use_http2="auto", return_objects="lazy"))
+            raw = list(client.query("select * from foo emit changes", use_http2="auto"))
+            resilient = list(client.resilient_query("select * from foo", use_http2="auto", return_objects=True))
+        self.assertEqual(rows, [{"ID": 1, "NAME": "one"}, {"ID": 2, "NAME": "two"}])
+        self.assertEqual(typed[1].NAME, "two")
+        self.assertEqual([row.as_dict() for row in lazy], rows)
+        self.assertEqual(raw, [header, '[1,"one"]\n', '[2,"two"]\n'])
+        self.assertEqual(resilient, rows)
+        self.assertEqual(paths(server), ["/info"])
+
+    def test_parse_version(self):
+        self.assertEqual(ksql.client.parse_version("0.10.1"), (0, 10, 1))
+        self.assertEqual(ksql.client.parse_version("7.3.0-ccs"), (7, 3, 0))
+        self.assertIsNone(ksql.client.parse_version("unknown"))
@@ -0,0 +1,157 @@
+import datetime
+import unittest
+
+from ksql import KSQLAPI
+from ksql.windows import HoppingWindow, SessionWindow, TumblingWindow, WindowedAggregator, to_duration
+from tests.benchmarks.fake_server import FakeKSQLServer, StreamConfig
+
+
+def row(key, rowtime, amount=1.0):
+    return {"ID": key, "ROWTIME": rowtime, "AMOUNT": amount}
+
+
+class TestTumblingWindows(unittest.TestCase):
+    def test_emits_windows_when_the_watermark_passes_their_end(self):
+        aggregator = WindowedAggregator(
+            TumblingWindow(1000), key="ID", value="AMOUNT", aggregations=("count", "sum", "mean", "min", "max")
+        )
+        results = aggregator.process([row("a", 100, 1), row("b", 200, 5), row("a", 900, 3)])
+        self.assertEqual(results, [])
+        results = aggregator.process([row("a", 1500, 10)])
+        self.assertEqual(
+            results,
+            [
+                {"ID": "a", "WINDOWSTART": 0, "WINDOWEND": 1000, "COUNT": 2, "SUM": 4.0, "MEAN": 2.0, "MIN": 1.0,
+                 "MAX": 3.0},
+                {"ID": "b", "WINDOWSTART": 0, "WINDOWEND": 1000, "COUNT": 1, "SUM": 5.0, "MEAN": 5.0, "MIN": 5.0,
+                 "MAX": 5.0},
+            ],
+        )
+        self.assertEqual(aggregator.open_windows, 1)
+        self.assertEqual(aggregator.flush()[0]["SUM"], 10.0)
+
+    def test_windows_accumulate_across_batches(self):
+        aggregator = WindowedAggregator(TumblingWindow(1000), key="ID", value="AMOUNT", aggregations=("count", "sum"))
+        for rowtime in range(0, 1000, 100):
+            aggregator.process([row("a", rowtime, 2)])
+        self.assertEqual(
+            aggregator.flush(), [{"ID": "a", "WINDOWSTART": 0, "WINDOWEND": 1000, "COUNT": 10, "SUM": 20.0}]
+        )
+
+    def test_percentiles(self):
+        aggregator = WindowedAggregator(TumblingWindow(1000), value="AMOUNT", aggregations=("p50", "p99", "max"))
+        aggregator.process([row("a", i, i) for i in range(0, 500)])
+        aggregator.process([row("a", i, i) for i in range(500, 1000)])
+        result = aggregator.flush()[0]
+        self.assertAlmostEqual(result["P50"], 499.5)
+        self.assertAlmostEqual(result["P99"], 989.01)
+        self.assertEqual(result["MAX"], 999.0)
+        self.assertNotIn("ID", result)
+
+    def test_grace_accepts_out_of_order_rows_and_drops_late_ones(self):
+        aggregator = WindowedAggregator(TumblingWindow(1000), key="ID", grace=500)
+        self.assertEqual(aggregator.process([row("a", 100), row("a", 1200)]), [])
+        self.assertEqual(aggregator.process([row("a", 800)]), [])
+        results = aggregator.process([row("a", 1600)])
+        self.assertEqual(results, [{"ID": "a", "WINDOWSTART": 0, "WINDOWEND": 1000, "COUNT": 2}])
+        aggregator.process([row("a", 300)])
+        self.assertEqual(aggregator.late, 1)
+        self.assertEqual(aggregator.flush(), [{"ID": "a", "WINDOWSTART": 1000, "WINDOWEND": 2000, "COUNT": 2}])
+
+    def test_null_values_are_skipped(self):
+        aggregator = WindowedAggregator(TumblingWindow(1000), value="AMOUNT", aggregations=("count", "sum"))
+        aggregator.process([row("a", 1, 2), row("a", 2, None)])
+        self.assertEqual(aggregator.skipped, 1)
+        self.assertEqual(aggregator.flush()[0]["COUNT"], 1)
+
+    def test_composite_and_computed_keys(self):
+        aggregator = WindowedAggregator(TumblingWindow(1000), key=("ID", "REGION"))
+        aggregator.process([{"ID": 1, "REGION": "eu", "ROWTIME": 5}])
+        self.assertEqual(
+            aggregator.flush(), [{"ID": 1, "REGION": "eu", "WINDOWSTART": 0, "WINDOWEND": 1000, "COUNT": 1}]
+        )
+        aggregator = WindowedAggregator(TumblingWindow(1000), key=lambda r: r["ID"] % 2)
+        aggregator.process([row(i, i) for i in range(5)])
+        self.assertEqual({result["KEY"]: result["COUNT"] for result in aggregator.flush()}, {0: 3, 1: 2})
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            WindowedAggregator(TumblingWindow(1000), aggregations=("median",), value="AMOUNT")
+        with self.assertRaises(ValueError):
+            WindowedAggregator(TumblingWindow(1000), aggregations=("sum",))
+        with self.assertRaises(ValueError):
+            HoppingWindow(1000, 2000)
+        with self.assertRaises(ValueError):
+            SessionWindow(0)
+
+    def test_durations(self):
+        self.assertEqual(to_duration(datetime.timedelta(minutes=1)), 60000)
+        self.assertEqual(TumblingWindow(datetime.timedelta(seconds=5)).size, 5000)
+
+
+class TestHoppingWindows(unittest.TestCase):
+    def test_rows_belong_to_every_overlapping_window(self):
+        aggregator = WindowedAggregator(HoppingWindow(1000, 250), key="ID")
+        aggregator.process([row("a", 600)])
+        results = aggregator.flush()
+        self.assertEqual(
+            [(r["WINDOWSTART"], r["WINDOWEND"]) for r in results], [(-250, 750), (0, 1000), (250, 1250), (500, 1500)]
+        )
+        self.assertEqual({r["COUNT"] for r in results}, {1})
+
+    def test_windows_close_in_order(self):
+        aggregator = WindowedAggregator(HoppingWindow(1000, 500), key="ID")
+        results = aggregator.process([row("a", 100), row("a", 700)])
+        self.assertEqual([(r["WINDOWSTART"], r["COUNT"]) for r in results], [(-500, 1)])
+        results = aggregator.process([row("a", 1100)])
+        self.assertEqual([(r["WINDOWSTART"], r["COUNT"]) for r in results], [(0, 2)])
+        results = aggregator.flush()
+        self.assertEqual([(r["WINDOWSTART"], r["COUNT"]) for r in results], [(500, 2), (1000, 1)])
+
+
+class TestSessionWindows(unittest.TestCase):
+    def test_rows_closer_than_the_gap_share_a_session(self):
+        aggregator = WindowedAggregator(SessionWindow(100), key="ID", value="AMOUNT", aggregations=("count", "sum"))
+        results = aggregator.process([row("a", 0, 1), row("a", 50, 1), row("b", 60, 7), row("a", 300, 1)])
+        self.assertEqual(
+            results,
+            [
+                {"ID": "a", "WINDOWSTART": 0, "WINDOWEND": 50, "COUNT": 2, "SUM": 2.0},
+                {"ID": "b", "WINDOWSTART": 60, "WINDOWEND": 60, "COUNT": 1, "SUM": 7.0},
+            ],
+        )
+        results = aggregator.process([row("a", 350, 1), row("a", 500, 1)])
+        self.assertEqual(results, [{"ID": "a", "WINDOWSTART": 300, "WINDOWEND": 350, "COUNT": 2, "SUM": 2.0}])
+
+    def test_out_of_order_row_merges_sessions(self):
+        aggregator = WindowedAggregator(SessionWindow(100), key="ID", grace=1000)
+        aggregator.process([row("a", 0), row("a", 150)])
+        self.assertEqual(aggregator.open_windows, 2)
+        aggregator.process([row("a", 80)])
+        self.assertEqual(aggregator.open_windows, 1)
+        self.assertEqual(aggregator.flush(), [{"ID": "a", "WINDOWSTART": 0, "WINDOWEND": 150, "COUNT": 3}])
+
+    def test_late_rows_are_dropped(self):
+        aggregator = WindowedAggregator(SessionWindow(100), key="ID")
+        aggregator.process([row("a", 0), row("a", 1000)])
+        aggregator.process([row("a", 500)])
+        self.assertEqual(aggregator.late, 1)
+
+
+class TestAggregateWindows(unittest.TestCase):
+    def test_aggregates_a_push_query(self):
+        with FakeKSQLServer(stream=StreamConfig(rows=1000)) as server:
+            client = KSQLAPI(server.url, check_version=False)
+            results = list(
+                client.aggregate_windows(
+                    "select * from events emit changes;",
+                    TumblingWindow(100),
+                    value="ID",
+                    aggregations=("count", "max"),
+                    time_column="ID",
+                    batch_size=64,
+                )
+            )
+        self.assertEqual(len(results), 10)
+        self.assertEqual([r["COUNT"] for r in results], [100] * 10)
+        self.assertEqual(results[-1], {"WINDOWSTART": 900, "WINDOWEND": 1000, "COUNT": 100, "MAX": 999.0})